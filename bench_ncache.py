@@ -0,0 +1,465 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for ncache.
+
+Two layers are measured.
+
+micro  Times the server engine functions directly, parse_command,
+       _get_or_timeout, _set_key, _clear_perm_keys, _clear_ttl_keys and
+       manage_memory, against caches holding 10k, 1M and 10M keys.
+e2e    Runs run_ncache in a child process on localhost and drives it with
+       ncache_client.NCache at several concurrency levels and value sizes.
+
+Every benchmark reports ops/sec and p50/p99/p999 latency. Results can be
+saved as json and two result files compared to find regressions.
+
+simulate replays a recorded trace or a Zipfian workload against each
+eviction policy of ncache_policy offline, in this process, and reports the
+hit ratio and the cost of evicting. A trace has one request per line, GET
+<key> or SET <key> [<value bytes> [<ttl seconds>]], a bare key being a GET.
+A GET that misses sets the key, as a caller filling the cache would.
+
+    $ python bench_ncache.py micro --sizes 10000 1000000 --output base.json
+    $ python bench_ncache.py e2e --concurrency 1 8 --value-sizes 100 10000 --output base.json
+    $ python bench_ncache.py compare base.json new.json --threshold 0.1
+    $ python bench_ncache.py simulate --zipf 0.99 --keys 100000 --ops 1000000 --memory 16000000
+    $ python bench_ncache.py simulate --trace requests.log --policies lru tinylfu
+"""
+
+__author__ = "Niall O'Connor zechs dot marquie at gmail dot com"
+__version__ = '1.0'
+
+import argparse
+from   datetime import datetime, timedelta
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import ncache
+from   ncache_client import NCache
+from   ncache_policy import POLICIES, make_policy
+from   ncache_store import Store
+
+perf_counter = time.perf_counter
+
+def percentile(ordered, fraction):
+    """
+    Returns the value at fraction (0-1) of an ordered list.
+    """
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def summarise(name, latencies, elapsed, **params):
+    """
+    Returns a result dict for a benchmark.
+
+    :param str name: The benchmark name.
+    :param list latencies: Seconds taken by each operation.
+    :param float elapsed: Wall clock seconds taken by all operations.
+    :param params: Parameters of the run, eg. keys or concurrency.
+    """
+    ordered = sorted(latencies)
+    result = {
+        'name': name,
+        'params': params,
+        'ops': len(latencies),
+        'ops_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_us': percentile(ordered, .50) * 1e6,
+        'p99_us': percentile(ordered, .99) * 1e6,
+        'p999_us': percentile(ordered, .999) * 1e6,
+    }
+    return result
+
+def timed(func, args_list):
+    """
+    Calls func with each args tuple in args_list, timing every call.
+    Returns (latencies, elapsed).
+    """
+    latencies = [0.0] * len(args_list)
+    started = perf_counter()
+    for i, args in enumerate(args_list):
+        before = perf_counter()
+        func(*args)
+        latencies[i] = perf_counter() - before
+    return latencies, perf_counter() - started
+
+def populate(size, value='x' * 100):
+    """
+    Fills the module store with size keys, half perm and half ttl keys with
+    expiries spread over the next 10000 seconds.
+    """
+    ncache.flush_all()
+    set_key = ncache._set_key
+    for i in range(size):
+        if i % 2:
+            set_key('key{0}'.format(i), value, ttl=i % 10000 + 1)
+        else:
+            set_key('key{0}'.format(i), value)
+
+def run_micro(sizes, ops):
+    """
+    Runs the engine microbenchmarks at each cache size.
+
+    :param list sizes: Numbers of keys in the cache.
+    :param int ops: Operations timed per benchmark.
+    """
+    results = []
+    for size in sizes:
+        populate(size)
+        count = min(ops, size)
+        keys = ['key{0}'.format(i) for i in range(count)]
+
+        latencies, elapsed = timed(ncache.parse_command, [('GET {0}'.format(key),) for key in keys])
+        results.append(summarise('parse_command GET', latencies, elapsed, keys=size))
+
+        latencies, elapsed = timed(ncache.parse_command,
+                                   [('SET {0} "some test data" TTL=300'.format(key),) for key in keys])
+        results.append(summarise('parse_command SET', latencies, elapsed, keys=size))
+
+        latencies, elapsed = timed(ncache._get_or_timeout, [(key,) for key in keys])
+        results.append(summarise('_get_or_timeout', latencies, elapsed, keys=size))
+
+        latencies, elapsed = timed(ncache._set_key, [(key, 'x' * 100,) for key in keys])
+        results.append(summarise('_set_key', latencies, elapsed, keys=size))
+
+        latencies, elapsed = timed(ncache._clear_perm_keys, [(1,)] * count)
+        results.append(summarise('_clear_perm_keys', latencies, elapsed, keys=size))
+
+        populate(size)
+        now = datetime.now()
+        windows = [(now + timedelta(seconds=10000 * (i + 1) // count),) for i in range(count)]
+        latencies, elapsed = timed(ncache._clear_ttl_keys, windows)
+        results.append(summarise('_clear_ttl_keys', latencies, elapsed, keys=size))
+
+        populate(size)
+        limit = ncache.current_cache_size()
+        step = max(limit // (count * 2), 1)
+        latencies, elapsed = timed(ncache.manage_memory,
+                                   [(1, 300, limit - step * (i + 1),) for i in range(count)])
+        results.append(summarise('manage_memory', latencies, elapsed, keys=size))
+    ncache.flush_all()
+    return results
+
+def zipf_trace(keys, ops, exponent=0.99, value_size=100, seed=1):
+    """
+    Returns ops GET requests for keys drawn from a Zipf distribution, key i
+    requested with probability proportional to 1 / (i + 1) ** exponent.
+
+    :param int keys: Distinct keys.
+    :param int ops: Requests.
+    :param float exponent: Skew, higher concentrates requests on fewer keys.
+    :param int value_size: Bytes of the value set when a GET misses.
+    :param int seed: Seed of the random draws so runs repeat.
+    """
+    weights = [1.0 / (i + 1) ** exponent for i in range(keys)]
+    total = 0.0
+    cumulative = []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    names = ['key{0}'.format(i) for i in range(keys)]
+    draws = random.Random(seed).choices(range(keys), cum_weights=cumulative, k=ops)
+    return [('GET', names[i], value_size, None,) for i in draws]
+
+def read_trace(path, value_size=100):
+    """
+    Returns the requests of a trace file as (op, key, value bytes, ttl) tuples.
+
+    :param str path: The trace, see the module docstring for its format.
+    :param int value_size: Bytes of values whose size the trace omits.
+    """
+    trace = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields:
+                continue
+            if len(fields) == 1:
+                fields = ['GET'] + fields
+            op = fields[0].upper()
+            if op not in ('GET', 'SET') or len(fields) > 4 or (op == 'GET' and len(fields) > 2):
+                raise ValueError('ERROR: Malformed trace line {0}: {1}'.format(number, line.strip()))
+            size = int(fields[2]) if len(fields) > 2 else value_size
+            ttl = float(fields[3]) if len(fields) > 3 else None
+            trace.append((op, fields[1], size, ttl,))
+    return trace
+
+def simulate(trace, policy, limit, chunk_size=1, trace_name='trace'):
+    """
+    Replays trace against an empty Store evicting with policy and returns a
+    result dict with its hit ratio, evictions and their cost. ncache.store is
+    replaced for the replay so manage_memory runs exactly as in the server.
+
+    :param list trace: (op, key, value bytes, ttl) requests, see read_trace.
+    :param str policy: The name of the eviction policy.
+    :param int limit: The cache size limit in bytes.
+    :param int chunk_size: Keys the policy evicts at a time.
+    :param str trace_name: Describes the trace in the result.
+    """
+    store = Store(make_policy(policy))
+    values = {}
+    saved = ncache.store
+    ncache.store = store
+    manage_memory = ncache.manage_memory
+    try:
+        started = perf_counter()
+        for op, key, size, ttl in trace:
+            if op == 'GET' and store.get_entry(key) is not None:
+                continue
+            value = values.get(size)
+            if value is None:
+                value = values[size] = b'x' * size
+            store.set(key, value, ttl)
+            if store.bytes > limit:
+                manage_memory(chunk_size, 300, limit)
+        elapsed = perf_counter() - started
+    finally:
+        ncache.store = saved
+    lookups = store.hits + store.misses
+    evictions = store.evictions
+    return {
+        'name': 'simulate',
+        'params': {'policy': policy, 'trace': trace_name, 'limit': limit},
+        'ops': len(trace),
+        'hit_ratio': float(store.hits) / lookups if lookups else 0.0,
+        'evictions': evictions,
+        'eviction_us': store.eviction_seconds / evictions * 1e6 if evictions else 0.0,
+        'replay_us': elapsed / len(trace) * 1e6 if trace else 0.0,
+    }
+
+def run_simulate(trace, policies, limits, chunk_size=1, trace_name='trace'):
+    """
+    Replays trace against every policy at every limit.
+
+    :param list trace: (op, key, value bytes, ttl) requests.
+    :param list policies: Names of the eviction policies.
+    :param list limits: Cache size limits in bytes.
+    """
+    return [simulate(trace, policy, limit, chunk_size, trace_name) for limit in limits for policy in policies]
+
+def report_simulation(results, out=sys.stdout):
+    """
+    Prints a table of simulation results. eviction us is the time spent
+    choosing and removing each evicted key, replay us the time taken by each
+    request including the policy's bookkeeping.
+    """
+    out.write('{0:<70} {1:>10} {2:>10} {3:>12} {4:>10}\n'.format(
+        'simulation', 'hit ratio', 'evictions', 'eviction us', 'replay us'))
+    for result in results:
+        out.write('{0:<70} {1:>10.4f} {2:>10} {3:>12.2f} {4:>10.2f}\n'.format(
+            result_id(result), result['hit_ratio'], result['evictions'], result['eviction_us'], result['replay_us']))
+
+def free_port():
+    """
+    Returns a localhost port nothing is listening on.
+    """
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_server(port, buffer_size=65536):
+    """
+    Runs run_ncache in a child process and waits until it accepts connections.
+    """
+    process = multiprocessing.Process(target=ncache.run_ncache,
+                                      kwargs={'port': port, 'buffer_size': buffer_size})
+    process.daemon = True
+    process.start()
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return process
+        except (IOError, OSError):
+            if time.time() > deadline:
+                process.terminate()
+                raise
+            time.sleep(0.05)
+
+def run_e2e(concurrency_levels, value_sizes, ops):
+    """
+    Drives a localhost server with NCache from several threads.
+
+    :param list concurrency_levels: Numbers of threads issuing requests at once.
+    :param list value_sizes: Sizes in bytes of the values set and got.
+    :param int ops: Operations per thread per benchmark.
+    """
+    port = free_port()
+    process = start_server(port)
+    results = []
+    try:
+        for concurrency in concurrency_levels:
+            cache = NCache(port=port, pool_size=concurrency)
+            for value_size in value_sizes:
+                value = b'x' * value_size
+                for name in ('set', 'get'):
+                    latencies = []
+                    def work(n):
+                        call = getattr(cache, name)
+                        mine = [0.0] * ops
+                        for i in range(ops):
+                            key = 'bench-{0}-{1}'.format(n, i)
+                            before = perf_counter()
+                            if name == 'set':
+                                call(key, value)
+                            else:
+                                call(key)
+                            mine[i] = perf_counter() - before
+                        latencies.extend(mine)
+                    threads = [threading.Thread(target=work, args=(n,)) for n in range(concurrency)]
+                    started = perf_counter()
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+                    elapsed = perf_counter() - started
+                    results.append(summarise('NCache.' + name, latencies, elapsed,
+                                             concurrency=concurrency, value_size=value_size))
+            cache.close()
+    finally:
+        process.terminate()
+        process.join()
+    return results
+
+def environment():
+    """
+    Describes where the benchmarks ran so results can be compared fairly.
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (IOError, OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': multiprocessing.cpu_count(),
+    }
+
+def result_id(result):
+    """
+    Returns a key identifying the same benchmark across result files.
+    """
+    params = ','.join('{0}={1}'.format(k, v) for k, v in sorted(result['params'].items()))
+    return '{0} [{1}]'.format(result['name'], params)
+
+def report(results, out=sys.stdout):
+    """
+    Prints a results table.
+    """
+    out.write('{0:<50} {1:>12} {2:>10} {3:>10} {4:>10}\n'.format('benchmark', 'ops/sec', 'p50 us', 'p99 us', 'p999 us'))
+    for result in results:
+        out.write('{0:<50} {1:>12.0f} {2:>10.2f} {3:>10.2f} {4:>10.2f}\n'.format(
+            result_id(result), result['ops_per_sec'], result['p50_us'], result['p99_us'], result['p999_us']))
+
+def save(results, path):
+    """
+    Adds results to the json file at path, replacing earlier results of the
+    same benchmarks.
+    """
+    data = {'environment': environment(), 'results': []}
+    if os.path.exists(path):
+        with open(path) as f:
+            data['results'] = json.load(f)['results']
+    replaced = set(result_id(result) for result in results)
+    data['results'] = [r for r in data['results'] if result_id(r) not in replaced] + results
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+def compare(base_path, new_path, threshold, out=sys.stdout):
+    """
+    Compares two result files. A benchmark regresses when its throughput
+    falls or its p99 latency rises by more than threshold.
+
+    :returns list: The ids of the regressed benchmarks.
+    """
+    with open(base_path) as f:
+        base = dict((result_id(r), r,) for r in json.load(f)['results'])
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    regressions = []
+    out.write('{0:<50} {1:>10} {2:>10}\n'.format('benchmark', 'ops/sec', 'p99'))
+    for result in new:
+        rid = result_id(result)
+        old = base.get(rid)
+        if old is None or 'ops_per_sec' not in result:
+            continue
+        throughput = result['ops_per_sec'] / old['ops_per_sec'] - 1 if old['ops_per_sec'] else 0.0
+        p99 = result['p99_us'] / old['p99_us'] - 1 if old['p99_us'] else 0.0
+        regressed = throughput < -threshold or p99 > threshold
+        if regressed:
+            regressions.append(rid)
+        out.write('{0:<50} {1:>+9.1%} {2:>+9.1%}{3}\n'.format(rid, throughput, p99, '  REGRESSION' if regressed else ''))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ncache benchmarks')
+    commands = parser.add_subparsers(dest='command')
+    micro = commands.add_parser('micro', help='engine microbenchmarks')
+    micro.add_argument('--sizes', type=int, nargs='+', default=[10000, 1000000, 10000000])
+    micro.add_argument('--ops', type=int, default=100000)
+    micro.add_argument('--output')
+    e2e = commands.add_parser('e2e', help='client to server round trips on localhost')
+    e2e.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    e2e.add_argument('--value-sizes', type=int, nargs='+', default=[100, 10000, 1000000])
+    e2e.add_argument('--ops', type=int, default=2000)
+    e2e.add_argument('--output')
+    sim = commands.add_parser('simulate', help='replay a workload against each eviction policy')
+    sim.add_argument('--trace', help='trace file to replay instead of a Zipfian workload')
+    sim.add_argument('--zipf', type=float, default=0.99, help='skew of the Zipfian workload')
+    sim.add_argument('--keys', type=int, default=100000)
+    sim.add_argument('--ops', type=int, default=1000000)
+    sim.add_argument('--value-size', type=int, default=100)
+    sim.add_argument('--memory', type=int, nargs='+', default=[4000000, 16000000], help='cache limits in bytes')
+    sim.add_argument('--policies', nargs='+', default=sorted(POLICIES), choices=sorted(POLICIES))
+    sim.add_argument('--chunk', type=int, default=1, help='keys evicted at a time')
+    sim.add_argument('--output')
+    cmp_ = commands.add_parser('compare', help='compare two result files')
+    cmp_.add_argument('base')
+    cmp_.add_argument('new')
+    cmp_.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        return 1 if compare(args.base, args.new, args.threshold) else 0
+    if args.command == 'micro':
+        results = run_micro(args.sizes, args.ops)
+    elif args.command == 'e2e':
+        results = run_e2e(args.concurrency, args.value_sizes, args.ops)
+    elif args.command == 'simulate':
+        if args.trace:
+            trace, name = read_trace(args.trace, args.value_size), os.path.basename(args.trace)
+        else:
+            trace = zipf_trace(args.keys, args.ops, args.zipf, args.value_size)
+            name = 'zipf-{0}-{1}'.format(args.zipf, args.keys)
+        results = run_simulate(trace, args.policies, args.memory, args.chunk, name)
+        report_simulation(results)
+        if args.output:
+            save(results, args.output)
+        return 0
+    else:
+        parser.print_help()
+        return 2
+    report(results)
+    if args.output:
+        save(results, args.output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
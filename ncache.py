@@ -9,28 +9,50 @@ basic language parsing.
 __author__ = "Niall O'Connor zechs dot marquie at gmail dot com"
 __version__ = '1.0'
 
-from   datetime import datetime, timedelta
+from   datetime import datetime
 import logging
+import mmap
+import os
+import multiprocessing
+import selectors
+import signal
 import socket
-from   sys import getsizeof
+import sys
+import time
+from   time import perf_counter
+
+from   ncache_persist import (KIND_PING, ReplicationFeed, Snapshotter, WriteLog, apply_record, load_snapshot,
+                          read_record)
+import ncache_protocol as protocol
+from   ncache_policy import make_policy
+from   ncache_shared import SharedTable
+from   ncache_store import KeyIndex, Store, now_ticks, seconds_to_ticks
 
 # setup logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-cache_timeouts = {}
-cache_values = {}
+# every key lives in the store, see ncache_store for the entry layout
+store = Store()
+
+# keys by tag and by prefix, kept in step with every change to the store
+index = KeyIndex(separator=':')
+store.watchers.append(index)
+
+# leases held on keys, key -> (token, <expiry tick>). Leases are kept apart
+# from the store so they are never evicted, persisted or counted as keys.
+leases = {}
+# expired leases are swept once the table grows past this size
+lease_sweep_size = 1024
 
 def _get_or_timeout(key):
     """
     Returns a key or clears timed out key.
 
-    ncache.cahce_values   contains key->value   pairs
-    ncache.cache_timeouts contains key->timeout pairs
-
-    There are two flavours of timeout
-    1. ('ttl',  <ttl datetime>)
-    2. ('perm', <created time>)
+    Each key is held in ncache.store as a single entry with an expiry tick.
+    There are two flavours of entry
+    1. ttl,  expires on <expiry tick>
+    2. perm, expires is None
 
     Specification.
 
@@ -40,37 +62,20 @@ def _get_or_timeout(key):
     |'k2' |    'ttl'     | in past      | 'NOT FOUND' |
     |'k3' |    'perm'    | in past      |  value      |
 
-    :param str key: A key in the timeout and value caches.
-    """
-    expiry = cache_timeouts.get(key, None)
-    value = None
-    if expiry:
-        # We found a time to live key
-        if expiry[0] == 'ttl':
-            # ttl is in the future or else the key should be deleted.
-            if expiry[1] > datetime.now():
-                value =  cache_values.get(key, None)
-        else: # key is permanent
-            value = cache_values.get(key, None)
+    :param str key: A key in the store.
+    """
+    value = store.get(key)
     if value is None:
-        # no key could be returned so be sure both cache timeouts and cache values are in sync.
-        cache_timeouts.pop(key, None)
-        cache_values.pop(key, None)
         value = 'NOT FOUND'
     return value
 
 def _clear_perm_keys(chunk_size):
     """
-    Clears a chunk of the oldest perm keys to free space.
+    Clears a chunk of the least recently used perm keys to free space.
 
     :param int chunk_size: The number of keys to clear.
     """
-    keys = [(key, val[1],) for key, val in cache_timeouts.items() if val[0] == 'perm']
-    keys = sorted(keys, key=lambda x: x[1], reverse=False)
-    keys = keys[:chunk_size]
-    for key, _ in keys:
-        cache_timeouts.pop(key, None)
-        cache_values.pop(key, None)
+    store.evict_lru(chunk_size)
 
 def _clear_ttl_keys(future):
     """
@@ -78,159 +83,1487 @@ def _clear_ttl_keys(future):
 
     :param datetime.datetime future: Future date used to expire keys.
     """
-    keys = [(key, val[1],) for key, val in cache_timeouts.items() if val[0] == 'ttl']
-    for key, expiry in keys:
-        if expiry < future:
-            cache_timeouts.pop(key, None)
-            cache_values.pop(key, None)
+    store.expire_before(now_ticks() + seconds_to_ticks((future - datetime.now()).total_seconds()))
+
+def _delete_key(key):
+    """
+    Removes a key from the store.
+
+    :param str key: The key to delete.
+    :returns bool: True if the key existed.
+    """
+    return store.delete(key)
+
+def _delete_keys(keys):
+    """
+    Removes keys from the store.
+
+    :param list keys: The keys to delete.
+    :returns int: The number of keys that existed.
+    """
+    return sum(1 for key in keys if store.delete(key))
+
+def _tag_key(key, tags):
+    """
+    Tags a key so it can be deleted with every other key sharing a tag.
+
+    :param str key: The key to tag.
+    :param list tags: The tags.
+    :returns bool: True if the key exists and was tagged.
+    """
+    if key not in store:
+        return False
+    index.tag(key, tags)
+    return True
+
+def _delete_tags(tags):
+    """
+    Removes every key tagged with any of tags. The cost is proportional to
+    the number of keys removed.
+
+    :param list tags: The tags.
+    :returns int: The number of keys removed.
+    """
+    return sum(_delete_keys(index.keys_with_tag(tag)) for tag in tags)
+
+def _delete_prefix(prefix):
+    """
+    Removes every key starting with prefix. Prefixes ending in the index
+    separator, eg. 'tenant:42:', cost time proportional to the keys removed,
+    others scan every key.
+
+    :param str prefix: The prefix.
+    :returns int: The number of keys removed.
+    """
+    if not prefix:
+        raise ValueError('ERROR: DELPREFIX needs a prefix')
+    return _delete_keys(index.keys_with_prefix(prefix, store))
+
+def _lease(key, token, ttl):
+    """
+    Takes a lease on a key for ttl seconds. A lease is granted when the key
+    has none, its lease expired or token already holds it, which renews it.
+    Only one of many processes about to recompute a key gets the lease.
+
+    :param str key: The key to lease.
+    :param str token: Identifies the holder, used again to release the lease.
+    :param int ttl: Seconds until the lease expires.
+    :returns bool: True if the lease was granted.
+    """
+    global lease_sweep_size
+    now = now_ticks()
+    held = leases.get(key)
+    if held is not None and held[0] != token and held[1] > now:
+        return False
+    leases[key] = (token, now + seconds_to_ticks(ttl),)
+    if len(leases) > lease_sweep_size:
+        for k in [k for k, (_, expires) in leases.items() if expires <= now]:
+            del leases[k]
+        lease_sweep_size = max(1024, 2 * len(leases))
+    return True
+
+def _release(key, token):
+    """
+    Releases a lease held by token.
+
+    :param str key: The leased key.
+    :param str token: The token the lease was taken with.
+    :returns bool: True if token held the lease.
+    """
+    held = leases.get(key)
+    if held is None or held[0] != token:
+        return False
+    del leases[key]
+    return held[1] > now_ticks()
 
 def _set_key(key, value, ttl=None):
     """
-    Sets a key in cache_values and cache_timeouts.
+    Sets a key in the store.
 
     :param str key: The key we are setting.
     :param str val: The value we are setting.
     :param int ttl: The time to live in seconds. Optional.
     """
-    if ttl is not None:
-        cache_timeouts[key] = ('ttl', datetime.now() + timedelta(seconds=ttl),)
-    else:
-        cache_timeouts[key] = ('perm', datetime.now(),)
-    cache_values[key] = value
+    store.set(key, value, ttl)
+
+def _incr(key, delta, initial=0, ttl=None):
+    """
+    Adds delta to the integer held in a key and returns the result. A missing
+    key starts at initial and is given ttl, an existing key keeps its expiry.
+
+    :param str key: The counter key.
+    :param int delta: The amount to add, negative to decrement.
+    :param int initial: The value of a missing key before delta is added.
+    :param int ttl: The time to live in seconds of a new key. Optional.
+    """
+    with store.lock(key):
+        entry = store.get_entry(key)
+        if entry is None:
+            value = initial + delta
+            store.set(key, str(value), ttl)
+            return value
+        try:
+            value = int(entry.value) + delta
+        except ValueError:
+            raise ValueError('ERROR: {0} does not hold an integer'.format(key))
+        store.replace_value(entry, str(value))
+        return value
+
+def _add(key, value, ttl=None):
+    """
+    Sets a key only if it is missing.
+
+    :returns int: The version of the new entry or None if the key exists.
+    """
+    with store.lock(key):
+        if store.get_entry(key) is not None:
+            return None
+        return store.set(key, value, ttl).version
+
+def _cas(key, value, version, ttl=None):
+    """
+    Sets a key only if its version is still version, as returned by GETS.
+
+    :param int version: The version the key was read at.
+    :returns int: The version of the new entry, None if the key changed
+                  since it was read or False if the key is missing.
+    """
+    with store.lock(key):
+        entry = store.get_entry(key)
+        if entry is None:
+            return False
+        if entry.version != version:
+            return None
+        return store.set(key, value, ttl).version
+
+class Command(object):
+    """
+    A text command in the registry.
+
+    A command either takes words, the arguments split on spaces, or like SET
+    a key and a value running to the end of the line with an optional TTL.
+    """
+    __slots__ = ('name', 'handler', 'min_args', 'max_args', 'value')
+
+    def __init__(self, name, handler, min_args=0, max_args=None, value=False):
+        self.name = name
+        self.handler = handler
+        self.min_args = min_args
+        self.max_args = max_args
+        self.value = value
+
+    def arity_error(self, received):
+        """
+        Returns the ValueError for a call with the wrong number of args.
+        """
+        if self.value:
+            expected = 'KEY VALUE [TTL=<int>]'
+        elif self.min_args == self.max_args:
+            expected = str(self.min_args)
+        elif self.max_args is None:
+            expected = 'at least {0}'.format(self.min_args)
+        else:
+            expected = '{0} to {1}'.format(self.min_args, self.max_args)
+        return ValueError('ERROR: Wrong number of args for {0}. Received {1}, expected {2}'.format(
+            self.name, received, expected))
+
+# lower case command name -> Command
+commands = {}
+
+def register_command(name, min_args=0, max_args=None, value=False):
+    """
+    Decorator registering a function as the handler of a text command. A
+    handler returns the response text or raises ValueError('ERROR: ...').
+
+    :param str name: The command, matched case insensitively.
+    :param int min_args: The fewest words the command takes.
+    :param int max_args: The most words the command takes, None for no limit.
+    :param bool value: Call the handler with (key, value, ttl) parsed like SET instead of words.
+
+    Usage:
+        >>> @register_command('append', 2, value=True)
+            def append(key, value, ttl):
+                ...
+    """
+    def register(handler):
+        commands[name.lower()] = Command(name.upper(), handler, min_args, max_args, value)
+        return handler
+    return register
+
+def _unquote(value):
+    """
+    Removes one pair of double quotes enclosing a value.
+    """
+    if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+        return value[1:-1]
+    return value
+
+def _key_value_ttl(command, rest):
+    """
+    Reads KEY VALUE [TTL=<int>] in one pass. Only the key and a trailing TTL
+    are split off, the value between them keeps its spacing.
+
+    :param Command command: The command being parsed, for its arity error.
+    :param str rest: The text after the command name.
+    """
+    key, _, value = rest.lstrip(' ').partition(' ')
+    if not key or not value:
+        raise command.arity_error(1 if key else 0)
+    ttl = None
+    head, space, tail = value.rpartition(' ')
+    if space and tail[:4].lower() == 'ttl=' and tail[4:].isdigit():
+        value = head
+        ttl = int(tail[4:])
+    return key, _unquote(value), ttl
 
 def parse_command(command):
     """
-    Parses SET and GET commands. Behaviour of the set command is represented below.
+    Parses a text command and runs the handler registered for it, see
+    register_command. Behaviour of the builtin commands is represented below.
 
     SET <KEY_NAME> "<VALUE>" TTL=<int>
-        - Key names CANNOT have spaces. TTL is optional.
+        - Key names CANNOT have spaces. TTL is optional. The value is taken as
+          sent, spaces included, with one pair of enclosing quotes removed.
 
     GET <KEY_NAME>
         - Key names CANNOT have spaces
 
+    MGET <KEY_NAME> <KEY_NAME> ...
+        - Responds with one line per key, NOT FOUND for missing keys.
+
+    MSET <KEY_NAME> <VALUE> [TTL=<int>] <KEY_NAME> <VALUE> [TTL=<int>] ...
+        - Values CANNOT have spaces. Each TTL applies to the key before it.
+
+    LEASE <KEY_NAME> <TOKEN> <SECONDS>
+        - Responds SUCCESS if the lease was granted, LOCKED if another token holds it.
+
+    RELEASE <KEY_NAME> <TOKEN>
+        - Responds SUCCESS if the token held the lease, NOT FOUND otherwise.
+
+    INCR <KEY_NAME> <DELTA> [<INITIAL>] [TTL=<int>]
+    DECR <KEY_NAME> <DELTA> [<INITIAL>] [TTL=<int>]
+        - Responds with the new value. A missing key starts at INITIAL, 0 if
+          omitted, and takes the TTL.
+
+    ADD <KEY_NAME> "<VALUE>" TTL=<int>
+        - Like SET but responds EXISTS instead if the key is already set.
+
+    GETS <KEY_NAME>
+        - Responds with the value and its version on the next line.
+
+    DEL <KEY_NAME> <KEY_NAME> ...
+        - Responds with the number of keys deleted.
+
+    TAG <KEY_NAME> <TAG> <TAG> ...
+        - Responds SUCCESS or NOT FOUND if the key is missing.
+
+    DELTAG <TAG> <TAG> ...
+    DELPREFIX <PREFIX>
+        - Delete every key with one of the tags or starting with the prefix,
+          responding with the number of keys deleted.
+
+    CAS <KEY_NAME> <VERSION> "<VALUE>" TTL=<int>
+        - Like SET if the key is still at VERSION, otherwise responds EXISTS,
+          or NOT FOUND if the key is missing.
+
     |   command               |  Expected              |
     +-------------------------+------------------------+
     | SET k1 "some test data" | k1 -> "some test data" |
     | SET k2 "some test data" | k2 -> "some test data" |
     | SET k2 "more test data" | k1 -> "more test data" |
-    | SET k3 some test data   | Exception - wrong args |
+    | SET k3 some test data   | k3 -> "some test data" |
     | SET k3 "me " TTL=20     | k3 -> "me "            |
     | SET k4                  | Exception - wrong args |
     | GET thing               | NOT FOUND              |
     | GET k3                  | "me "                  |
+    | MSET a 1 b 2 TTL=5      | a -> "1", b -> "2"     |
+    | MGET a thing b          | "1", NOT FOUND, "2"    |
+    | LEASE a t1 10           | SUCCESS                |
+    | LEASE a t2 10           | LOCKED                 |
+    | RELEASE a t1            | SUCCESS                |
+    | INCR hits 1             | 1                      |
+    | DECR hits 5 10 TTL=60   | -4                     |
+    | ADD a "x"               | EXISTS                 |
+    | TAG a t1                | SUCCESS                |
+    | DELTAG t1               | 1                      |
+    | DEL a thing             | 0                      |
     """
-    # preceeding and trailing spaces are removed and the entire string is split on spaces.
-    command = command.lstrip(' ').rstrip(' ').split(' ')
+    name, _, rest = command.lstrip(' ').partition(' ')
+    entry = commands.get(name.lower())
+    if entry is None:
+        names = [c.name for c in commands.values()]
+        raise ValueError('ERROR: Unkown command. Not {0} or {1}'.format(', '.join(names[:-1]), names[-1]))
+    if entry.value:
+        return entry.handler(*_key_value_ttl(entry, rest))
+    args = rest.split()
+    if len(args) < entry.min_args or (entry.max_args is not None and len(args) > entry.max_args):
+        raise entry.arity_error(len(args))
+    return entry.handler(*args)
+
+@register_command('get', 1, 1)
+def _command_get(key):
+    return _get_or_timeout(key)
+
+@register_command('set', value=True)
+def _command_set(key, value, ttl):
+    _set_key(key, value, ttl=ttl)
+    return 'SUCCESS'
 
-    # A GET command can only be followed by a KEY
-    if command[0].lower() == 'get': # case insensitive
-        if len(command) == 2:
-            return _get_or_timeout(command[1])
+@register_command('mget', 1)
+def _command_mget(*keys):
+    return '\r\n'.join(_text(_get_or_timeout(key)) for key in keys)
+
+@register_command('mset', 2)
+def _command_mset(*args):
+    # KEY VALUE pairs, each followed by an optional TTL
+    batch = []
+    while len(args) > 1:
+        key, value = args[0], _unquote(args[1])
+        ttl = args[2].lower() if len(args) > 2 else ''
+        if ttl.startswith('ttl=') and ttl[4:].isdigit():
+            batch.append((key, value, int(ttl[4:]),))
+            args = args[3:]
         else:
-            raise ValueError('ERROR: Wrong number of args for GET. Received {0}, expected 2'.format(len(command)))
-    # A SET command can be followed by a KEY, then a VALUE and finally an optional TTL
-    elif command[0].lower() == 'set': # case insensitive
-        # Do we have at least the right num of params?
-        if len(command) > 2:
-            # parse out the ttl
-            ttl = command[-1].lower()
-            if ttl.startswith('ttl=') and ttl[4:].isdigit():
-                command = [command[0], command[1], ' '.join(command[2:-1]), command[-1]]
-                ttl = int(ttl[4:])
-            else:
-                command = [command[0], command[1], ' '.join(command[2:])]
-                ttl = None
+            batch.append((key, value, None,))
+            args = args[2:]
+    if args:
+        raise ValueError('ERROR: Wrong number of args for MSET. Expected KEY VALUE pairs')
+    for key, value, ttl in batch:
+        _set_key(key, value, ttl=ttl)
+    return 'SUCCESS'
+
+@register_command('lease', 3, 3)
+def _command_lease(key, token, ttl):
+    if not ttl.isdigit():
+        raise ValueError('ERROR: Wrong args for LEASE. Expected LEASE <KEY> <TOKEN> <SECONDS>')
+    return 'SUCCESS' if _lease(key, token, int(ttl)) else 'LOCKED'
+
+@register_command('release', 2, 2)
+def _command_release(key, token):
+    return 'SUCCESS' if _release(key, token) else 'NOT FOUND'
+
+@register_command('del', 1)
+def _command_del(*keys):
+    return str(_delete_keys(keys))
+
+@register_command('tag', 2)
+def _command_tag(key, *tags):
+    return 'SUCCESS' if _tag_key(key, tags) else 'NOT FOUND'
+
+@register_command('deltag', 1)
+def _command_deltag(*tags):
+    return str(_delete_tags(tags))
+
+@register_command('delprefix', 1, 1)
+def _command_delprefix(prefix):
+    return str(_delete_prefix(prefix))
+
+def _counter_args(name, delta, args):
+    """
+    Parses the DELTA [INITIAL] [TTL=<int>] args of INCR and DECR.
+    """
+    initial, ttl = '0', None
+    if args and args[-1][:4].lower() == 'ttl=':
+        ttl = args[-1][4:]
+        if not ttl.isdigit():
+            raise ValueError('ERROR: TTL must be a positive integer')
+        ttl = int(ttl)
+        args = args[:-1]
+    if args:
+        initial = args[0]
+    try:
+        return int(delta), int(initial), ttl
+    except ValueError:
+        raise ValueError('ERROR: {0} DELTA and INITIAL must be integers'.format(name))
 
-            # examine the value and remove encapsulating quotes mess
-            if command[2][0] == '"' and command[2][-1] == '"':
-                command = command = [command[0], command[1], command[2][1:-1]]
+@register_command('incr', 2, 4)
+def _command_incr(key, delta, *args):
+    delta, initial, ttl = _counter_args('INCR', delta, args)
+    return str(_incr(key, delta, initial, ttl))
 
-            _set_key(command[1], command[2], ttl=ttl)
-            return 'SUCCESS'
+@register_command('decr', 2, 4)
+def _command_decr(key, delta, *args):
+    delta, initial, ttl = _counter_args('DECR', delta, args)
+    return str(_incr(key, -delta, initial, ttl))
+
+@register_command('add', value=True)
+def _command_add(key, value, ttl):
+    return 'EXISTS' if _add(key, value, ttl) is None else 'SUCCESS'
+
+@register_command('gets', 1, 1)
+def _command_gets(key):
+    entry = store.get_entry(key)
+    if entry is None:
+        return 'NOT FOUND'
+    return '{0}\r\n{1}'.format(_text(entry.value), entry.version)
+
+@register_command('cas', value=True)
+def _command_cas(key, value, ttl):
+    version, _, value = value.partition(' ')
+    if not version.isdigit() or not value:
+        raise ValueError('ERROR: Wrong args for CAS. Expected CAS <KEY> <VERSION> <VALUE> [TTL=<int>]')
+    result = _cas(key, _unquote(value), int(version), ttl)
+    if result is False:
+        return 'NOT FOUND'
+    return 'EXISTS' if result is None else 'SUCCESS'
+
+def _text(value):
+    """
+    Returns a value as text for a text response. Values stored from binary
+    frames are bytes and are decoded as latin-1, byte for byte.
+    """
+    if isinstance(value, bytes):
+        return value.decode('latin-1')
+    return value
+
+def _ttl_item(ttl):
+    """
+    Parses the ttl item of a binary frame, an empty ttl means the key is perm.
+    """
+    if not ttl:
+        return None
+    if not ttl.isdigit():
+        raise ValueError('ERROR: TTL must be a positive integer')
+    return int(ttl)
+
+def _op_get(items):
+    """
+    Binary GET. Items are [key]. Responds with [value, ttl] or NOT FOUND, ttl
+    is the milliseconds the key has left or empty for a perm key.
+    """
+    if len(items) != 1:
+        raise ValueError('ERROR: Wrong number of args for GET. Received {0}, expected 1'.format(len(items)))
+    entry = store.get_entry(items[0].decode('latin-1'))
+    if entry is None:
+        return protocol.STATUS_NOT_FOUND, []
+    expires = entry.expires
+    ttl = "" if expires is None else str(max(expires - now_ticks(), 0))
+    return protocol.STATUS_OK, [entry.value, ttl]
+
+def _op_set(items):
+    """
+    Binary SET. Items are [key, value, ttl, <tag>, ...], an empty ttl means the
+    key is perm. The value is stored exactly as received and the key is given
+    any tags that follow.
+    """
+    if len(items) < 3:
+        raise ValueError('ERROR: Wrong number of args for SET. Received {0}, expected at least 3'.format(len(items)))
+    key = items[0].decode('latin-1')
+    _set_key(key, items[1], ttl=_ttl_item(items[2]))
+    if len(items) > 3:
+        index.tag(key, [tag.decode('latin-1') for tag in items[3:]])
+    return protocol.STATUS_OK, []
+
+def _op_mget(items):
+    """
+    Binary MGET. Items are [key, key, ...]. Responds with a [found, value] pair
+    per key, found is b'1' or b'0' and the value of a missing key is empty.
+    """
+    response = []
+    for key in items:
+        value = _get_or_timeout(key.decode('latin-1'))
+        if value == 'NOT FOUND':
+            response.append(b'0')
+            response.append(b'')
         else:
-            raise ValueError('ERROR: Wrong number of args for SET. Received {0}, expected 2'.format(len(command)))
-    else:
-        raise ValueError('ERROR: Unkown command. Not GET or SET')
+            response.append(b'1')
+            response.append(value)
+    return protocol.STATUS_OK, response
+
+def _op_mset(items):
+    """
+    Binary MSET. Items are [key, value, ttl] triplets, one per key. Every ttl
+    is checked before any key is set.
+    """
+    if not items or len(items) % 3:
+        raise ValueError('ERROR: Wrong number of args for MSET. Received {0}, expected a multiple of 3'.format(len(items)))
+    ttls = [_ttl_item(ttl) for ttl in items[2::3]]
+    for key, value, ttl in zip(items[0::3], items[1::3], ttls):
+        _set_key(key.decode('latin-1'), value, ttl=ttl)
+    return protocol.STATUS_OK, []
+
+def _op_del(items):
+    """
+    Binary DEL. Items are [key, ...]. Responds with [<keys deleted>].
+    """
+    return protocol.STATUS_OK, [str(_delete_keys([key.decode('latin-1') for key in items]))]
+
+def _op_tag(items):
+    """
+    Binary TAG. Items are [key, tag, ...]. Responds with OK or NOT FOUND.
+    """
+    if len(items) < 2:
+        raise ValueError('ERROR: Wrong number of args for TAG. Received {0}, expected at least 2'.format(len(items)))
+    if not _tag_key(items[0].decode('latin-1'), [tag.decode('latin-1') for tag in items[1:]]):
+        return protocol.STATUS_NOT_FOUND, []
+    return protocol.STATUS_OK, []
+
+def _op_deltag(items):
+    """
+    Binary DELTAG. Items are [tag, ...]. Responds with [<keys deleted>].
+    """
+    return protocol.STATUS_OK, [str(_delete_tags([tag.decode('latin-1') for tag in items]))]
+
+def _op_delprefix(items):
+    """
+    Binary DELPREFIX. Items are [prefix]. Responds with [<keys deleted>].
+    """
+    if len(items) != 1:
+        raise ValueError('ERROR: Wrong number of args for DELPREFIX. Received {0}, expected 1'.format(len(items)))
+    return protocol.STATUS_OK, [str(_delete_prefix(items[0].decode('latin-1')))]
+
+def _op_lease(items):
+    """
+    Binary LEASE. Items are [key, token, ttl]. Responds with [b'1'] if the
+    lease was granted or [b'0'] if another token holds it.
+    """
+    if len(items) != 3:
+        raise ValueError('ERROR: Wrong number of args for LEASE. Received {0}, expected 3'.format(len(items)))
+    key, token, ttl = items
+    ttl = _ttl_item(ttl)
+    if ttl is None:
+        raise ValueError('ERROR: LEASE needs a TTL')
+    granted = _lease(key.decode('latin-1'), token.decode('latin-1'), ttl)
+    return protocol.STATUS_OK, [b'1' if granted else b'0']
+
+def _op_release(items):
+    """
+    Binary RELEASE. Items are [key, token]. Responds with [b'1'] if the token
+    held the lease, otherwise [b'0'].
+    """
+    if len(items) != 2:
+        raise ValueError('ERROR: Wrong number of args for RELEASE. Received {0}, expected 2'.format(len(items)))
+    released = _release(items[0].decode('latin-1'), items[1].decode('latin-1'))
+    return protocol.STATUS_OK, [b'1' if released else b'0']
+
+def _int_item(name, item):
+    """
+    Parses a signed integer item of a binary frame.
+    """
+    try:
+        return int(item)
+    except ValueError:
+        raise ValueError('ERROR: {0} must be an integer'.format(name))
+
+def _op_incr(items):
+    """
+    Binary INCR. Items are [key, delta, initial, ttl], a negative delta
+    decrements and an empty initial is 0. Responds with [value].
+    """
+    if len(items) != 4:
+        raise ValueError('ERROR: Wrong number of args for INCR. Received {0}, expected 4'.format(len(items)))
+    key, delta, initial, ttl = items
+    value = _incr(key.decode('latin-1'), _int_item('DELTA', delta),
+                  _int_item('INITIAL', initial) if initial else 0, _ttl_item(ttl))
+    return protocol.STATUS_OK, [str(value)]
+
+def _op_add(items):
+    """
+    Binary ADD. Items are [key, value, ttl]. Responds with [b'1', version] if
+    the key was set or [b'0'] if it exists.
+    """
+    if len(items) != 3:
+        raise ValueError('ERROR: Wrong number of args for ADD. Received {0}, expected 3'.format(len(items)))
+    key, value, ttl = items
+    version = _add(key.decode('latin-1'), value, _ttl_item(ttl))
+    if version is None:
+        return protocol.STATUS_OK, [b'0']
+    return protocol.STATUS_OK, [b'1', str(version)]
+
+def _op_gets(items):
+    """
+    Binary GETS. Items are [key]. Responds with [value, version] or NOT FOUND.
+    """
+    if len(items) != 1:
+        raise ValueError('ERROR: Wrong number of args for GETS. Received {0}, expected 1'.format(len(items)))
+    entry = store.get_entry(items[0].decode('latin-1'))
+    if entry is None:
+        return protocol.STATUS_NOT_FOUND, []
+    return protocol.STATUS_OK, [entry.value, str(entry.version)]
+
+def _op_cas(items):
+    """
+    Binary CAS. Items are [key, value, ttl, version]. Responds with
+    [b'1', version] if the key was set, [b'0'] if it changed since version
+    or NOT FOUND.
+    """
+    if len(items) != 4:
+        raise ValueError('ERROR: Wrong number of args for CAS. Received {0}, expected 4'.format(len(items)))
+    key, value, ttl, version = items
+    version = _cas(key.decode('latin-1'), value, _int_item('VERSION', version), _ttl_item(ttl))
+    if version is False:
+        return protocol.STATUS_NOT_FOUND, []
+    if version is None:
+        return protocol.STATUS_OK, [b'0']
+    return protocol.STATUS_OK, [b'1', str(version)]
+
+frame_handlers = {
+    protocol.OP_GET: _op_get,
+    protocol.OP_SET: _op_set,
+    protocol.OP_MGET: _op_mget,
+    protocol.OP_MSET: _op_mset,
+    protocol.OP_LEASE: _op_lease,
+    protocol.OP_RELEASE: _op_release,
+    protocol.OP_INCR: _op_incr,
+    protocol.OP_ADD: _op_add,
+    protocol.OP_GETS: _op_gets,
+    protocol.OP_CAS: _op_cas,
+    protocol.OP_DEL: _op_del,
+    protocol.OP_TAG: _op_tag,
+    protocol.OP_DELTAG: _op_deltag,
+    protocol.OP_DELPREFIX: _op_delprefix,
+}
+
+def execute_frame(opcode, items):
+    """
+    Executes a binary frame and returns (status, items) for the response frame.
+
+    :param int opcode: The opcode of the request frame.
+    :param list items: The bytes items carried in the request body.
+    """
+    handler = frame_handlers.get(opcode)
+    if handler is None:
+        raise ValueError('ERROR: Unkown opcode {0}'.format(opcode))
+    return handler(items)
 
 def manage_memory(chunk_size, step_seconds, limit):
     """
-    Manage the size of the cache by first removing the oldest perm keys.
-    If that fails to reduce the cache size then ttl keys that will expire before
+    Manage the size of the cache by first removing the keys chosen by the store's
+    eviction policy, by default the least recently used perm keys. If that fails
+    to reduce the cache size then ttl keys that will expire before
     now + step_seconds will be removed.  Step_seconds is incremented to keep
     removing keys until the limit is respected.
 
-    :param int chunk_size: The number of perm keys to remove.
+    The size compared with limit is the tracked store.bytes so the check is
+    O(1) and costs nothing while the cache is under its limit.
+
+    :param int chunk_size: The number of keys the eviction policy removes at a time.
     :param int step_seconds: The increment steps in seconds for removing ttl keys.
     :param int limit: The cache size limit in bytes.
     """
-    # record the cache size in bytes and the ttl step in seconds
-    old_cache_size = current_cache_size()
-    this_step = step_seconds
-
     # While the cache is over the tolerance limit
-    while current_cache_size() > limit:
+    while store.bytes > limit:
+
+        # Get rid of the keys the policy evicts first, by default the least recently used perm keys
+        if store.evict(chunk_size):
+            continue
+
+        # The policy has nothing left to evict
+        step = seconds_to_ticks(step_seconds)
+        this_step = step
+        # So while the cache is over the tolerance limit and ttl keys remain
+        while store.bytes > limit and store.expiry_index:
+            now = now_ticks()
+            # skip windows in which nothing expires
+            wait = store.next_expiry() - now
+            if wait >= this_step:
+                this_step += ((wait - this_step) // step + 1) * step
+            # start removing ttl keys that will in expire in this_step worth of seconds
+            store.expire_before(now + this_step)
+            # Increment this_step to keep removing more keys until the tolerance is preserved.
+            this_step += step
+        # Nothing is left that can be removed
+        return
 
-        # Get rid of the oldest perm keys
-        _clear_perm_keys(chunk_size)
+def current_rss():
+    """
+    Returns the resident set size of this process in bytes, or None where it
+    cannot be read. Linux only, reads a single line from /proc.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * mmap.PAGESIZE
+    except (IOError, OSError, ValueError, IndexError):
+        return None
 
-        # If the cache size has not changed them all the perm keys have been removed
-        if current_cache_size() == old_cache_size:
-            # So while the cache is over the tolerance limit
-            while current_cache_size() > limit:
-                # start removing ttl keys that will in expire in this_step worth of seconds
-                _clear_ttl_keys(this_step)
-                # Increment this_step to keep removing more keys until the tolerance is preserved.
-                this_step += step_seconds
+def flush_all():
+    """
+    Removes every key, tag and lease from the cache.
+    """
+    store.clear()
+    index.clear()
+    leases.clear()
 
-def init_socket(ip, port):
+def init_socket(ip, port, backlog=1024, reuse_port=False):
     """
-    Factory returns a tcp socet bound to ip and port
+    Factory returns a non blocking tcp socket bound to ip and port
 
     :param str ip: ipaddress for service to run on
     :param int port: port for service to run on.
+    :param int backlog: Number of pending connections the kernel will queue.
+    :param bool reuse_port: Let other sockets listen on the same port, the kernel spreads connections over them.
     """
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     s.bind((ip, port,))
-    s.listen(1)
+    s.listen(backlog)
+    s.setblocking(False)
     return s
 
-current_cache_size = lambda : getsizeof(cache_values) + getsizeof(cache_timeouts)
+current_cache_size = lambda : store.bytes
+
+# the commands a replica serves, everything else is sent to its primary
+read_commands = frozenset(['get', 'mget'])
+
+# commands needing state only one process holds, refused by shared table workers
+unshared_commands = frozenset(['lease', 'release', 'tag', 'deltag', 'delprefix', 'sync'])
+
+class Connection(object):
+    """
+    State held for one client connection by the event loop.
+
+    Bytes read from the socket wait in inbox until a command can be parsed,
+    responses wait in outbox, a list of buffers, until the socket is writable.
+    Counters are kept so per connection throughput can be reported when the
+    client leaves.
+    """
+    __slots__ = ('sock', 'addr', 'inbox', 'outbox', 'opened', 'commands',
+                 'bytes_in', 'bytes_out')
+
+    def __init__(self, sock, addr, buffer_size=1024):
+        self.sock = sock
+        self.addr = addr
+        self.inbox = protocol.ReadBuffer(buffer_size)
+        self.outbox = []
+        self.opened = time.time()
+        self.commands = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def throughput(self):
+        """
+        Returns a dict describing the work done on this connection so far.
+        """
+        elapsed = max(time.time() - self.opened, 1e-6)
+        return {
+            'commands': self.commands,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'seconds': elapsed,
+            'ops_per_sec': self.commands / elapsed,
+        }
+
+class PrimaryLink(object):
+    """
+    A replica's connection to its primary and the stream of records received
+    on it that have not yet been applied.
+    """
+    __slots__ = ('sock', 'inbox', 'connected')
+
+    def __init__(self, sock, buffer_size=1024):
+        self.sock = sock
+        self.inbox = protocol.ReadBuffer(buffer_size)
+        self.connected = time.time()
+
+class LatencyHistogram(object):
+    """
+    Counts command latencies in power of two microsecond buckets. Bucket i
+    holds latencies under 2**i microseconds, the last bucket everything
+    slower. Counts live in a list allocated once so recording is just an
+    index and an increment.
+    """
+    __slots__ = ('counts', 'total', 'seconds')
+
+    BUCKETS = 24 # up to 2**23 microseconds, about 8 seconds
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.total = 0
+        self.seconds = 0.0
+
+    def record(self, seconds):
+        """
+        Count one latency.
+        """
+        bucket = int(seconds * 1000000).bit_length()
+        self.counts[bucket if bucket < self.BUCKETS else self.BUCKETS - 1] += 1
+        self.total += 1
+        self.seconds += seconds
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound in microseconds of the bucket holding the
+        latency at fraction (0-1) of all recorded latencies.
+        """
+        wanted = self.total * fraction
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return 2 ** bucket
+        return 0
+
+class Server(object):
+    """
+    Single threaded, non blocking event loop serving many clients at once.
+
+    A selector watches the listening socket and every client socket. New
+    clients are accepted for the life of the process. Commands are handed to
+    parse_command exactly as before and manage_memory runs before each one.
+    Periodic tasks registered with every() run between socket events.
+
+    Expired keys are removed actively by an expiry cycle every
+    expire_interval seconds, spending at most expire_budget seconds each time.
+    While a cycle runs out of budget with expired keys left it runs again on
+    the next loop, after the clients waiting are served.
+
+    Any server streams its changes to replicas that send it a SYNC frame.
+    Started with primary, a server is a read only replica of that server. It
+    connects, and reconnects whenever the link drops, replacing its keys with
+    a full sync and then applying each change as it is streamed. Replication
+    is asynchronous, a replica is behind its primary by the time records take
+    to arrive, reported as replication_lag_seconds from the primary's pings.
+
+    With shared, the server is one of many worker processes serving a
+    SharedTable from a listening socket given as sock, see serve_workers.
+
+    eviction_policy names the ncache_policy policy choosing the keys evicted
+    once the cache is over its limit, default, lru, lfu or tinylfu.
+    """
+    def __init__(self, ip='127.0.0.1', port=5005, buffer_size=1024, max_memory=1933000000,
+                 memory_tolerance=.95, clear_perm_chunk=1, clear_ttl_step=300,
+                 check_rss=False, rss_interval=1.0, snapshot_path=None, snapshot_interval=None,
+                 log_path=None, log_fsync='everysec', log_compact_size=64 * 1024 * 1024,
+                 expire_interval=0.1, expire_budget=0.001, primary=None, replication_ping=0.1,
+                 replication_backlog=64 * 1024 * 1024, sock=None, shared=False, eviction_policy='default'):
+        # a SharedTable evicts within each bucket, see ncache_shared
+        self.eviction_policy = 'default' if shared else eviction_policy
+        if not shared:
+            store.set_policy(make_policy(eviction_policy))
+        self.buffer_size = buffer_size
+        self.limit = int(max_memory*memory_tolerance)
+        self.tracked_limit = self.limit
+        self.check_rss = check_rss and current_rss() is not None
+        self.rss_interval = rss_interval
+        self.rss_baseline = current_rss() if self.check_rss else 0
+        self.rss_checked = 0
+        self.clear_perm_chunk = clear_perm_chunk
+        self.clear_ttl_step = clear_ttl_step
+        self.sock = init_socket(ip, port) if sock is None else sock
+        self.address = self.sock.getsockname()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+        self.connections = {}
+        self.accepted = 0
+        self.started = time.time()
+        self.latency = dict((name, LatencyHistogram(),) for name in
+                            list(protocol.OPCODE_NAMES.values()) + ['other'])
+        self.running = False
+        # [interval, next run, func] lists
+        self.periodic = []
+        self.expire_interval = expire_interval
+        self.expire_budget = expire_budget
+        self.expire_task = self.every(expire_interval, self._expire_cycle) if expire_interval else None
+        self.snapshotter = None
+        self.write_log = None
+        if log_path:
+            # the write log holds every change since it was last compacted so
+            # it is replayed instead of loading a possibly older snapshot
+            self.write_log = WriteLog(log_path, log_fsync, log_compact_size)
+            self.write_log.open()
+            replay = self.write_log.replay(store)
+            store.watchers.append(self.write_log)
+            self.replay_started = time.time()
+            self.replayed = 0
+            self.replay_task = self.every(0, lambda: self._replay_step(replay))
+            self.every(1.0, lambda: self.write_log.tick(store))
+        elif snapshot_path:
+            started = time.time()
+            loaded = load_snapshot(store, snapshot_path)
+            logger.info("Loaded %s keys from %s in %.3f seconds", loaded, snapshot_path, time.time() - started)
+        if snapshot_path:
+            self.snapshotter = Snapshotter(store, snapshot_path)
+            self.every(0.1, self.snapshotter.poll)
+            if snapshot_interval:
+                self.every(snapshot_interval, self.snapshotter.save)
+        self.feed = ReplicationFeed()
+        store.watchers.append(self.feed)
+        self.replication_backlog = replication_backlog
+        self.every(replication_ping, self._ping_replicas)
+        self.primary = tuple(primary) if primary else None
+        self.shared = shared
+        self.refused = unshared_commands if shared else frozenset()
+        self.link = None
+        self.replicated_bytes = 0
+        self.last_ping = None
+        if self.primary:
+            self._connect_primary()
+            self.every(1.0, self._connect_primary)
+
+    def every(self, interval, func):
+        """
+        Call func every interval seconds from the event loop.
+
+        :param float interval: Seconds between calls.
+        :param func: Called with no arguments.
+        :returns list: The task, to pass to cancel.
+        """
+        task = [interval, time.time() + interval, func]
+        self.periodic.append(task)
+        return task
+
+    def cancel(self, task):
+        """
+        Stop a periodic task started with every.
+        """
+        if task in self.periodic:
+            self.periodic.remove(task)
+
+    def _expire_cycle(self):
+        """
+        Remove expired keys within the expiry budget. A backlog brings the
+        next cycle forward to the next loop, once it is cleared the cycle
+        returns to expire_interval.
+        """
+        if self.write_log is not None and self.write_log.replaying:
+            # a key deleted now would be marked touched and lose its later records
+            return
+        _, backlog = store.expire_due(self.expire_budget)
+        task = self.expire_task
+        task[0] = 0 if backlog else self.expire_interval
+        task[1] = time.time() + task[0]
+
+    def _replay_step(self, replay):
+        """
+        Replay the next batch of the write log, between socket events.
+        """
+        try:
+            self.replayed = next(replay)
+        except StopIteration:
+            self.cancel(self.replay_task)
+            logger.info("Replayed %s write log records in %.3f seconds",
+                        self.replayed, time.time() - self.replay_started)
+
+    def _ping_replicas(self):
+        """
+        Stream a ping to every replica and drop those too far behind to catch
+        up, they reconnect and sync again.
+        """
+        self.feed.ping()
+        for conn, backlog in self.feed.backlogs():
+            if backlog > self.replication_backlog:
+                logger.warning("Replica %s is %s bytes behind, disconnecting it", conn.addr, backlog)
+                self._close(conn)
+        self._flush_replicas()
+
+    def _flush_replicas(self):
+        """
+        Start sending the records queued for replicas.
+        """
+        for conn in list(self.feed.replicas):
+            if conn.outbox:
+                self._write(conn)
+
+    def _add_replica(self, conn):
+        """
+        Start streaming to a client that sent SYNC.
+        """
+        started = time.time()
+        count = self.feed.add(conn, store)
+        # a ping straight after the sync lets the replica report its lag at once
+        self.feed.ping()
+        logger.info("Replica %s synced %s keys in %.3f seconds", conn.addr, count, time.time() - started)
+
+    def _connect_primary(self):
+        """
+        Connect to the primary, unless connected, and ask it for a full sync.
+        Every key is dropped first, the sync brings back each one still live.
+        """
+        if self.link is not None:
+            return
+        try:
+            sock = socket.create_connection(self.primary, timeout=1.0)
+            sock.sendall(protocol.pack_frame(protocol.MAGIC_REQUEST, protocol.OP_SYNC))
+        except (ConnectionError, OSError) as e:
+            logger.warning("Cannot reach primary %s: %s", self.primary, e)
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        flush_all()
+        self.link = PrimaryLink(sock, self.buffer_size)
+        self.selector.register(sock, selectors.EVENT_READ, self.link)
+        logger.info("Replicating %s", self.primary)
+
+    def _read_primary(self):
+        """
+        Apply every complete record the primary has streamed.
+        """
+        link = self.link
+        inbox = link.inbox
+        try:
+            received = inbox.recv_into(link.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (ConnectionError, OSError):
+            received = 0
+        if not received:
+            logger.warning("Lost primary %s", self.primary)
+            self._close_primary()
+            return
+        self.replicated_bytes += received
+        offset = inbox.start
+        now = time.time()
+        while True:
+            record = read_record(inbox.buf, offset, inbox.end)
+            if record is None:
+                break
+            kind, key, value, expiry, offset = record
+            if kind == KIND_PING:
+                self.last_ping = expiry
+            else:
+                apply_record(store, kind, key, value, expiry, now)
+        inbox.consume(offset)
+        manage_memory(self.clear_perm_chunk, self.clear_ttl_step, self.memory_limit())
+        self._flush_replicas()
+
+    def _close_primary(self):
+        """
+        Close the link to the primary, it is reopened by _connect_primary.
+        """
+        link, self.link = self.link, None
+        if link is not None:
+            self.selector.unregister(link.sock)
+            link.sock.close()
+
+    def _run_periodic(self, poll_interval):
+        """
+        Run the periodic tasks that are due and return the seconds until the
+        next one, at most poll_interval.
+        """
+        now = time.time()
+        wait = poll_interval
+        for task in list(self.periodic):
+            if now >= task[1]:
+                task[1] = now + task[0]
+                try:
+                    task[2]()
+                except Exception as e:
+                    logger.exception(e)
+            wait = min(wait, task[1] - now)
+        return max(wait, 0)
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Run the event loop until stop() is called.
+
+        :param float poll_interval: Seconds to wait for socket events before looping.
+        """
+        self.running = True
+        try:
+            while self.running:
+                timeout = self._run_periodic(poll_interval)
+                for key, events in self.selector.select(timeout):
+                    if key.data is None:
+                        self._accept()
+                    elif key.data is self.link:
+                        self._read_primary()
+                    else:
+                        conn = key.data
+                        if events & selectors.EVENT_READ:
+                            self._read(conn)
+                        if events & selectors.EVENT_WRITE and conn.sock.fileno() != -1:
+                            self._write(conn)
+        finally:
+            self.close()
+
+    def stop(self):
+        """
+        Ask the event loop to exit after the current iteration.
+        """
+        self.running = False
+
+    def close(self):
+        """
+        Close every client connection and the listening socket.
+        """
+        for conn in list(self.connections.values()):
+            self._close(conn)
+        self._close_primary()
+        store.watchers.remove(self.feed)
+        self.selector.close()
+        self.sock.close()
+        if self.snapshotter is not None:
+            self.snapshotter.poll(block=True)
+        if self.write_log is not None:
+            store.watchers.remove(self.write_log)
+            self.write_log.close()
+
+    def stats(self):
+        """
+        Returns a list of (name, value) counters describing the server.
+
+        latency_<command>_buckets lists the count of each LatencyHistogram
+        bucket, bucket i counting commands that took under 2**i microseconds.
+        """
+        stats = [
+            ('pid', os.getpid()),
+            ('uptime', int(time.time() - self.started)),
+            ('keys', len(store)),
+            ('bytes', store.bytes),
+            ('limit_bytes', self.tracked_limit),
+            ('hits', store.hits),
+            ('misses', store.misses),
+            ('expired', store.expired),
+            ('lru_evictions', store.lru_evictions),
+            ('ttl_evictions', store.ttl_evictions),
+            ('eviction_seconds', round(store.eviction_seconds, 6)),
+            ('eviction_policy', self.eviction_policy),
+            ('connections', len(self.connections)),
+            ('total_connections', self.accepted),
+            ('replicas', len(self.feed.replicas)),
+            ('replication_backlog_bytes', max([backlog for _, backlog in self.feed.backlogs()] or [0])),
+        ]
+        if self.shared:
+            stats.append(('capacity', store.capacity))
+        else:
+            stats.append(('policy_evictions', store.policy_evictions))
+        if self.primary:
+            stats.extend([
+                ('replication_connected', int(self.link is not None)),
+                ('replication_bytes', self.replicated_bytes),
+                # -1 until the first ping arrives
+                ('replication_lag_seconds', -1 if self.last_ping is None else round(time.time() - self.last_ping, 3)),
+            ])
+        for name, latency in sorted(self.latency.items()):
+            if not latency.total:
+                continue
+            prefix = 'latency_' + name
+            stats.extend([
+                (prefix + '_count', latency.total),
+                (prefix + '_mean_us', round(latency.seconds * 1000000 / latency.total, 2)),
+                (prefix + '_p50_us', latency.percentile(.50)),
+                (prefix + '_p99_us', latency.percentile(.99)),
+                (prefix + '_p999_us', latency.percentile(.999)),
+                (prefix + '_buckets', ','.join(str(count) for count in latency.counts)),
+            ])
+        return stats
+
+    def snapshot(self):
+        """
+        Start writing a snapshot in the background.
+        """
+        if self.snapshotter is None:
+            raise ValueError('ERROR: Snapshots are not configured, start the server with a snapshot_path')
+        return 'SUCCESS' if self.snapshotter.save() else 'IN PROGRESS'
+
+    def _accept(self):
+        """
+        Accept every pending connection on the listening socket.
+        """
+        while True:
+            try:
+                sock, addr = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            logger.info("Connection Address: %s", addr)
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(sock, addr, self.buffer_size)
+            self.connections[sock.fileno()] = conn
+            self.accepted += 1
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def _read(self, conn):
+        """
+        Read from a readable client and execute what it sent.
+        """
+        try:
+            received = conn.inbox.recv_into(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (ConnectionError, OSError):
+            received = 0
+        if not received:
+            self._close(conn)
+            return
+        conn.bytes_in += received
+        self._process(conn)
+        if self.write_log is not None:
+            # under the always policy changes are on disk before we respond
+            self.write_log.commit()
+        self._write(conn)
+        if self.feed.replicas:
+            self._flush_replicas()
+
+    def _process(self, conn):
+        """
+        Execute every complete command waiting in the connection inbox, binary
+        frames and newline terminated text alike, queueing responses in order.
+        Partial commands stay in the inbox until the rest arrives.
+        """
+        inbox = conn.inbox
+        buf = inbox.buf
+        consumed = inbox.start
+        received = inbox.end
+        outbox = conn.outbox
+        while consumed < received:
+            if buf[consumed] == protocol.MAGIC_REQUEST:
+                try:
+                    frame = protocol.read_frame(buf, consumed, received)
+                except ValueError as e:
+                    # framing is lost, nothing more can be read from this client
+                    logger.exception(e)
+                    outbox.extend(protocol.frame_parts(protocol.MAGIC_RESPONSE,
+                                                       protocol.STATUS_ERROR, [str(e)]))
+                    consumed = received
+                    break
+                if frame is None:
+                    break
+                _, opcode, items, consumed = frame
+                if opcode == protocol.OP_SYNC and not self.refused:
+                    # the rest of this connection is the replication stream
+                    self._add_replica(conn)
+                    consumed = received
+                    break
+                started = perf_counter()
+                status, items = self.execute_frame(opcode, items)
+                latency = self.latency.get(protocol.OPCODE_NAMES.get(opcode), self.latency['other'])
+                latency.record(perf_counter() - started)
+                outbox.extend(protocol.frame_parts(protocol.MAGIC_RESPONSE, status, items))
+            else:
+                end = buf.find(protocol.TEXT_TERMINATOR, consumed, received)
+                if end == -1:
+                    break
+                line = buf[consumed:end].rstrip(b'\r').decode('latin-1')
+                consumed = end + 1
+                started = perf_counter()
+                response = self.execute(line)
+                latency = self.latency.get(line.lstrip(' ').partition(' ')[0].lower(), self.latency['other'])
+                latency.record(perf_counter() - started)
+                outbox.append(protocol.to_bytes(response) + protocol.TEXT_RESPONSE_TERMINATOR)
+            conn.commands += 1
+        inbox.consume(consumed)
+
+    def execute(self, data):
+        """
+        Manage memory then parse a single text command, returning the response.
+
+        :param str data: The command text.
+        """
+        try: # execute
+            ### Commands about the server rather than the cache
+            command = data.strip(' ').lower()
+            if command == 'snapshot':
+                return self.snapshot()
+            if command == 'stats':
+                return '\r\n'.join('{0} {1}'.format(name, value) for name, value in self.stats())
+            if self.primary or self.refused:
+                self._check_command(command.partition(' ')[0])
+
+            ### Manage memory before we add more keys
+            manage_memory(self.clear_perm_chunk, self.clear_ttl_step, self.memory_limit())
+
+            ### Parse the command and return the response.
+            return parse_command(data)
+
+        except ValueError as e:
+            ### If a parse error occured
+            logger.exception(e)
+            return str(e)
+
+    def execute_frame(self, opcode, items):
+        """
+        Manage memory then execute a single binary frame, returning (status, items).
+
+        :param int opcode: The opcode of the request frame.
+        :param list items: The items carried in the request body.
+        """
+        try:
+            if opcode == protocol.OP_SNAPSHOT:
+                return protocol.STATUS_OK, [self.snapshot()]
+            if opcode == protocol.OP_STATS:
+                items = []
+                for name, value in self.stats():
+                    items.append(name)
+                    items.append(str(value))
+                return protocol.STATUS_OK, items
+            if self.primary or self.refused:
+                # tags given with a SET are refused like TAG
+                self._check_command('tag' if opcode == protocol.OP_SET and len(items) > 3
+                                    else protocol.OPCODE_NAMES.get(opcode))
+            manage_memory(self.clear_perm_chunk, self.clear_ttl_step, self.memory_limit())
+            return execute_frame(opcode, items)
+        except ValueError as e:
+            logger.exception(e)
+            return protocol.STATUS_ERROR, [str(e)]
+
+    def _check_command(self, name):
+        """
+        Replicas only serve read_commands, changes must be made on the primary.
+        Shared table workers refuse unshared_commands.
+        """
+        if self.primary and name not in read_commands:
+            raise ValueError('ERROR: Replicas are read only. Send {0} to the primary {1}:{2}'.format(
+                (name or 'writes').upper(), *self.primary))
+        if name in self.refused:
+            raise ValueError('ERROR: {0} is not supported by multi process servers'.format(name.upper()))
+
+    def memory_limit(self):
+        """
+        Returns the limit for tracked cache bytes.
+
+        With check_rss the process RSS is sampled at most once per rss_interval.
+        The ratio of RSS growth since startup to tracked bytes measures the
+        allocator overhead the tracking cannot see, and the tracked limit is
+        scaled down by it so RSS stays within the configured limit.
+        """
+        if self.check_rss:
+            now = time.time()
+            if now - self.rss_checked >= self.rss_interval:
+                self.rss_checked = now
+                rss = current_rss()
+                if rss is not None and store.bytes:
+                    ratio = max(1.0, float(rss - self.rss_baseline) / store.bytes)
+                    self.tracked_limit = int(self.limit / ratio)
+        return self.tracked_limit
+
+    def _write(self, conn):
+        """
+        Send as much of the outbox as the socket will take. The buffers are
+        handed to sendmsg as they are so values are never copied into one
+        response. Interest in write events is only registered while there is
+        something left to send.
+        """
+        while conn.outbox:
+            batch = conn.outbox[:protocol.IOV_MAX]
+            try:
+                sent = conn.sock.sendmsg(batch)
+            except (BlockingIOError, InterruptedError):
+                break
+            except (ConnectionError, OSError):
+                self._close(conn)
+                return
+            left = protocol.advance(conn.outbox, sent)
+            conn.bytes_out += sent
+            # the socket took less than offered so it is full
+            full = len(left) > len(conn.outbox) - len(batch)
+            conn.outbox = left
+            if full:
+                break
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if conn.outbox else selectors.EVENT_READ
+        self.selector.modify(conn.sock, events, conn)
+
+    def _close(self, conn):
+        """
+        Unregister and close a client connection, logging its throughput.
+        """
+        if self.connections.pop(conn.sock.fileno(), None) is None:
+            return
+        self.feed.remove(conn)
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+        logger.info("Connection Closed: %s %s", conn.addr, conn.throughput())
 
 def run_ncache(ip='127.0.0.1', port=5005, buffer_size=1024, max_memory=1933000000,
-               memory_tolerance=.95, clear_perm_chunk=1, clear_ttl_step=300):
+               memory_tolerance=.95, clear_perm_chunk=1, clear_ttl_step=300,
+               check_rss=False, rss_interval=1.0, snapshot_path=None, snapshot_interval=None,
+               log_path=None, log_fsync='everysec', log_compact_size=64 * 1024 * 1024,
+               expire_interval=0.1, expire_budget=0.001, primary=None, replication_ping=0.1,
+               replication_backlog=64 * 1024 * 1024, workers=1, max_key_size=250, max_value_size=4096,
+               eviction_policy='default'):
     """
     Creates and binds to a tcp socket to listen for cache commands.  Calculates
-    memory limits.  Listens for and parses new commands.  Returns responses.
+    memory limits.  Serves any number of concurrent clients, parsing their
+    commands and returning responses, until the process is stopped.
 
     :param str ip: The ip address to bind tcp socket to.
     :param int port: The port to bind tcp socket to.
     :param int buffer_size: Read this number of bytes from the tcp buffer. Smaller can be faster.
     :param int max_memory: The memory limit in bytes.
     :param float memory_tolerance: Precentage of max_memory that will be our limit, we may go over briefly.
-    :param int clear_perm_chunk: The number of perm keys to remove.
+    :param int clear_perm_chunk: The number of keys the eviction policy removes at a time.
     :param int clear_ttl_step: The increment steps in seconds for removing ttl keys.
+    :param bool check_rss: Correct the tracked memory limit against process RSS. Linux only.
+    :param float rss_interval: Seconds between RSS samples when check_rss is set.
+    :param str snapshot_path: File to load the cache from at startup and save SNAPSHOTs to.
+    :param float snapshot_interval: Seconds between automatic snapshots. Optional.
+    :param str log_path: Append every change to this write log and replay it at startup. Optional.
+    :param str log_fsync: When the write log is fsynced, always, everysec or never.
+    :param int log_compact_size: Rewrite the write log from the cache once it grows past this size.
+    :param float expire_interval: Seconds between active expiry cycles, 0 leaves expired keys to be found lazily.
+    :param float expire_budget: The most seconds one expiry cycle spends removing keys.
+    :param tuple primary: (ip, port) of the server to replicate. The server is then a read only replica.
+    :param float replication_ping: Seconds between the pings replicas measure their lag by.
+    :param int replication_backlog: Bytes queued for a replica after which it is disconnected to sync again.
+    :param int workers: Worker processes serving one SharedTable, see serve_workers. 1 serves a Store from this process.
+    :param int max_key_size: The longest key in bytes when workers is more than 1.
+    :param int max_value_size: The largest value in bytes when workers is more than 1.
+    :param str eviction_policy: The keys evicted over the memory limit, default, lru, lfu or tinylfu. See ncache_policy.
     """
-    s = init_socket(ip, port)
-    conn, addr = s.accept()
+    if workers > 1:
+        if snapshot_path or log_path or primary or check_rss:
+            raise ValueError('ERROR: snapshot_path, log_path, primary and check_rss need a single process, workers=1')
+        if eviction_policy != 'default':
+            raise ValueError('ERROR: eviction_policy needs a single process, workers=1')
+        serve_workers(workers, ip, port, int(max_memory * memory_tolerance), max_key_size, max_value_size,
+                      buffer_size=buffer_size, max_memory=max_memory, memory_tolerance=memory_tolerance,
+                      clear_perm_chunk=clear_perm_chunk, clear_ttl_step=clear_ttl_step,
+                      expire_interval=expire_interval, expire_budget=expire_budget)
+        return
+    server = Server(ip, port, buffer_size, max_memory, memory_tolerance,
+                    clear_perm_chunk, clear_ttl_step, check_rss, rss_interval,
+                    snapshot_path, snapshot_interval, log_path, log_fsync, log_compact_size,
+                    expire_interval, expire_budget, primary, replication_ping, replication_backlog,
+                    eviction_policy=eviction_policy)
+    server.serve_forever()
 
-    logger.info("Connection Address: %s", addr)
+def _serve_worker(table, sock, server_kw):
+    """
+    Runs in a forked worker, serving table on sock until SIGTERM.
+    """
+    global store
+    store = table
+    server = Server(sock=sock, shared=True, **server_kw)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    server.serve_forever()
 
-    limit = int(max_memory*memory_tolerance)
+def serve_workers(workers, ip, port, limit, max_key_size=250, max_value_size=4096, **server_kw):
+    """
+    Serves one cache from many processes so commands run on every core.
 
-    while True:
-        data = conn.recv(buffer_size)
-        if not data:
-            break
-        try: # execute
-            ### Manage memory before we add more keys
-            manage_memory(clear_perm_chunk, clear_ttl_step, limit)
+    The keys live in a SharedTable sized to hold limit bytes of slots, made
+    before the workers fork. Each worker listens on the port with its own
+    SO_REUSEPORT socket and the kernel spreads connections over them. The
+    slots reserve memory for their largest key and value so the table never
+    exceeds limit, a full bucket evicts a key to make room, see SharedTable.
 
-            ### Parse the command and return the response.
-            response = parse_command(data)
-            conn.send(response)
+    Leases, tags and prefix deletes need state held by one process and are
+    refused, as are snapshots, the write log and replication. Stats counters
+    other than keys and bytes are those of the worker answering.
 
-        except ValueError as e:
-            ### If a parse error occured
-            logger.exception(e)
-            conn.send(str(e))
-    conn.close()
+    :param int workers: The number of worker processes.
+    :param str ip: The ip address to listen on.
+    :param int port: The port to listen on.
+    :param int limit: Bytes of shared memory for the table.
+    :param int max_key_size: The longest key in bytes.
+    :param int max_value_size: The largest value in bytes.
+    :param server_kw: Passed to the Server of every worker.
+    """
+    slot_size = SharedTable.slot_bytes(max_key_size, max_value_size)
+    table = SharedTable(max(limit // slot_size, 1), max_key=max_key_size, max_value=max_value_size)
+    sock = init_socket(ip, port, reuse_port=True)
+    ip, port = sock.getsockname()
+    logger.info("Serving %s slots of %s bytes from %s workers on %s:%s", table.capacity, slot_size, workers, ip, port)
+    # fork, not spawn, so the workers inherit the table and its locks
+    context = multiprocessing.get_context('fork')
+    processes = []
+    previous = signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for i in range(workers):
+            worker_sock = sock if i == 0 else init_socket(ip, port, reuse_port=True)
+            process = context.Process(target=_serve_worker, args=(table, worker_sock, server_kw))
+            process.start()
+            processes.append(process)
+            worker_sock.close()
+        for process in processes:
+            process.join()
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        table.close()
+        table.unlink()
@@ -0,0 +1,389 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+asyncio client for ncache.
+
+Requests from any number of coroutines are written straight onto a few
+pooled stream connections without waiting for earlier responses. The server
+answers frames in order, so each connection keeps a queue of futures and a
+reader task resolves them as responses arrive.
+"""
+
+__author__ = "Niall O'Connor zechs dot marquie at gmail dot com"
+__version__ = '1.0'
+
+import asyncio
+from   collections import deque
+from   functools import wraps
+import itertools
+import logging
+import re
+import warnings
+
+from   ncache_client import func2key
+import ncache_protocol as protocol
+from   ncache_serializers import Codec
+
+logger = logging.getLogger(__name__)
+
+class AsyncConnection(object):
+    """
+    One stream connection to an ncache server with requests in flight.
+    """
+    def __init__(self, reader, writer, buffer_size=65536):
+        super(AsyncConnection, self).__init__()
+        self.reader = reader
+        self.writer = writer
+        self.buffer_size = buffer_size
+        self.pending = deque()
+        self.closed = False
+        self.task = asyncio.ensure_future(self._read_responses())
+
+    @classmethod
+    async def open(cls, ip, port, buffer_size=65536, connect_timeout=None):
+        """
+        Connect to a server and start reading its responses.
+        """
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), connect_timeout)
+        return cls(reader, writer, buffer_size)
+
+    def request(self, frame):
+        """
+        Write a frame, a list of buffers, and return a future for its response. Writing and
+        queueing the future happen together so responses line up with
+        requests however many coroutines share the connection.
+        """
+        if self.closed:
+            raise ConnectionError('ncache connection is closed')
+        future = asyncio.get_running_loop().create_future()
+        self.writer.writelines(frame)
+        self.pending.append(future)
+        return future
+
+    async def _read_responses(self):
+        """
+        Resolve pending futures in order as response frames arrive.
+        """
+        inbox = bytearray()
+        error = ConnectionError('ncache server closed the connection')
+        try:
+            while True:
+                data = await self.reader.read(self.buffer_size)
+                if not data:
+                    break
+                inbox += data
+                offset = 0
+                while True:
+                    frame = protocol.read_frame(inbox, offset)
+                    if frame is None:
+                        break
+                    _, status, items, offset = frame
+                    future = self.pending.popleft()
+                    if future.cancelled():
+                        continue
+                    if status == protocol.STATUS_ERROR:
+                        future.set_exception(ValueError(items[0].decode('latin-1')))
+                    else:
+                        future.set_result((status, items,))
+                del inbox[:offset]
+        except asyncio.CancelledError:
+            error = ConnectionError('ncache connection is closed')
+        except Exception as e:
+            logger.exception(e)
+            error = ConnectionError(str(e))
+        finally:
+            self.closed = True
+            while self.pending:
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_exception(error)
+            self.writer.close()
+
+    async def drain(self):
+        """
+        Wait while the socket's write buffer is too full.
+        """
+        await self.writer.drain()
+
+    def close(self):
+        """
+        Close the connection, failing any requests still in flight.
+        """
+        self.task.cancel()
+
+class AsyncCachable(object):
+    """
+    Provides the cachable decorator for coroutine functions to any async
+    client with awaitable get and set methods.
+    """
+    def __init__(self):
+        super(AsyncCachable, self).__init__()
+        # key -> future of the computations running on this event loop
+        self._flights = {}
+
+    def cachable(self, key_name=None, seconds=None, tags=None):
+        """
+        Decorate an expensive coroutine function to save on computing. See
+        ncache_client.Cachable.cachable. Coroutines missing the same key while
+        it is computed await the one computation.
+
+        :param str key_name: The specific name for this key. If omitted this key will be made of the calling function name and a list of its args.
+        :param int seconds: The expiry time of this key
+        :param tags: Tags the key is stored with, a list or a function of the decorated function's args returning one.
+
+        Usage:
+            >>> cache = AsyncNCache()
+            >>> @cache.cachable()
+                async def addit(a, b):
+                    return a+b
+        """
+        def collect(f):
+            @wraps(f)
+            async def do_caching(*args, **kw):
+                key = func2key(f, *args, **kw) if key_name is None else key_name
+                value = await self.get(key)
+                if value:
+                    return value
+                # nothing exists so we must await the decorated function, once
+                flight = self._flights.get(key)
+                if flight is not None:
+                    return await asyncio.shield(flight)
+                flight = self._flights[key] = asyncio.get_running_loop().create_future()
+                try:
+                    value = await f(*args, **kw)
+                    if value is None:
+                        warnings.warn("""
+
+                            Decorated function must exit using the return keyword and must NOT return None.
+
+                            Instead return something similar but meaningful in the context of your function eg:
+                            [], {}, 0, False, str("None"), str("No records") etc.""")
+                        raise TypeError('NoneType is not cachable. If required None can be cached using AsyncNCache.set()')
+                    await self.set(key, value, seconds=seconds, tags=tags(*args, **kw) if callable(tags) else tags)
+                    flight.set_result(value)
+                    return value
+                except Exception as e:
+                    flight.set_exception(e)
+                    flight.exception() # retrieved here so a flight nobody awaited is not logged
+                    raise
+                except BaseException:
+                    flight.cancel()
+                    raise
+                finally:
+                    del self._flights[key]
+            return do_caching
+        return collect
+
+class AsyncNCache(AsyncCachable):
+    """
+    asyncio version of ncache_client.NCache.
+
+    usage:
+        >>> cache = AsyncNCache()
+        >>> await cache.set('Something', 'Not nothing')
+        >>> await cache.get('Something')
+        Not nothing
+    """
+    def __init__(self, ip='127.0.0.1', port=5005, buffer=65536, key_rexp=r"[\w\d:-]{2,}", pickled=True,
+                 pool_size=4, connect_timeout=None, read_timeout=None, serializer=None, compress_threshold=None,
+                 compress_level=1):
+        """
+        :param str ip: Ip address of tcp server.
+        :param str port: Port number of tcp server.
+        :param int buffer: Number of bytes to read from a stream at a time.
+        :param str key_regx: Key names must match this regex.
+        :param bool pickled: Pickle data when recording them, otherwise store str as text. Ignored if serializer is given.
+        :param int pool_size: Number of connections requests are spread over.
+        :param float connect_timeout: Seconds to wait for a connection, None waits forever.
+        :param float read_timeout: Seconds to wait for a response, None waits forever.
+        :param serializer: A ncache_serializers.Serializer or one of pickle, marshal, raw or text.
+        :param int compress_threshold: Values this many bytes or larger are compressed, None never compresses.
+        :param int compress_level: zlib level of compressed values.
+        """
+        super(AsyncNCache, self).__init__()
+        self.ip = ip
+        self.port = port
+        self.buffer_size = buffer
+        if serializer is None:
+            serializer = 'pickle' if pickled else 'text'
+        self.codec = Codec(serializer, compress_threshold, compress_level)
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.connections = [None] * pool_size
+        self.next_connection = itertools.cycle(range(pool_size))
+        self.connecting = {}
+        self.__rexp = re.compile(key_rexp)
+        self.__key_rexp = key_rexp
+
+    def __validate_key(self, key):
+        """
+        Ensures a key name passes the regex check. See NCache.
+        """
+        is_match = self.__rexp.match(key)
+        if not is_match or is_match.group() != key:
+            raise KeyError('"%s" is an invalid key as it does not match with the following regular expression, %s'%(key, self.__key_rexp))
+        return key
+
+    async def _connection(self):
+        """
+        Returns the next connection round robin, opening it if it is closed.
+        Coroutines arriving while a connection opens wait for the same one.
+        """
+        index = next(self.next_connection)
+        conn = self.connections[index]
+        if conn is not None and not conn.closed:
+            return conn
+        opening = self.connecting.get(index)
+        if opening is None:
+            opening = self.connecting[index] = asyncio.ensure_future(
+                AsyncConnection.open(self.ip, self.port, self.buffer_size, self.connect_timeout))
+            try:
+                conn = self.connections[index] = await opening
+            finally:
+                del self.connecting[index]
+            return conn
+        return await asyncio.shield(opening)
+
+    async def _execute(self, opcode, *items):
+        """
+        Send one binary request frame and await its (status, items) response.
+        """
+        frame = protocol.frame_parts(protocol.MAGIC_REQUEST, opcode, items)
+        conn = await self._connection()
+        future = conn.request(frame)
+        await conn.drain()
+        return await asyncio.wait_for(future, self.read_timeout)
+
+    async def set(self, key, value, seconds=None, tags=None):
+        """
+        Set a key in the cache.
+
+        :param str key: The specific name for this key.
+        :param object value: The object to be cached.
+        :param int seconds: The expiry time of this key.
+        :param list tags: Tags to delete the key by with delete_tag.
+        """
+        ttl = "" if seconds is None else str(int(seconds))
+        await self._execute(protocol.OP_SET, self.__validate_key(key), self.codec.encode(value), ttl, *(tags or ()))
+        return 'SUCCESS'
+
+    async def get(self, key):
+        """
+        Get a key from the cache, None if it is not found.
+
+        :param str key: The specific name for this key.
+        """
+        status, items = await self._execute(protocol.OP_GET, self.__validate_key(key))
+        if status == protocol.STATUS_NOT_FOUND:
+            return None
+        return self.codec.decode(items[0])
+
+    async def incr(self, key, delta=1, initial=0, seconds=None):
+        """
+        Add to a counter on the server in one atomic round trip. See NCache.incr.
+        """
+        ttl = "" if seconds is None else str(int(seconds))
+        _, items = await self._execute(protocol.OP_INCR, self.__validate_key(key), str(int(delta)), str(int(initial)), ttl)
+        return int(items[0])
+
+    async def decr(self, key, delta=1, initial=0, seconds=None):
+        """
+        Subtract from a counter on the server. See NCache.decr.
+        """
+        return await self.incr(key, -delta, initial, seconds)
+
+    async def add(self, key, value, seconds=None):
+        """
+        Set a key only if it is missing. See NCache.add.
+        """
+        ttl = "" if seconds is None else str(int(seconds))
+        _, items = await self._execute(protocol.OP_ADD, self.__validate_key(key), self.codec.encode(value), ttl)
+        return items[0] == b'1'
+
+    async def gets(self, key):
+        """
+        Get a key and its version for cas. See NCache.gets.
+        """
+        status, items = await self._execute(protocol.OP_GETS, self.__validate_key(key))
+        if status == protocol.STATUS_NOT_FOUND:
+            return None, None
+        return self.codec.decode(items[0]), int(items[1])
+
+    async def cas(self, key, value, version, seconds=None):
+        """
+        Set a key only if it is still at version. See NCache.cas.
+        """
+        ttl = "" if seconds is None else str(int(seconds))
+        status, items = await self._execute(protocol.OP_CAS, self.__validate_key(key), self.codec.encode(value),
+                                            ttl, str(version))
+        return status == protocol.STATUS_OK and items[0] == b'1'
+
+    async def delete(self, *keys):
+        """
+        Delete keys. See NCache.delete.
+        """
+        keys = [self.__validate_key(key) for key in keys]
+        if not keys:
+            return 0
+        _, items = await self._execute(protocol.OP_DEL, *keys)
+        return int(items[0])
+
+    async def tag(self, key, *tags):
+        """
+        Tag a key already in the cache. See NCache.tag.
+        """
+        status, _ = await self._execute(protocol.OP_TAG, self.__validate_key(key), *tags)
+        return status == protocol.STATUS_OK
+
+    async def delete_tag(self, *tags):
+        """
+        Delete every key tagged with any of tags. See NCache.delete_tag.
+        """
+        if not tags:
+            return 0
+        _, items = await self._execute(protocol.OP_DELTAG, *tags)
+        return int(items[0])
+
+    async def delete_prefix(self, prefix):
+        """
+        Delete every key starting with prefix. See NCache.delete_prefix.
+        """
+        _, items = await self._execute(protocol.OP_DELPREFIX, prefix)
+        return int(items[0])
+
+    async def set_many(self, mapping, seconds=None):
+        """
+        Set many keys in one round trip. See NCache.set_many.
+        """
+        per_key = isinstance(seconds, dict)
+        items = []
+        for key, value in mapping.items():
+            items.append(self.__validate_key(key))
+            items.append(self.codec.encode(value))
+            ttl = seconds.get(key) if per_key else seconds
+            items.append("" if ttl is None else str(int(ttl)))
+        if items:
+            await self._execute(protocol.OP_MSET, *items)
+        return 'SUCCESS'
+
+    async def get_many(self, keys):
+        """
+        Get many keys in one round trip. See NCache.get_many.
+        """
+        keys = [self.__validate_key(key) for key in keys]
+        if not keys:
+            return {}
+        _, items = await self._execute(protocol.OP_MGET, *keys)
+        return dict((key, self.codec.decode(value),) for key, found, value in zip(keys, items[0::2], items[1::2])
+                    if found == b'1')
+
+    def close(self):
+        """
+        Close every connection.
+        """
+        for conn in self.connections:
+            if conn is not None:
+                conn.close()
+        self.connections = [None] * self.pool_size
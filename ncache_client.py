@@ -9,59 +9,322 @@ basic language parsing.
 __author__ = "Niall O'Connor zechs dot marquie at gmail"
 __version__ = "1.0"
 
-import cPickle
-from   functools import wraps
-from   hashlib import sha1
+from   bisect import bisect
+from   collections import OrderedDict
+from   concurrent.futures import ThreadPoolExecutor
+from   functools import partial, wraps
+from   hashlib import md5, sha1
+import itertools
 import logging
 import re
 import socket
+import threading
+import time
+import uuid
 import warnings
 
+import ncache_protocol as protocol
+from   ncache_serializers import Codec
+
 logger = logging.getLogger(__name__)
 
 def func2key(func, *args, **kw):
     """
     Convert a function and its arguments to a cache key.
     """
-    kw = kw.items() # dicts have no order so converting to a list of tuples and sort
-    kw.sort()
-    return sha1('%s_%s_%s' % (func.__name__, args, kw)).hexdigest()
+    kw = sorted(kw.items()) # dicts have no order so converting to a list of tuples and sort
+    return sha1(('%s_%s_%s' % (func.__name__, args, kw)).encode('utf-8')).hexdigest()
+
+class Connection(object):
+    """
+    One socket to an ncache server and the bytes received on it that have not
+    yet been read as a response.
+    """
+    def __init__(self, ip, port, buffer_size=1024, connect_timeout=None, read_timeout=None):
+        super(Connection, self).__init__()
+        self.sock = socket.create_connection((ip, port,), timeout=connect_timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(read_timeout)
+        self.read_timeout = read_timeout
+        self.buffer_size = buffer_size
+        self.inbox = protocol.ReadBuffer(buffer_size)
+        self.last_used = time.time()
+        self.uses = 0
 
-class NCache(object):
-    def __init__(self, ip='127.0.0.1', port=5005, buffer=1024, key_rexp="[\w\d-]{2,}", pickled=True):
+    def close(self):
         """
-        Create a new cache key.
+        Close the socket.
+        """
+        self.sock.close()
 
-        :param str ip: Ip address of tcp server.
-        :param str port: Port number of tcp server.
-        :param int buffer: TCP buffer size.
-        :param str key_regx: Key names must match this regex.
-        :param bool pickled: Pickle data when recording them.
-        usage:
-            >>> my_cache = NCache()
-            >>> my_cache.set('Something', 'Not nothing')
-            >>> my_cache.get('Something')
-            Not nothing
+    def is_healthy(self):
         """
-        super(NCache, self).__init__()
-        self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.conn.connect((ip, port,))
-        self.buffer_size = buffer
-        self.pickled = pickled
-        self.__rexp = re.compile(key_rexp)
-        self.__key_rexp = key_rexp
+        Returns False if the server closed the connection or left unread bytes
+        on it. Peeks at the socket without blocking.
+        """
+        if self.inbox:
+            return False
+        try:
+            self.sock.setblocking(False)
+            try:
+                # anything readable on an idle connection is either EOF or garbage
+                self.sock.recv(1, socket.MSG_PEEK)
+                return False
+            except (BlockingIOError, InterruptedError):
+                return True
+            finally:
+                self.sock.settimeout(self.read_timeout)
+        except OSError:
+            return False
 
-    def _execute_command(self, command):
+    def _recv(self):
         """
-        Execute the constructed command and handle the response.
+        Read more bytes from the server into the inbox.
         """
-        self.conn.send(command)
-        response = self.conn.recv(self.buffer_size)
-        if response.startswith('ERROR: '):
-            raise ValueError(response)
+        if not self.inbox.recv_into(self.sock):
+            raise ConnectionError('ncache server closed the connection')
+
+    def send(self, data):
+        """
+        Send bytes, or a list of buffers without joining them, to the server.
+        """
+        if isinstance(data, list):
+            protocol.send_parts(self.sock, data)
+        else:
+            self.sock.sendall(data)
+
+    def read_response(self):
+        """
+        Block until one complete response frame has arrived and return (status, items).
+        Raises ValueError if the server responded with an error.
+        """
+        inbox = self.inbox
+        frame = protocol.read_frame(inbox.buf, inbox.start, inbox.end)
+        while frame is None:
+            self._recv()
+            frame = protocol.read_frame(inbox.buf, inbox.start, inbox.end)
+        _, status, items, end = frame
+        inbox.consume(end)
+        if status == protocol.STATUS_ERROR:
+            raise ValueError(items[0].decode('latin-1'))
+        return status, items
+
+    def read_line(self):
+        """
+        Block until one CRLF terminated text response has arrived and return it.
+        """
+        end = self.inbox.find(protocol.TEXT_RESPONSE_TERMINATOR)
+        while end == -1:
+            self._recv()
+            end = self.inbox.find(protocol.TEXT_RESPONSE_TERMINATOR)
+        response = self.inbox.take(end).decode('latin-1')
+        self.inbox.consume(end + len(protocol.TEXT_RESPONSE_TERMINATOR))
         return response
 
-    def cachable(self, key_name=None, seconds=None, overwrite=True, cache_until=None):
+class PoolTimeout(Exception):
+    """
+    Raised when no pooled connection became free in time.
+    """
+
+class ConnectionPool(object):
+    """
+    A bounded, thread safe pool of Connections to one server.
+
+    Idle connections are reused most recently used first. When every
+    connection is checked out, callers wait for one to be checked back in.
+    Connections idle for longer than health_check_interval are checked
+    before reuse and replaced if the server has gone away.
+    """
+    def __init__(self, ip='127.0.0.1', port=5005, buffer_size=1024, max_size=10,
+                 connect_timeout=None, read_timeout=None, pool_timeout=None,
+                 health_check_interval=30):
+        """
+        :param str ip: Ip address of tcp server.
+        :param int port: Port number of tcp server.
+        :param int buffer_size: Number of bytes to read from a socket at a time.
+        :param int max_size: The most connections open at once.
+        :param float connect_timeout: Seconds to wait for a connection, None waits forever.
+        :param float read_timeout: Seconds to wait for a response, None waits forever.
+        :param float pool_timeout: Seconds to wait for a free connection, None waits forever.
+        :param float health_check_interval: Idle seconds after which a connection is checked before use.
+        """
+        super(ConnectionPool, self).__init__()
+        self.ip = ip
+        self.port = port
+        self.buffer_size = buffer_size
+        self.max_size = max_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_timeout = pool_timeout
+        self.health_check_interval = health_check_interval
+        self.idle = []
+        self.created = 0
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+
+    def _connect(self):
+        return Connection(self.ip, self.port, self.buffer_size,
+                          self.connect_timeout, self.read_timeout)
+
+    def get(self):
+        """
+        Check out a connection, opening a new one if the pool is not full.
+        """
+        with self.lock:
+            while not self.idle and self.created >= self.max_size:
+                if not self.available.wait(self.pool_timeout):
+                    raise PoolTimeout('No ncache connection became free in {0} seconds'.format(self.pool_timeout))
+            if self.idle:
+                conn = self.idle.pop()
+            else:
+                conn = None
+                self.created += 1
+        if conn is not None:
+            if time.time() - conn.last_used < self.health_check_interval or conn.is_healthy():
+                return conn
+            conn.close()
+        try:
+            return self._connect()
+        except Exception:
+            self._forget()
+            raise
+
+    def put(self, conn):
+        """
+        Check a healthy connection back in.
+        """
+        conn.last_used = time.time()
+        conn.uses += 1
+        with self.lock:
+            self.idle.append(conn)
+            self.available.notify()
+
+    def discard(self, conn):
+        """
+        Close a broken connection instead of checking it back in.
+        """
+        conn.close()
+        self._forget()
+
+    def _forget(self):
+        with self.lock:
+            self.created -= 1
+            self.available.notify()
+
+    def call(self, func, retry=True):
+        """
+        Run func with a checked out connection and return its result.
+
+        A ValueError is the server rejecting a command, the connection is still
+        in step and goes back to the pool. Socket errors discard the connection.
+        A ConnectionError on a connection that served earlier calls usually means
+        the server closed it while idle, so func is retried once on a new one.
+
+        :param func: Called with a Connection.
+        :param bool retry: Allow the single retry on a reused connection.
+        """
+        while True:
+            conn = self.get()
+            try:
+                result = func(conn)
+            except ValueError:
+                self.put(conn)
+                raise
+            except ConnectionError:
+                self.discard(conn)
+                if retry and conn.uses:
+                    retry = False
+                    continue
+                raise
+            except BaseException:
+                self.discard(conn)
+                raise
+            self.put(conn)
+            return result
+
+    def close(self):
+        """
+        Close every idle connection.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+            self.created -= len(idle)
+        for conn in idle:
+            conn.close()
+
+class _Flight(object):
+    """
+    One computation of a key that concurrent callers wait on.
+    """
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class Cachable(object):
+    """
+    Provides the cachable decorator to any client with get and set methods.
+    Clients with lease and release methods also coordinate recomputing a key
+    across processes.
+    """
+    def __init__(self):
+        super(Cachable, self).__init__()
+        # key -> _Flight of the computations running in this process
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+    def _single_flight(self, key, compute, wait=True):
+        """
+        Runs compute for a key once at a time in this process. Callers arriving
+        while it runs wait for and share its result, or its exception.
+
+        :param str key: The key being computed.
+        :param callable compute: Called with no args to compute the value.
+        :param bool wait: If False return None at once when key is already being computed.
+        """
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if not wait:
+                return None
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = compute()
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _refresh(self, key, compute):
+        """
+        Recomputes a stale key in a background thread unless it is already
+        being computed. Errors are logged and the stale value kept.
+        """
+        if key in self._flights:
+            return
+        def run():
+            try:
+                self._single_flight(key, compute, wait=False)
+            except Exception as e:
+                logger.exception(e)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def cachable(self, key_name=None, seconds=None, overwrite=True, cache_until=None, stale=None, lease=None,
+                 tags=None):
         """
         Decorate an expensive calculation to save on computing. All values are
         pickled before being stored. Keys may be hashed for some security. The may
@@ -69,10 +332,19 @@ class NCache(object):
         Note - Only cache module methods. To cache class methods, specify a key_name.
                 Additional fix/support is needed for caching class methods
 
+        Concurrent misses on a key in one process call the function once and
+        share its result. With lease, processes take a server lease on the key
+        before recomputing it and the others wait for the value to appear.
+        With stale, a key is still served for stale seconds after it goes out of
+        date while one caller recomputes it in the background.
+
         :param str key_name: The specific name for this key. If omitted this key will be made of the calling function name and a list of its args.
         :param int seconds: The expiry time of this key
         :param bool overwrite: A flag to set whether a key may be overwritten
         :param datetime.datetime cache_until: Datetime that this key will expire on
+        :param int stale: Seconds an out of date value is served while it is recomputed. Needs seconds.
+        :param int lease: Seconds a process may hold the server lease on a key while recomputing it.
+        :param tags: Tags the key is stored with, for delete_tag. A list or a function of the decorated function's args returning one.
 
         Usage:
             >>> cache = Cache()
@@ -80,15 +352,22 @@ class NCache(object):
                 def addit(a, b):
                     return a+b
         """
+        if stale is not None and seconds is None:
+            raise ValueError('stale needs seconds, the time a value is up to date')
         def collect(f):
-            # using functools.wrap allows all func parametres to be passed to this decorator
-            # while preserving the doc strings and other meta data.
-            @wraps(f)
-            def do_caching(*args, **kw):
-                # key is hashed by func2key
-                key = func2key(f, *args, **kw) if key_name is None else key_name
-                value = self.get(key, hash=False)
-                if not value: # If value is none nothing exists and we must call the decorated function
+            def compute(key, args, kw):
+                token = None
+                if lease and hasattr(self, 'lease'):
+                    token = self.lease(key, lease)
+                    if token is None:
+                        # another process is computing the key, wait for it to be set
+                        deadline = time.time() + lease
+                        while time.time() < deadline:
+                            time.sleep(0.05)
+                            cached = self.get(key)
+                            if cached:
+                                return cached[0] if stale is not None else cached
+                try:
                     value = f(*args, **kw)
                     if value is None:
                         # You shouldn't decorate fuctions that retrun None with a cache decorator.
@@ -100,12 +379,453 @@ class NCache(object):
                             Instead return something similar but meaningful in the context of your function eg:
                             [], {}, 0, False, str("None"), str("No records") etc.""")
                         raise TypeError('NoneType is not cachable. If required None can be cached using Cache.set()')
+                    key_tags = tags(*args, **kw) if callable(tags) else tags
+                    if stale is None:
+                        self.set(key, value, seconds=seconds, tags=key_tags)
+                    else:
+                        # stored with the time it goes out of date and kept for the stale window after it
+                        self.set(key, (value, time.time() + seconds,), seconds=seconds + stale, tags=key_tags)
+                    return value
+                finally:
+                    if token is not None:
+                        self.release(key, token)
 
-                    self.set(key, value, seconds=seconds)
-                return value
+            # using functools.wrap allows all func parametres to be passed to this decorator
+            # while preserving the doc strings and other meta data.
+            @wraps(f)
+            def do_caching(*args, **kw):
+                # key is hashed by func2key
+                key = func2key(f, *args, **kw) if key_name is None else key_name
+                value = self.get(key)
+                if value: # If value is none nothing exists and we must call the decorated function
+                    if stale is None:
+                        return value
+                    value, fresh_until = value
+                    if time.time() >= fresh_until:
+                        self._refresh(key, partial(compute, key, args, kw))
+                    return value
+                def fill():
+                    # a caller missing just before another caller set the key finds it here
+                    cached = self.get(key)
+                    if cached:
+                        return cached if stale is None else cached[0]
+                    return compute(key, args, kw)
+                return self._single_flight(key, fill)
             return do_caching
         return collect
 
+class NearCache(object):
+    """
+    A bounded in-process cache kept in front of the server. Hot keys are
+    answered from memory without a round trip or unpickling, so the objects
+    returned are shared between callers and must not be modified.
+
+    Entries are dropped least recently used first once there are more than
+    max_entries or their payloads exceed max_bytes. An entry expires with its
+    key on the server or after ttl seconds, whichever comes first.
+
+    usage:
+        >>> near = NearCache(max_entries=1000, ttl=5)
+        >>> near.put('k1', 'v1', 2)
+        >>> near.get('k1')
+        'v1'
+    """
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024, ttl=None):
+        """
+        :param int max_entries: The most keys held.
+        :param int max_bytes: The most payload bytes held.
+        :param float ttl: Seconds a key may be served locally, None for as long as the server holds it.
+        """
+        super(NearCache, self).__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> (value, <expiry on the monotonic clock or None>, size), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Returns the value held for key or None if it is missing or expired.
+
+        :param str key: The key to look up.
+        """
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                value, expires, size = cached
+                if expires is None or expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+                self.bytes -= size
+            self.misses += 1
+            return None
+
+    def put(self, key, value, size, seconds=None):
+        """
+        Holds a value for key. None is never held as it reads as a miss.
+
+        :param str key: The key.
+        :param object value: The decoded value.
+        :param int size: The bytes of the value as sent to the server.
+        :param float seconds: Seconds the key has left on the server, None for a perm key.
+        """
+        if value is None or size > self.max_bytes:
+            self.invalidate(key)
+            return
+        if self.ttl is not None:
+            seconds = self.ttl if seconds is None else min(seconds, self.ttl)
+        expires = None if seconds is None else time.monotonic() + seconds
+        entries = self.entries
+        with self.lock:
+            old = entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            entries[key] = (value, expires, size,)
+            self.bytes += size
+            while len(entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, _, evicted) = entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Drops a key so the next get goes to the server.
+
+        :param str key: The key to drop.
+        """
+        with self.lock:
+            cached = self.entries.pop(key, None)
+            if cached is not None:
+                self.bytes -= cached[2]
+
+    def invalidate_prefix(self, prefix):
+        """
+        Drops every key starting with prefix.
+
+        :param str prefix: The prefix.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key.startswith(prefix)]:
+                self.bytes -= self.entries.pop(key)[2]
+
+    def clear(self):
+        """
+        Drops every key.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        Returns the size and hit counters of the near cache.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'keys': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+class NCache(Cachable):
+    def __init__(self, ip='127.0.0.1', port=5005, buffer=1024, key_rexp=r"[\w\d:-]{2,}", pickled=True,
+                 pool_size=10, connect_timeout=None, read_timeout=None, pool_timeout=None,
+                 health_check_interval=30, near_cache_size=0, near_cache_bytes=16 * 1024 * 1024,
+                 near_cache_ttl=None, serializer=None, compress_threshold=None, compress_level=1, replicas=()):
+        """
+        Create a new cache key.
+
+        :param str ip: Ip address of tcp server.
+        :param str port: Port number of tcp server.
+        :param int buffer: Number of bytes to read from the socket at a time.
+        :param str key_regx: Key names must match this regex.
+        :param bool pickled: Pickle data when recording them, otherwise store str as text. Ignored if serializer is given.
+        :param int pool_size: The most connections open at once, shared by every thread.
+        :param float connect_timeout: Seconds to wait for a connection, None waits forever.
+        :param float read_timeout: Seconds to wait for a response, None waits forever.
+        :param float pool_timeout: Seconds to wait for a free connection, None waits forever.
+        :param float health_check_interval: Idle seconds after which a connection is checked before use.
+        :param int near_cache_size: Keys held in an in-process NearCache, 0 to disable it.
+        :param int near_cache_bytes: Payload bytes held in the NearCache.
+        :param float near_cache_ttl: Seconds a key may be served from the NearCache, None for its server ttl.
+        :param serializer: A ncache_serializers.Serializer or one of pickle, marshal, raw or text.
+        :param int compress_threshold: Values this many bytes or larger are compressed, None never compresses.
+        :param int compress_level: zlib level of compressed values.
+        :param list replicas: (ip, port) of replicas of the server. get and get_many are spread over them
+                              round robin and go to the server if a replica cannot be reached. Replication
+                              is asynchronous so a read may not yet see a write just made.
+        usage:
+            >>> my_cache = NCache()
+            >>> my_cache.set('Something', 'Not nothing')
+            >>> my_cache.get('Something')
+            Not nothing
+        """
+        super(NCache, self).__init__()
+        self.pool = ConnectionPool(ip, port, buffer, pool_size, connect_timeout,
+                                   read_timeout, pool_timeout, health_check_interval)
+        # connect now so a missing server is reported straight away
+        self.pool.put(self.pool.get())
+        if serializer is None:
+            serializer = 'pickle' if pickled else 'text'
+        self.codec = Codec(serializer, compress_threshold, compress_level)
+        self.near = NearCache(near_cache_size, near_cache_bytes, near_cache_ttl) if near_cache_size else None
+        self.replica_pools = [ConnectionPool(replica_ip, replica_port, buffer, pool_size, connect_timeout,
+                                             read_timeout, pool_timeout, health_check_interval)
+                              for replica_ip, replica_port in replicas]
+        self.next_replica = itertools.cycle(self.replica_pools) if self.replica_pools else None
+        self.__rexp = re.compile(key_rexp)
+        self.__key_rexp = key_rexp
+
+    def close(self):
+        """
+        Close every idle connection to the server and its replicas.
+        """
+        self.pool.close()
+        for pool in self.replica_pools:
+            pool.close()
+
+    def _call(self, pool, opcode, items):
+        """
+        Send one binary request frame on a connection from pool and return the
+        (status, items) response.
+        """
+        frame = protocol.frame_parts(protocol.MAGIC_REQUEST, opcode, items)
+        def request(conn):
+            conn.send(frame)
+            return conn.read_response()
+        return pool.call(request)
+
+    def _execute(self, opcode, *items):
+        """
+        Send one binary request frame to the server and return the (status, items) response.
+        """
+        return self._call(self.pool, opcode, items)
+
+    def _execute_read(self, opcode, *items):
+        """
+        Send a read to the next replica, or to the server if there are none or
+        the replica cannot be reached.
+        """
+        if self.next_replica is not None:
+            try:
+                return self._call(next(self.next_replica), opcode, items)
+            except (OSError, PoolTimeout) as e:
+                logger.warning("Replica read failed, reading from the server: %s", e)
+        return self._call(self.pool, opcode, items)
+
+    def _execute_command(self, command):
+        """
+        Execute a text command using the fallback grammar and return the response text.
+
+        :param str command: A text command such as 'GET k1'. It must not contain newlines.
+        """
+        data = protocol.to_bytes(command) + protocol.TEXT_TERMINATOR
+        def request(conn):
+            conn.send(data)
+            return conn.read_line()
+        response = self.pool.call(request)
+        if response.startswith('ERROR: '):
+            raise ValueError(response)
+        return response
+
+    def stats(self):
+        """
+        Returns the server counters as a dict. Numbers are converted to int or
+        float, latency_<command>_buckets to a list of ints and names such as
+        eviction_policy are left as str, see Server.stats.
+        """
+        _, items = self._execute(protocol.OP_STATS)
+        stats = {}
+        for name, value in zip(items[0::2], items[1::2]):
+            name = name.decode('latin-1')
+            value = value.decode('latin-1')
+            if name.endswith('_buckets'):
+                value = [int(count) for count in value.split(',')]
+            else:
+                try:
+                    value = int(value)
+                except ValueError:
+                    try:
+                        value = float(value)
+                    except ValueError:
+                        pass
+            stats[name] = value
+        return stats
+
+    def snapshot(self):
+        """
+        Ask the server to write a snapshot in the background. Returns SUCCESS,
+        or IN PROGRESS if a snapshot is already being written.
+        """
+        _, items = self._execute(protocol.OP_SNAPSHOT)
+        return items[0].decode('latin-1')
+
+    def incr(self, key, delta=1, initial=0, seconds=None):
+        """
+        Add to a counter on the server in one atomic round trip and return its
+        new value. A missing counter starts at initial and expires after
+        seconds, an existing one keeps its expiry.
+
+        :param str key: The counter key.
+        :param int delta: The amount to add.
+        :param int initial: The value of a missing counter before delta is added.
+        :param int seconds: The expiry time of a new counter.
+        """
+        ttl = "" if seconds is None else str(int(seconds))
+        _, items = self._execute(protocol.OP_INCR, self.__validate_key(key), str(int(delta)), str(int(initial)), ttl)
+        if self.near is not None:
+            self.near.invalidate(key)
+        return int(items[0])
+
+    def decr(self, key, delta=1, initial=0, seconds=None):
+        """
+        Subtract from a counter on the server. See incr.
+        """
+        return self.incr(key, -delta, initial, seconds)
+
+    def add(self, key, value, seconds=None):
+        """
+        Set a key only if it is missing. Returns True if it was set.
+
+        :param str key: The specific name for this key.
+        :param object value: The object to be cached.
+        :param int seconds: The expiry time of this key.
+        """
+        _, items = self._execute(protocol.OP_ADD, *self._set_items(key, value, seconds))
+        if self.near is not None:
+            self.near.invalidate(key)
+        return items[0] == b'1'
+
+    def gets(self, key):
+        """
+        Get a key and its version for cas. Returns (value, version) or
+        (None, None) if the key is missing.
+
+        :param str key: The specific name for this key.
+        """
+        status, items = self._execute(protocol.OP_GETS, *self._get_items(key))
+        if status == protocol.STATUS_NOT_FOUND:
+            return None, None
+        return self.codec.decode(items[0]), int(items[1])
+
+    def cas(self, key, value, version, seconds=None):
+        """
+        Set a key only if it is still at the version gets returned. Returns
+        True if it was set, False if it changed or is missing.
+
+        :param str key: The specific name for this key.
+        :param object value: The object to be cached.
+        :param int version: The version returned by gets.
+        :param int seconds: The expiry time of this key.
+        """
+        status, items = self._execute(protocol.OP_CAS, *self._set_items(key, value, seconds) + (str(version),))
+        if self.near is not None:
+            self.near.invalidate(key)
+        return status == protocol.STATUS_OK and items[0] == b'1'
+
+    def delete(self, *keys):
+        """
+        Delete keys. Returns the number that existed.
+
+        :param str keys: The key names to delete.
+        """
+        keys = [self.__validate_key(key) for key in keys]
+        if not keys:
+            return 0
+        _, items = self._execute(protocol.OP_DEL, *keys)
+        if self.near is not None:
+            for key in keys:
+                self.near.invalidate(key)
+        return int(items[0])
+
+    def tag(self, key, *tags):
+        """
+        Tag a key already in the cache. Returns False if it is missing.
+
+        :param str key: The key to tag.
+        :param str tags: The tags.
+        """
+        status, _ = self._execute(protocol.OP_TAG, self.__validate_key(key), *tags)
+        return status == protocol.STATUS_OK
+
+    def delete_tag(self, *tags):
+        """
+        Delete every key tagged with any of tags. Returns the number deleted.
+        The NearCache does not know tags so it is cleared.
+
+        :param str tags: The tags.
+        """
+        if not tags:
+            return 0
+        _, items = self._execute(protocol.OP_DELTAG, *tags)
+        if self.near is not None:
+            self.near.clear()
+        return int(items[0])
+
+    def delete_prefix(self, prefix):
+        """
+        Delete every key starting with prefix. Returns the number deleted.
+        Prefixes ending in ':', eg. 'user:42:', are indexed by the server and
+        cost time proportional to the keys deleted, others scan every key.
+
+        :param str prefix: The prefix.
+        """
+        _, items = self._execute(protocol.OP_DELPREFIX, prefix)
+        if self.near is not None:
+            self.near.invalidate_prefix(prefix)
+        return int(items[0])
+
+    def lease(self, key, seconds=10, token=None):
+        """
+        Take a lease on a key, eg. before recomputing it, so only one process
+        does the work. Returns the token holding the lease or None if another
+        token holds it.
+
+        :param str key: The key to lease.
+        :param int seconds: Seconds until the lease expires if it is not released.
+        :param str token: Renew a lease held with this token. A new token is made if omitted.
+        """
+        token = uuid.uuid4().hex if token is None else token
+        _, items = self._execute(protocol.OP_LEASE, self.__validate_key(key), token, str(max(int(seconds), 1)))
+        return token if items[0] == b'1' else None
+
+    def release(self, key, token):
+        """
+        Release a lease. Returns True if token still held it.
+
+        :param str key: The leased key.
+        :param str token: The token returned by lease.
+        """
+        _, items = self._execute(protocol.OP_RELEASE, self.__validate_key(key), token)
+        return items[0] == b'1'
+
+    def pipeline(self):
+        """
+        Returns a Pipeline that queues commands and sends them in one round trip.
+
+        usage:
+            >>> with my_cache.pipeline() as pipe:
+            ...     pipe.set('k1', 'v1')
+            ...     pipe.get('k1')
+            >>> pipe.results
+            ['SUCCESS', 'v1']
+        """
+        return Pipeline(self)
+
     def __validate_key(self, key):
         """
         Ensures a key name passes the regex check with expression in self.__key_rexp
@@ -114,26 +834,47 @@ class NCache(object):
         :param str key: A key name.
         """
         is_match = self.__rexp.match(key)
-        if not is_match or is_match.group() is not key:
+        if not is_match or is_match.group() != key:
             raise KeyError('"%s" is an invalid key as it does not match with the following regular expression, %s'%(key, self.__key_rexp))
         return key
 
-    def set(self, key, value, seconds=None):
+    def _set_items(self, key, value, seconds):
+        """
+        Validate and encode the items of a SET request.
+        """
+        key = self.__validate_key(key)
+        value = self.codec.encode(value)
+        ttl = "" if seconds is None else str(int(seconds))
+        return key, value, ttl
+
+    def _get_items(self, key):
+        """
+        Validate and encode the items of a GET request.
+        """
+        return self.__validate_key(key),
+
+    def _decode_get(self, status, items):
+        """
+        Turn a GET response into a python value, None when the key was not found.
+        """
+        if status == protocol.STATUS_NOT_FOUND:
+            return None
+        return self.codec.decode(items[0])
+
+    def set(self, key, value, seconds=None, tags=None):
         """
         Set a key in the cache.
 
         :param str key: The specific name for this key.
         :param object value: The object to be cached.
         :param int seconds: The expiry time of this key.
+        :param list tags: Tags to delete the key by with delete_tag.
         """
-        key = self.__validate_key(key)
-        if self.pickled:
-            value = cPickle.dumps(value)
-        ttl = ""
-        if seconds is not None:
-            ttl = "TTL={0}".format(seconds)
-        command = "SET {0} {1} {2}".format(key, value, ttl)
-        return self._execute_command(command)
+        items = self._set_items(key, value, seconds)
+        self._execute(protocol.OP_SET, *items + tuple(tags or ()))
+        if self.near is not None:
+            self.near.put(key, value, len(items[1]), seconds)
+        return 'SUCCESS'
 
     def get(self, key):
         """
@@ -141,11 +882,366 @@ class NCache(object):
 
         :param str key: The specific name for this key.
         """
-        key = self.__validate_key(key)
-        command = "GET {0}".format(key)
-        resp = self._execute_command(command)
-        if resp == 'NOT FOUND':
-            resp = None
-        elif self.pickled:
-            resp = cPickle.loads(resp)
-        return resp
+        near = self.near
+        if near is None:
+            return self._decode_get(*self._execute_read(protocol.OP_GET, *self._get_items(key)))
+        value = near.get(key)
+        if value is None:
+            status, items = self._execute_read(protocol.OP_GET, *self._get_items(key))
+            value = self._decode_get(status, items)
+            if value is not None:
+                # the server sends the milliseconds the key has left
+                ttl = items[1] if len(items) > 1 else b''
+                near.put(key, value, len(items[0]), int(ttl) / 1000.0 if ttl else None)
+        return value
+
+    def set_many(self, mapping, seconds=None):
+        """
+        Set many keys in one round trip.
+
+        :param dict mapping: key -> object pairs to be cached.
+        :param seconds: The expiry time of every key, or a dict of key -> seconds
+                        for per key expiry times. Keys missing from the dict are perm.
+        """
+        encode = self.codec.encode
+        validate = self.__validate_key
+        per_key = isinstance(seconds, dict)
+        items = []
+        for key, value in mapping.items():
+            items.append(validate(key))
+            items.append(encode(value))
+            ttl = seconds.get(key) if per_key else seconds
+            items.append("" if ttl is None else str(int(ttl)))
+        if items:
+            self._execute(protocol.OP_MSET, *items)
+        if self.near is not None:
+            for key in mapping:
+                self.near.invalidate(key)
+        return 'SUCCESS'
+
+    def get_many(self, keys):
+        """
+        Get many keys in one round trip. Returns a dict of the keys that were
+        found, missing keys are left out. Keys held in the NearCache are not
+        fetched but MGET does not send ttls so the rest are not added to it.
+
+        :param list keys: The key names to fetch.
+        """
+        keys = [self.__validate_key(key) for key in keys]
+        found = {}
+        if self.near is not None:
+            for key in keys:
+                value = self.near.get(key)
+                if value is not None:
+                    found[key] = value
+            keys = [key for key in keys if key not in found]
+        if not keys:
+            return found
+        _, items = self._execute_read(protocol.OP_MGET, *keys)
+        decode = self.codec.decode
+        found.update((key, decode(value),) for key, hit, value in zip(keys, items[0::2], items[1::2])
+                     if hit == b'1')
+        return found
+
+class Pipeline(object):
+    """
+    Queues GET and SET commands for an NCache and sends them as one batch of
+    frames. The server answers in order so results line up with the calls made.
+    """
+    def __init__(self, cache):
+        super(Pipeline, self).__init__()
+        self.cache = cache
+        self.frames = []
+        self.decoders = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.execute()
+
+    def set(self, key, value, seconds=None):
+        """
+        Queue a SET. See NCache.set.
+        """
+        items = self.cache._set_items(key, value, seconds)
+        near = self.cache.near
+        def decode(status, items):
+            if near is not None:
+                near.invalidate(key)
+            return 'SUCCESS'
+        self.frames.extend(protocol.frame_parts(protocol.MAGIC_REQUEST, protocol.OP_SET, items))
+        self.decoders.append(decode)
+        return self
+
+    def get(self, key):
+        """
+        Queue a GET. See NCache.get.
+        """
+        items = self.cache._get_items(key)
+        self.frames.extend(protocol.frame_parts(protocol.MAGIC_REQUEST, protocol.OP_GET, items))
+        self.decoders.append(self.cache._decode_get)
+        return self
+
+    def execute(self):
+        """
+        Send every queued command in one write and return their results in order.
+        A failed command has its ValueError placed in the results instead.
+        """
+        frames, decoders = self.frames, self.decoders
+        self.frames, self.decoders = [], []
+        def request(conn):
+            conn.send(frames)
+            results = []
+            for decode in decoders:
+                try:
+                    results.append(decode(*conn.read_response()))
+                except ValueError as e:
+                    results.append(e)
+            return results
+        self.results = self.cache.pool.call(request)
+        return self.results
+
+class HashRing(object):
+    """
+    A consistent hash ring. Each node is placed on the ring at many virtual
+    points so keys spread evenly, and adding or removing a node only moves
+    the keys between its points and their neighbours, about 1/n of them.
+    """
+    def __init__(self, nodes=(), vnodes=160):
+        """
+        :param list nodes: Hashable node names.
+        :param int vnodes: Points on the ring per node.
+        """
+        super(HashRing, self).__init__()
+        self.vnodes = vnodes
+        self.points = []
+        self.owners = []
+        self.nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(value):
+        """
+        Returns a 64 bit position on the ring for a str.
+        """
+        return int(md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+    def _rebuild(self, ring):
+        ring.sort()
+        self.points = [point for point, _ in ring]
+        self.owners = [node for _, node in ring]
+
+    def add(self, node):
+        """
+        Place a node on the ring.
+        """
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        ring = list(zip(self.points, self.owners))
+        ring.extend((self.hash('{0}-{1}'.format(node, i)), node,) for i in range(self.vnodes))
+        self._rebuild(ring)
+
+    def remove(self, node):
+        """
+        Take a node off the ring.
+        """
+        self.nodes.discard(node)
+        self._rebuild([(point, owner,) for point, owner in zip(self.points, self.owners) if owner != node])
+
+    def get(self, key):
+        """
+        Returns the node owning key, the first point clockwise from its hash.
+        """
+        if not self.points:
+            raise KeyError('The hash ring has no nodes')
+        index = bisect(self.points, self.hash(key))
+        return self.owners[index if index < len(self.points) else 0]
+
+class ShardedNCache(Cachable):
+    """
+    Spreads keys over many ncache servers with a consistent hash ring.
+
+    Single key calls go to the node owning the key. Batch calls are split
+    into one request per node and the requests run in parallel.
+
+    usage:
+        >>> cache = ShardedNCache([('10.0.0.1', 5005), ('10.0.0.2', 5005)])
+        >>> cache.set('Something', 'Not nothing')
+        >>> cache.get('Something')
+        Not nothing
+    """
+    def __init__(self, nodes, vnodes=160, **kw):
+        """
+        :param list nodes: (ip, port) pairs of the servers.
+        :param int vnodes: Points on the hash ring per server.
+        :param kw: Passed to the NCache of every server, eg. pool_size.
+        """
+        super(ShardedNCache, self).__init__()
+        self.client_kw = kw
+        self.clients = {}
+        self.ring = HashRing(vnodes=vnodes)
+        self.executor = None
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        """
+        Start routing a share of the keys to a new server.
+
+        :param tuple node: (ip, port) of the server.
+        """
+        node = tuple(node)
+        if node not in self.clients:
+            self.clients[node] = NCache(*node, **self.client_kw)
+            self.ring.add(node)
+
+    def remove_node(self, node):
+        """
+        Stop routing keys to a server and close its connections.
+
+        :param tuple node: (ip, port) of the server.
+        """
+        node = tuple(node)
+        client = self.clients.pop(node, None)
+        if client is not None:
+            self.ring.remove(node)
+            client.close()
+
+    def close(self):
+        """
+        Close the connections to every server.
+        """
+        for client in self.clients.values():
+            client.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def client_for(self, key):
+        """
+        Returns the NCache of the server owning key.
+        """
+        return self.clients[self.ring.get(key)]
+
+    def _parallel(self, calls):
+        """
+        Run (func, arg) calls concurrently, one per server, and return their results.
+        """
+        if len(calls) == 1:
+            func, arg = calls[0]
+            return [func(arg)]
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=max(len(self.clients), 1))
+        futures = [self.executor.submit(func, arg) for func, arg in calls]
+        return [future.result() for future in futures]
+
+    def set(self, key, value, seconds=None, tags=None):
+        """
+        Set a key on the server owning it. See NCache.set.
+        """
+        return self.client_for(key).set(key, value, seconds=seconds, tags=tags)
+
+    def get(self, key):
+        """
+        Get a key from the server owning it. See NCache.get.
+        """
+        return self.client_for(key).get(key)
+
+    def incr(self, key, delta=1, initial=0, seconds=None):
+        """
+        Add to a counter on the server owning it. See NCache.incr.
+        """
+        return self.client_for(key).incr(key, delta, initial, seconds)
+
+    def decr(self, key, delta=1, initial=0, seconds=None):
+        """
+        Subtract from a counter on the server owning it. See NCache.decr.
+        """
+        return self.client_for(key).decr(key, delta, initial, seconds)
+
+    def add(self, key, value, seconds=None):
+        """
+        Set a missing key on the server owning it. See NCache.add.
+        """
+        return self.client_for(key).add(key, value, seconds=seconds)
+
+    def gets(self, key):
+        """
+        Get a key and its version from the server owning it. See NCache.gets.
+        """
+        return self.client_for(key).gets(key)
+
+    def cas(self, key, value, version, seconds=None):
+        """
+        Compare and swap a key on the server owning it. See NCache.cas.
+        """
+        return self.client_for(key).cas(key, value, version, seconds=seconds)
+
+    def delete(self, *keys):
+        """
+        Delete keys with one request per server. See NCache.delete.
+        """
+        shards = {}
+        for key in keys:
+            shards.setdefault(self.ring.get(key), []).append(key)
+        return sum(self._parallel([(lambda args, client=self.clients[node]: client.delete(*args), batch)
+                                   for node, batch in shards.items()]))
+
+    def tag(self, key, *tags):
+        """
+        Tag a key on the server owning it. See NCache.tag.
+        """
+        return self.client_for(key).tag(key, *tags)
+
+    def delete_tag(self, *tags):
+        """
+        Delete tagged keys from every server. See NCache.delete_tag.
+        """
+        return sum(self._parallel([(lambda args, client=client: client.delete_tag(*args), tags)
+                                   for client in self.clients.values()]))
+
+    def delete_prefix(self, prefix):
+        """
+        Delete keys starting with prefix from every server. See NCache.delete_prefix.
+        """
+        return sum(self._parallel([(client.delete_prefix, prefix) for client in self.clients.values()]))
+
+    def lease(self, key, seconds=10, token=None):
+        """
+        Take a lease on a key from the server owning it. See NCache.lease.
+        """
+        return self.client_for(key).lease(key, seconds=seconds, token=token)
+
+    def release(self, key, token):
+        """
+        Release a lease on the server owning key. See NCache.release.
+        """
+        return self.client_for(key).release(key, token)
+
+    def set_many(self, mapping, seconds=None):
+        """
+        Set many keys with one request per server. See NCache.set_many.
+        """
+        shards = {}
+        for key, value in mapping.items():
+            shards.setdefault(self.ring.get(key), {})[key] = value
+        self._parallel([(partial(self.clients[node].set_many, seconds=seconds), batch)
+                         for node, batch in shards.items()])
+        return 'SUCCESS'
+
+    def get_many(self, keys):
+        """
+        Get many keys with one request per server. See NCache.get_many.
+        """
+        shards = {}
+        for key in keys:
+            shards.setdefault(self.ring.get(key), []).append(key)
+        found = {}
+        for result in self._parallel([(self.clients[node].get_many, batch)
+                                      for node, batch in shards.items()]):
+            found.update(result)
+        return found
@@ -0,0 +1,626 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Point in time snapshots, an append only write log and the replication
+stream of an ncache store.
+
+A snapshot is a header followed by one record per entry.
+
+    | magic | wall clock time of snapshot | entry count |
+    +-------+-----------------------------+-------------+
+    |  8s   |            d                |      Q      |
+
+    | kind | expiry wall clock time | key length | value length | key | value |
+    +------+------------------------+------------+--------------+-----+-------+
+    |  B   |          d             |     I      |      I       | ... |  ...  |
+
+kind records whether the value was stored as str or bytes. Expiry is the
+wall clock time the entry expires, or -1 for perm entries. Perm entries are
+written least recently used first so loading restores their recency order.
+Monotonic ticks do not survive a restart, so expiries are converted to and
+from wall clock time.
+
+The write log is a sequence of the same records without a header. Besides
+the two value kinds a record may be KIND_DELETE, which has an empty value.
+
+Replicas are sent the same records over a socket, one for every live entry
+followed by every later change. The stream also carries KIND_PING records,
+with an empty key and value, whose expiry is the wall clock time of the
+primary when it was sent.
+"""
+
+__author__ = "Niall O'Connor zechs dot marquie at gmail dot com"
+__version__ = '1.0'
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from   ncache_store import TICKS_PER_SECOND, now_ticks
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'NCSNAP1\n'
+SNAPSHOT_HEADER = struct.Struct('!8sdQ')
+SNAPSHOT_RECORD = struct.Struct('!BdII')
+
+KIND_BYTES = 0
+KIND_TEXT = 1
+KIND_DELETE = 2
+KIND_PING = 3
+
+PERM = -1.0
+
+def _pack_entry(key, entry, wall, ticks):
+    """
+    Returns the record for an entry as a list of bytes.
+
+    :param str key: The entry key.
+    :param ncache_store.Entry entry: The entry.
+    :param float wall: time.time() at the tick ticks.
+    :param int ticks: now_ticks() at the time wall.
+    """
+    value = entry.value
+    kind = KIND_BYTES
+    if isinstance(value, str):
+        kind = KIND_TEXT
+        value = value.encode('latin-1')
+    key = key.encode('latin-1')
+    if entry.expires is None:
+        expiry = PERM
+    else:
+        expiry = wall + float(entry.expires - ticks) / TICKS_PER_SECOND
+    return [SNAPSHOT_RECORD.pack(kind, expiry, len(key), len(value)), key, value]
+
+def _pack_delete(key):
+    """
+    Returns the record deleting a key as bytes.
+    """
+    key = key.encode('latin-1')
+    return SNAPSHOT_RECORD.pack(KIND_DELETE, PERM, len(key), 0) + key
+
+def _records(store):
+    """
+    Yields (key, entry) for every entry, perm entries in recency order first.
+    """
+    head = store.head
+    entry = head.next
+    while entry is not head:
+        yield entry.key, entry
+        entry = entry.next
+    for key, entry in store.entries.items():
+        if entry.expires is not None:
+            yield key, entry
+
+def write_snapshot(store, path):
+    """
+    Writes every entry of store to path. The file is written beside path and
+    renamed over it so a reader never sees a partial snapshot.
+
+    :param ncache_store.Store store: The store to save.
+    :param str path: The snapshot file.
+    :returns int: The number of entries written.
+    """
+    wall = time.time()
+    ticks = now_ticks()
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as snapshot:
+        snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, wall, len(store)))
+        _write_entries(snapshot, store, wall, ticks)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(tmp, path)
+    return len(store)
+
+def _write_entries(out, store, wall, ticks):
+    """
+    Writes a record for every entry of store to the file out.
+    """
+    for key, entry in _records(store):
+        out.writelines(_pack_entry(key, entry, wall, ticks))
+
+def load_snapshot(store, path):
+    """
+    Loads the entries of a snapshot into store. The file is memory mapped and
+    records are unpacked in place. Keys that expired while the server was
+    down are dropped.
+
+    :param ncache_store.Store store: The store to load into.
+    :param str path: The snapshot file.
+    :returns int: The number of entries loaded, 0 if there is no snapshot.
+    """
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return 0
+    loaded = 0
+    now = time.time()
+    unpack = SNAPSHOT_RECORD.unpack_from
+    record_size = SNAPSHOT_RECORD.size
+    with open(path, 'rb') as snapshot:
+        data = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, _, count = SNAPSHOT_HEADER.unpack_from(data, 0)
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError('ERROR: {0} is not an ncache snapshot'.format(path))
+            offset = SNAPSHOT_HEADER.size
+            for _ in range(count):
+                kind, expiry, key_len, value_len = unpack(data, offset)
+                offset += record_size
+                key = data[offset:offset + key_len].decode('latin-1')
+                offset += key_len
+                value = data[offset:offset + value_len]
+                offset += value_len
+                if expiry == PERM:
+                    ttl = None
+                else:
+                    ttl = expiry - now
+                    if ttl <= 0:
+                        continue
+                if kind == KIND_TEXT:
+                    value = value.decode('latin-1')
+                store.set(key, value, ttl)
+                loaded += 1
+        finally:
+            data.close()
+    return loaded
+
+class Snapshotter(object):
+    """
+    Saves snapshots in a forked child process so the parent keeps serving.
+
+    The child gets a copy on write view of the store as it was at the fork,
+    writes it and exits. The parent calls poll() from its event loop to reap
+    the child. Where fork is not available the snapshot is written inline.
+    """
+    def __init__(self, store, path):
+        """
+        :param ncache_store.Store store: The store to save.
+        :param str path: The snapshot file.
+        """
+        super(Snapshotter, self).__init__()
+        self.store = store
+        self.path = path
+        self.pid = None
+        self.started = None
+        self.last_saved = None
+
+    @property
+    def in_progress(self):
+        return self.pid is not None
+
+    def save(self):
+        """
+        Start a snapshot unless one is already being written.
+
+        :returns bool: True if a new snapshot was started.
+        """
+        if self.pid is not None:
+            return False
+        self.started = time.time()
+        if not hasattr(os, 'fork'):
+            write_snapshot(self.store, self.path)
+            self.last_saved = self.started
+            return True
+        pid = os.fork()
+        if pid == 0: # child
+            status = 0
+            try:
+                write_snapshot(self.store, self.path)
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        self.pid = pid
+        return True
+
+    def poll(self, block=False):
+        """
+        Reap a finished snapshot child.
+
+        :param bool block: Wait for the child to finish.
+        """
+        if self.pid is None:
+            return
+        pid, status = os.waitpid(self.pid, 0 if block else os.WNOHANG)
+        if pid == 0:
+            return
+        self.pid = None
+        if status == 0:
+            self.last_saved = self.started
+            logger.info("Snapshot saved to %s in %.3f seconds", self.path, time.time() - self.started)
+        else:
+            logger.error("Snapshot to %s failed with status %s", self.path, status)
+
+def read_log(path, end=None):
+    """
+    Yields (kind, key, value, expiry) for every complete record of a write log.
+
+    :param str path: The write log file.
+    :param int end: Stop at this offset, the end of the file by default.
+    """
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return
+    unpack = SNAPSHOT_RECORD.unpack_from
+    record_size = SNAPSHOT_RECORD.size
+    with open(path, 'rb') as log:
+        data = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            size = len(data) if end is None else min(end, len(data))
+            offset = 0
+            while offset + record_size <= size:
+                kind, expiry, key_len, value_len = unpack(data, offset)
+                stop = offset + record_size + key_len + value_len
+                if stop > size:
+                    break
+                start = offset + record_size
+                key = data[start:start + key_len].decode('latin-1')
+                value = data[start + key_len:stop]
+                offset = stop
+                yield kind, key, value, expiry
+        finally:
+            data.close()
+
+def read_record(buf, start=0, stop=None):
+    """
+    Reads one record from buf beginning at offset start, eg. from the
+    replication stream.
+
+    Returns (kind, key, value, expiry, end) or None if buf does not yet hold
+    a complete record. end is the offset of the first byte after the record.
+
+    :param bytearray buf: Bytes received so far.
+    :param int start: Offset of the first byte of the record.
+    :param int stop: Offset after the last byte received, the end of buf if omitted.
+    """
+    if stop is None:
+        stop = len(buf)
+    if stop - start < SNAPSHOT_RECORD.size:
+        return None
+    kind, expiry, key_len, value_len = SNAPSHOT_RECORD.unpack_from(buf, start)
+    offset = start + SNAPSHOT_RECORD.size
+    end = offset + key_len + value_len
+    if stop < end:
+        return None
+    key = buf[offset:offset + key_len].decode('latin-1')
+    value = bytes(buf[offset + key_len:end])
+    return kind, key, value, expiry, end
+
+def repair_log(path):
+    """
+    Truncates a write log after its last complete record. A record cut short
+    by a crash would otherwise corrupt everything appended after it. Only
+    record headers are read.
+
+    :param str path: The write log file.
+    :returns int: The size of the repaired log.
+    """
+    if not os.path.exists(path):
+        return 0
+    size = os.path.getsize(path)
+    record_size = SNAPSHOT_RECORD.size
+    offset = 0
+    with open(path, 'r+b') as log:
+        while offset + record_size <= size:
+            log.seek(offset)
+            _, _, key_len, value_len = SNAPSHOT_RECORD.unpack(log.read(record_size))
+            if offset + record_size + key_len + value_len > size:
+                break
+            offset += record_size + key_len + value_len
+        if offset != size:
+            logger.warning("Write log %s ends with a partial record, truncating %s bytes", path, size - offset)
+            log.truncate(offset)
+    return offset
+
+def apply_record(store, kind, key, value, expiry, now=None):
+    """
+    Applies one write log record to store. Sets that have expired are dropped.
+
+    :returns bool: True if the store changed.
+    """
+    if kind == KIND_DELETE:
+        return store.delete(key)
+    if expiry == PERM:
+        ttl = None
+    else:
+        ttl = expiry - (now or time.time())
+        if ttl <= 0:
+            return store.delete(key)
+    if kind == KIND_TEXT:
+        value = value.decode('latin-1')
+    store.set(key, value, ttl)
+    return True
+
+FSYNC_ALWAYS = 'always'
+FSYNC_EVERYSEC = 'everysec'
+FSYNC_NEVER = 'never'
+
+class WriteLog(object):
+    """
+    Appends every set and delete made to a store to a file.
+
+    Watches the store, so writes from any path are recorded. Records are
+    appended to an in memory buffer. With the always policy the server calls
+    commit() once per batch of commands, before their responses are sent, and
+    the batch is written and fsynced together. With everysec or never a
+    background thread writes the buffer once a second, fsyncing it under
+    everysec, so the request path never touches the disk.
+
+    Compaction forks a child that rewrites the log from the live store while
+    the parent keeps appending. Records made meanwhile are also kept in a
+    rewrite buffer, appended to the new log once the child finishes.
+    """
+    def __init__(self, path, fsync=FSYNC_EVERYSEC, compact_size=64 * 1024 * 1024):
+        """
+        :param str path: The write log file.
+        :param str fsync: always, everysec or never.
+        :param int compact_size: Compact once the log is larger than this and
+                                 twice its size after the last compaction.
+        """
+        super(WriteLog, self).__init__()
+        if fsync not in (FSYNC_ALWAYS, FSYNC_EVERYSEC, FSYNC_NEVER):
+            raise ValueError('ERROR: fsync policy must be always, everysec or never')
+        self.path = path
+        self.fsync = fsync
+        self.compact_size = compact_size
+        self.lock = threading.Lock()
+        self.buffer = bytearray()
+        self.rewrite = None
+        self.pid = None
+        self.file = None
+        self.size = 0
+        self.compacted_size = 0
+        self.opened_size = None
+        # keys written by live traffic while the log is replayed
+        self.replaying = False
+        self.touched = set()
+        self.muted = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def open(self):
+        """
+        Repair and open the log for appending and start the background writer.
+        """
+        repair_log(self.path)
+        self.file = open(self.path, 'ab')
+        self.size = self.compacted_size = self.opened_size = self.file.tell()
+        if self.fsync != FSYNC_ALWAYS:
+            self.thread = threading.Thread(target=self._run, name='ncache-write-log')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _append(self, record):
+        with self.lock:
+            self.buffer += record
+            if self.rewrite is not None:
+                self.rewrite += record
+
+    def on_set(self, key, entry):
+        """
+        Store watcher, records a set.
+        """
+        if self.muted:
+            return
+        if self.replaying:
+            self.touched.add(key)
+        self._append(b''.join(_pack_entry(key, entry, time.time(), now_ticks())))
+
+    def on_delete(self, key):
+        """
+        Store watcher, records a delete.
+        """
+        if self.muted:
+            return
+        if self.replaying:
+            self.touched.add(key)
+        self._append(_pack_delete(key))
+
+    def flush(self, sync):
+        """
+        Write the buffer to the file, fsyncing it if sync is set.
+        """
+        with self.lock:
+            if self.buffer:
+                self.file.write(self.buffer)
+                self.file.flush()
+                self.size += len(self.buffer)
+                del self.buffer[:]
+                if sync:
+                    os.fsync(self.file.fileno())
+
+    def commit(self):
+        """
+        Make the buffered records durable. Only does work under the always policy.
+        """
+        if self.fsync == FSYNC_ALWAYS:
+            self.flush(True)
+
+    def _run(self):
+        while not self.stopped.wait(1.0):
+            try:
+                self.flush(self.fsync == FSYNC_EVERYSEC)
+            except (IOError, OSError) as e:
+                logger.exception(e)
+
+    def replay(self, store, batch=10000):
+        """
+        Returns a generator applying the log, as it was when opened, to store
+        batch records per step so the caller can interleave replay with serving
+        requests. Keys written by live traffic since replay began are not
+        replayed. Each step yields the number of records applied so far.
+        """
+        self.replaying = True
+        return self._replay(store, batch, self.opened_size)
+
+    def _replay(self, store, batch, end):
+        now = time.time()
+        applied = 0
+        try:
+            for i, (kind, key, value, expiry) in enumerate(read_log(self.path, end)):
+                if key not in self.touched:
+                    self.muted = True
+                    try:
+                        apply_record(store, kind, key, value, expiry, now)
+                    finally:
+                        self.muted = False
+                    applied += 1
+                if i % batch == batch - 1:
+                    yield applied
+        finally:
+            self.replaying = False
+            self.touched.clear()
+        yield applied
+
+    def compact(self, store):
+        """
+        Start rewriting the log from the live store in a forked child.
+
+        :returns bool: True if compaction was started.
+        """
+        if self.pid is not None or not hasattr(os, 'fork') or self.replaying:
+            return False
+        with self.lock:
+            self.rewrite = bytearray()
+            pid = os.fork()
+        if pid == 0: # child
+            status = 0
+            try:
+                with open(self.path + '.rewrite', 'wb') as out:
+                    _write_entries(out, store, time.time(), now_ticks())
+                    out.flush()
+                    os.fsync(out.fileno())
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        self.pid = pid
+        return True
+
+    def poll(self, block=False):
+        """
+        Reap a finished compaction child and swap in the rewritten log.
+
+        :param bool block: Wait for the child to finish.
+        """
+        if self.pid is None:
+            return
+        pid, status = os.waitpid(self.pid, 0 if block else os.WNOHANG)
+        if pid == 0:
+            return
+        self.pid = None
+        rewritten = self.path + '.rewrite'
+        with self.lock:
+            rewrite, self.rewrite = self.rewrite, None
+            if status != 0:
+                logger.error("Write log compaction failed with status %s", status)
+                return
+            # the rewrite buffer holds every record made since the fork
+            with open(rewritten, 'ab') as out:
+                out.write(rewrite)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(rewritten, self.path)
+            self.file.close()
+            self.file = open(self.path, 'ab')
+            self.size = self.compacted_size = self.file.tell()
+            del self.buffer[:]
+        logger.info("Write log compacted to %s bytes", self.size)
+
+    def tick(self, store):
+        """
+        Called periodically, reaps compaction and starts one when the log is large.
+        """
+        self.poll()
+        if self.size > self.compact_size and self.size > 2 * self.compacted_size:
+            self.compact(store)
+
+    def close(self):
+        """
+        Stop the background writer and write out everything buffered.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.poll(block=True)
+        if self.file is not None:
+            self.flush(self.fsync != FSYNC_NEVER)
+            self.file.close()
+
+class ReplicationFeed(object):
+    """
+    Streams every set and delete made to a store to the connections of its
+    replicas.
+
+    Watches the store, so evictions and expiry are streamed as deletes like
+    any other change. A replica is first queued a record for every live entry
+    and then the record of each change as it is made. Records are appended to
+    the outbox of each replica connection and sent by the server with the rest
+    of its writes. Nothing is packed while there are no replicas.
+    """
+    def __init__(self):
+        super(ReplicationFeed, self).__init__()
+        # connection -> bytes queued on it since it connected
+        self.replicas = {}
+
+    def add(self, conn, store):
+        """
+        Start streaming to a replica connection, queueing a full sync of store.
+
+        :param conn: A connection with outbox, a list of buffers, and bytes_out.
+        :param ncache_store.Store store: The store watched.
+        :returns int: The number of entries queued.
+        """
+        wall = time.time()
+        ticks = now_ticks()
+        queued = conn.bytes_out + sum(len(part) for part in conn.outbox)
+        count = 0
+        for key, entry in _records(store):
+            record = _pack_entry(key, entry, wall, ticks)
+            # values are referenced, not copied, until they are sent
+            conn.outbox.extend(record)
+            queued += sum(len(part) for part in record)
+            count += 1
+        self.replicas[conn] = queued
+        return count
+
+    def remove(self, conn):
+        """
+        Stop streaming to a replica connection.
+        """
+        self.replicas.pop(conn, None)
+
+    def _append(self, record):
+        replicas = self.replicas
+        for conn in replicas:
+            conn.outbox.append(record)
+            replicas[conn] += len(record)
+
+    def on_set(self, key, entry):
+        """
+        Store watcher, streams a set.
+        """
+        if self.replicas:
+            self._append(b''.join(_pack_entry(key, entry, time.time(), now_ticks())))
+
+    def on_delete(self, key):
+        """
+        Store watcher, streams a delete.
+        """
+        if self.replicas:
+            self._append(_pack_delete(key))
+
+    def ping(self):
+        """
+        Stream the wall clock time so replicas can tell how far behind they are.
+        """
+        if self.replicas:
+            self._append(SNAPSHOT_RECORD.pack(KIND_PING, time.time(), 0, 0))
+
+    def backlogs(self):
+        """
+        Returns (connection, bytes queued but not yet sent) for every replica.
+        """
+        return [(conn, queued - conn.bytes_out,) for conn, queued in self.replicas.items()]
@@ -0,0 +1,355 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Eviction policies for ncache_store.Store.
+
+A policy chooses the keys manage_memory evicts once the cache is over its
+limit. It is told of every set and delete as a store watcher and, if it sets
+counts_reads, of every get. evict(count) removes up to count keys and returns
+the number removed, 0 once it has nothing left to evict.
+
+default   The least recently used perm keys. ttl keys are left to
+          manage_memory, which removes them nearest expiry first.
+lru       The least recently used keys, perm or ttl.
+lfu       The least frequently used keys, the least recently used of them
+          first. Counts are never aged so keys popular long ago stay.
+tinylfu   lru eviction behind an admission filter. A new key only displaces
+          the least recently used key if a frequency sketch of recent reads
+          and writes estimates it is used more often.
+
+usage:
+    >>> store = Store(policy=make_policy('tinylfu'))
+    >>> store.policy.evict(10)
+    10
+"""
+
+__author__ = "Niall O'Connor zechs dot marquie at gmail dot com"
+__version__ = '1.0'
+
+from   collections import OrderedDict
+from   itertools import islice
+import time
+
+class EvictionPolicy(object):
+    """
+    Base of the eviction policies. Subclasses order the keys they are told of
+    and return the next ones to evict from victims.
+    """
+    name = None
+    # True if Store.get_entry calls on_read and on_miss
+    counts_reads = True
+
+    def __init__(self):
+        super(EvictionPolicy, self).__init__()
+        self.store = None
+
+    def attach(self, store):
+        """
+        Starts choosing keys of store, which may already hold keys.
+
+        :param Store store: The store evicted from.
+        """
+        self.store = store
+        self.clear()
+        for key, entry in store.entries.items():
+            self.on_set(key, entry)
+
+    def on_read(self, key, entry):
+        """
+        A get found key.
+        """
+
+    def on_miss(self, key):
+        """
+        A get did not find key.
+        """
+
+    def on_set(self, key, entry):
+        """
+        Store watcher, key was set.
+        """
+
+    def on_delete(self, key):
+        """
+        Store watcher, key was deleted, expired or evicted.
+        """
+
+    def clear(self):
+        """
+        Forgets every key, eg. when the store is cleared.
+        """
+
+    def victims(self, count):
+        """
+        Returns up to count keys to evict, the first evicted first.
+        """
+        return []
+
+    def evict(self, count):
+        """
+        Removes up to count keys from the store.
+
+        :param int count: The number of keys to remove.
+        :returns int: The number of keys removed.
+        """
+        store = self.store
+        started = time.time()
+        keys = self.victims(count)
+        for key in keys:
+            store.delete(key)
+        store.policy_evictions += len(keys)
+        store.eviction_seconds += time.time() - started
+        return len(keys)
+
+class PermLRUPolicy(EvictionPolicy):
+    """
+    The store's own order, its recency list of perm keys. ttl keys are not
+    evicted by the policy.
+    """
+    name = 'default'
+    counts_reads = False
+
+    def attach(self, store):
+        self.store = store
+
+    def evict(self, count):
+        return self.store.evict_lru(count)
+
+class LRUPolicy(EvictionPolicy):
+    """
+    Evicts the least recently used keys, perm or ttl.
+    """
+    name = 'lru'
+
+    def __init__(self):
+        super(LRUPolicy, self).__init__()
+        # keys from least to most recently used
+        self.order = OrderedDict()
+
+    def on_read(self, key, entry):
+        self.order.move_to_end(key)
+
+    def on_set(self, key, entry):
+        order = self.order
+        order[key] = None
+        order.move_to_end(key)
+
+    def on_delete(self, key):
+        self.order.pop(key, None)
+
+    def clear(self):
+        self.order.clear()
+
+    def victims(self, count):
+        return list(islice(self.order, count))
+
+class LFUPolicy(EvictionPolicy):
+    """
+    Evicts the keys read or written the fewest times. Keys with the same count
+    are kept in buckets ordered from least to most recently used, so touching
+    a key and finding the next victim are O(1).
+    """
+    name = 'lfu'
+
+    def __init__(self):
+        super(LFUPolicy, self).__init__()
+        # key -> uses, uses -> {key: None} from least to most recently used
+        self.counts = {}
+        self.buckets = {}
+        # the fewest uses of any key, the bucket may since have emptied
+        self.least = 1
+
+    def _touch(self, key):
+        counts = self.counts
+        buckets = self.buckets
+        count = counts[key]
+        bucket = buckets[count]
+        del bucket[key]
+        if not bucket:
+            del buckets[count]
+        count += 1
+        counts[key] = count
+        bucket = buckets.get(count)
+        if bucket is None:
+            bucket = buckets[count] = {}
+        bucket[key] = None
+
+    def on_read(self, key, entry):
+        self._touch(key)
+
+    def on_set(self, key, entry):
+        if key in self.counts:
+            self._touch(key)
+            return
+        self.counts[key] = 1
+        bucket = self.buckets.get(1)
+        if bucket is None:
+            bucket = self.buckets[1] = {}
+        bucket[key] = None
+        self.least = 1
+
+    def on_delete(self, key):
+        count = self.counts.pop(key, None)
+        if count is None:
+            return
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+
+    def clear(self):
+        self.counts.clear()
+        self.buckets.clear()
+        self.least = 1
+
+    def victims(self, count):
+        buckets = self.buckets
+        if not buckets:
+            return []
+        if self.least not in buckets:
+            self.least = min(buckets)
+        keys = list(islice(buckets[self.least], count))
+        if len(keys) < count:
+            # the fewest used bucket ran out, take from the next ones
+            keys = []
+            for uses in sorted(buckets):
+                keys.extend(islice(buckets[uses], count - len(keys)))
+                if len(keys) == count:
+                    break
+        return keys
+
+# byte -> byte >> 1, halves a row of counters with bytearray.translate
+HALVED = bytes(count >> 1 for count in range(256))
+
+class FrequencySketch(object):
+    """
+    A count-min sketch of how often keys are used. Each key has a saturating
+    counter in each of depth rows and its estimate is the smallest of them.
+    Every counter is halved after sample_size increments so the counts follow
+    recent use.
+    """
+    __slots__ = ('rows', 'mask', 'depth', 'additions', 'sample_size')
+
+    MAX_COUNT = 15
+
+    def __init__(self, width=65536, depth=4, sample_size=None):
+        """
+        :param int width: Counters per row, rounded up to a power of 2. Roughly the keys cached.
+        :param int depth: Rows, each key is counted once in every row.
+        :param int sample_size: Increments between halvings, 10 * width if omitted.
+        """
+        size = 1
+        while size < width:
+            size <<= 1
+        self.rows = [bytearray(size) for _ in range(depth)]
+        self.mask = size - 1
+        self.depth = depth
+        self.additions = 0
+        self.sample_size = sample_size or 10 * size
+
+    def increment(self, key):
+        """
+        Counts one use of key. Row i counts it at h1 + i * h2, double hashing
+        from the one hash of key.
+        """
+        h1 = hash(key)
+        h2 = (h1 >> 17) | 1
+        mask = self.mask
+        for row in self.rows:
+            i = h1 & mask
+            if row[i] < self.MAX_COUNT:
+                row[i] += 1
+            h1 += h2
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.halve()
+
+    def estimate(self, key):
+        """
+        Returns the estimated uses of key, never fewer than counted since the last halving.
+        """
+        h1 = hash(key)
+        h2 = (h1 >> 17) | 1
+        mask = self.mask
+        least = self.MAX_COUNT
+        for row in self.rows:
+            count = row[h1 & mask]
+            if count < least:
+                least = count
+            h1 += h2
+        return least
+
+    def halve(self):
+        """
+        Ages the sketch, halving every counter.
+        """
+        for row in self.rows:
+            row[:] = row.translate(HALVED)
+        self.additions //= 2
+
+class TinyLFUPolicy(LRUPolicy):
+    """
+    LRU eviction with TinyLFU admission. The newest key set since the last
+    eviction is the candidate. Evicting, it is compared with the least
+    recently used key and whichever the sketch estimates is used less often
+    goes, so a burst of keys read once cannot flush the popular ones.
+    """
+    name = 'tinylfu'
+
+    def __init__(self, width=65536, depth=4, sample_size=None):
+        """
+        :param int width: Counters per sketch row, roughly the keys cached.
+        :param int depth: Sketch rows.
+        :param int sample_size: Uses counted between halvings of the sketch, 10 * width if omitted.
+        """
+        super(TinyLFUPolicy, self).__init__()
+        self.sketch = FrequencySketch(width, depth, sample_size)
+        self.candidate = None
+        # new keys evicted in place of the least recently used key
+        self.rejected = 0
+
+    def on_read(self, key, entry):
+        self.sketch.increment(key)
+        self.order.move_to_end(key)
+
+    def on_miss(self, key):
+        self.sketch.increment(key)
+
+    def on_set(self, key, entry):
+        self.sketch.increment(key)
+        order = self.order
+        if key not in order:
+            self.candidate = key
+        order[key] = None
+        order.move_to_end(key)
+
+    def clear(self):
+        self.order.clear()
+        self.candidate = None
+
+    def victims(self, count):
+        keys = list(islice(self.order, count))
+        candidate = self.candidate
+        self.candidate = None
+        if keys and candidate in self.order and candidate not in keys:
+            estimate = self.sketch.estimate
+            if estimate(candidate) <= estimate(keys[0]):
+                keys[0] = candidate
+                self.rejected += 1
+        return keys
+
+POLICIES = dict((policy.name, policy,) for policy in (PermLRUPolicy, LRUPolicy, LFUPolicy, TinyLFUPolicy))
+
+def make_policy(name, **options):
+    """
+    Returns a new policy by name.
+
+    :param str name: default, lru, lfu or tinylfu.
+    :param options: Passed to the policy, eg. width for tinylfu.
+    """
+    policy = POLICIES.get(name)
+    if policy is None:
+        raise ValueError('ERROR: Unknown eviction policy {0}, choose one of {1}'.format(
+            name, ', '.join(sorted(POLICIES))))
+    return policy(**options)
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Wire format shared by the ncache server and its clients.
+
+Two grammars are understood on the same port.
+
+Binary frames start with a magic byte and carry explicit lengths, so values
+of any size and content survive the trip and many frames may be written back
+to back (pipelined) with responses returned in the same order.
+
+    | magic | opcode/status | item count | body length | body ...      |
+    +-------+---------------+------------+-------------+---------------+
+    |  B    |      B        |     I      |      I      | items         |
+
+The body is a sequence of items, each one a 4 byte length followed by that
+many bytes. Requests use MAGIC_REQUEST and an opcode, responses use
+MAGIC_RESPONSE and a status.
+
+Text commands (SET/GET as understood by ncache.parse_command) are the
+fallback. Each command is terminated by a newline and each response is
+terminated by CRLF.
+"""
+
+__author__ = "Niall O'Connor zechs dot marquie at gmail dot com"
+__version__ = '1.0'
+
+import struct
+
+MAGIC_REQUEST = 0x80
+MAGIC_RESPONSE = 0x81
+
+HEADER = struct.Struct('!BBII')
+ITEM = struct.Struct('!I')
+
+# opcodes
+OP_GET = 0x01
+OP_SET = 0x02
+OP_MGET = 0x03
+OP_MSET = 0x04
+OP_SNAPSHOT = 0x05
+OP_STATS = 0x06
+OP_LEASE = 0x07
+OP_RELEASE = 0x08
+OP_INCR = 0x09
+OP_ADD = 0x0a
+OP_GETS = 0x0b
+OP_CAS = 0x0c
+OP_DEL = 0x0d
+OP_TAG = 0x0e
+OP_DELTAG = 0x0f
+OP_DELPREFIX = 0x10
+OP_SYNC = 0x11
+
+# names of the opcodes, matching the text commands
+OPCODE_NAMES = {
+    OP_GET: 'get',
+    OP_SET: 'set',
+    OP_MGET: 'mget',
+    OP_MSET: 'mset',
+    OP_SNAPSHOT: 'snapshot',
+    OP_STATS: 'stats',
+    OP_LEASE: 'lease',
+    OP_RELEASE: 'release',
+    OP_INCR: 'incr',
+    OP_ADD: 'add',
+    OP_GETS: 'gets',
+    OP_CAS: 'cas',
+    OP_DEL: 'del',
+    OP_TAG: 'tag',
+    OP_DELTAG: 'deltag',
+    OP_DELPREFIX: 'delprefix',
+    OP_SYNC: 'sync',
+}
+
+# response statuses
+STATUS_OK = 0x00
+STATUS_NOT_FOUND = 0x01
+STATUS_ERROR = 0x02
+
+TEXT_TERMINATOR = b'\n'
+TEXT_RESPONSE_TERMINATOR = b'\r\n'
+
+# items this large are sent from their own buffer rather than copied into the frame
+COPY_THRESHOLD = 16 * 1024
+# the most buffers handed to one sendmsg call
+IOV_MAX = 1024
+
+def to_bytes(value):
+    """
+    Coerce a str, bytes or buffer item to bytes. Text is encoded as latin-1 so
+    every character maps to exactly one byte and back again.
+
+    :param value: The item to coerce.
+    """
+    if isinstance(value, str):
+        return value.encode('latin-1')
+    return bytes(value)
+
+def frame_parts(magic, code, items=()):
+    """
+    Returns a complete frame as a list of buffers to be written in order, eg.
+    with sendmsg. Small items are joined with the header and length prefixes,
+    items of COPY_THRESHOLD bytes or more are referenced, not copied.
+
+    :param int magic: MAGIC_REQUEST or MAGIC_RESPONSE.
+    :param int code: The opcode of a request or the status of a response.
+    :param list items: str, bytes or buffer items making up the body.
+    """
+    parts = [None]
+    small = []
+    length = 0
+    for item in items:
+        if isinstance(item, str):
+            item = item.encode('latin-1')
+        size = len(item)
+        length += ITEM.size + size
+        small.append(ITEM.pack(size))
+        if size < COPY_THRESHOLD:
+            small.append(item)
+        else:
+            parts.append(b''.join(small))
+            parts.append(item)
+            small = []
+    if small:
+        parts.append(b''.join(small))
+    parts[0] = HEADER.pack(magic, code, len(items), length)
+    return parts
+
+def pack_frame(magic, code, items=()):
+    """
+    Returns a complete frame as bytes.
+
+    :param int magic: MAGIC_REQUEST or MAGIC_RESPONSE.
+    :param int code: The opcode of a request or the status of a response.
+    :param list items: str or bytes items making up the body.
+    """
+    return b''.join(frame_parts(magic, code, items))
+
+def read_frame(buf, start=0, stop=None):
+    """
+    Reads one frame from buf beginning at offset start.
+
+    Returns (magic, code, items, end) or None if buf does not yet hold a
+    complete frame. end is the offset of the first byte after the frame.
+    Each item is copied out of buf exactly once.
+
+    :param bytearray buf: Bytes received so far.
+    :param int start: Offset of the first byte of the frame.
+    :param int stop: Offset after the last byte received, the end of buf if omitted.
+    """
+    if stop is None:
+        stop = len(buf)
+    if stop - start < HEADER.size:
+        return None
+    magic, code, count, length = HEADER.unpack_from(buf, start)
+    end = start + HEADER.size + length
+    if stop < end:
+        return None
+    items = []
+    offset = start + HEADER.size
+    with memoryview(buf) as view:
+        for _ in range(count):
+            if offset + ITEM.size > end:
+                raise ValueError('ERROR: Malformed frame. Body holds fewer items than its count')
+            size, = ITEM.unpack_from(buf, offset)
+            offset += ITEM.size
+            if offset + size > end:
+                break
+            items.append(view[offset:offset + size].tobytes())
+            offset += size
+    if offset != end:
+        raise ValueError('ERROR: Malformed frame. Body length does not match its items')
+    return magic, code, items, end
+
+class ReadBuffer(object):
+    """
+    A preallocated buffer sockets are read into with recv_into.
+
+    Bytes from start to end have been received but not yet consumed. Reading
+    appends at end, consuming moves start forward. Nothing is moved until the
+    buffer fills, then the unconsumed bytes move to the front or, if a single
+    frame needs more room, the buffer doubles.
+
+    usage:
+        >>> inbox = ReadBuffer(1024)
+        >>> inbox.recv_into(sock)
+        >>> read_frame(inbox.buf, inbox.start, inbox.end)
+    """
+    __slots__ = ('buf', 'start', 'end', 'size')
+
+    def __init__(self, size=65536):
+        """
+        :param int size: Bytes preallocated, the buffer returns to this size once emptied.
+        """
+        self.buf = bytearray(size)
+        self.start = 0
+        self.end = 0
+        self.size = size
+
+    def __len__(self):
+        return self.end - self.start
+
+    def recv_into(self, sock):
+        """
+        Read from sock into the free space. Returns the bytes read, 0 when the
+        peer closed the connection.
+        """
+        buf = self.buf
+        if self.end == len(buf):
+            if self.start:
+                unread = self.end - self.start
+                buf[:unread] = buf[self.start:self.end]
+                self.start, self.end = 0, unread
+            else:
+                buf.extend(bytes(len(buf)))
+        with memoryview(buf) as view:
+            received = sock.recv_into(view[self.end:])
+        self.end += received
+        return received
+
+    def consume(self, offset):
+        """
+        Marks every byte before offset as consumed.
+        """
+        self.start = offset
+        if offset == self.end:
+            self.start = self.end = 0
+            if len(self.buf) > self.size:
+                del self.buf[self.size:]
+
+    def find(self, sub):
+        """
+        Returns the offset of sub in the unconsumed bytes or -1.
+        """
+        return self.buf.find(sub, self.start, self.end)
+
+    def take(self, offset):
+        """
+        Returns the unconsumed bytes before offset as bytes and consumes them.
+        """
+        data = bytes(self.buf[self.start:offset])
+        self.consume(offset)
+        return data
+
+def send_parts(sock, parts):
+    """
+    Write buffers to a blocking socket with sendmsg so they are not joined
+    first. Returns the bytes sent.
+
+    :param socket.socket sock: A blocking socket.
+    :param list parts: The buffers to send in order.
+    """
+    parts = [memoryview(part).cast('B') if not isinstance(part, bytes) else part for part in parts]
+    total = 0
+    while parts:
+        sent = sock.sendmsg(parts[:IOV_MAX])
+        total += sent
+        parts = advance(parts, sent)
+    return total
+
+def advance(parts, sent):
+    """
+    Returns the buffers left to send after sent bytes of parts went out.
+    """
+    done = 0
+    for part in parts:
+        size = len(part)
+        if sent < size:
+            break
+        sent -= size
+        done += 1
+    rest = parts[done:]
+    if sent:
+        rest[0] = memoryview(rest[0])[sent:]
+    return rest
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Value encodings for ncache clients.
+
+A serializer turns python values into the bytes stored on the server and
+back again. A Codec wraps a serializer and compresses values larger than a
+threshold. When compression is enabled every value starts with one flag
+byte saying how the rest was written, so readers decode values written with
+or without compression. Every client of a key must use the same encoding.
+
+    | flag | payload                         |
+    +------+---------------------------------+
+    |  B   | serialized, zlib compressed if  |
+    |      | flag is FLAG_ZLIB               |
+"""
+
+__author__ = "Niall O'Connor zechs dot marquie at gmail dot com"
+__version__ = '1.0'
+
+try:
+    import cPickle
+except ImportError: # python 3
+    import pickle as cPickle
+import marshal
+import zlib
+
+FLAG_PLAIN = b'\x00'
+FLAG_ZLIB = b'\x01'
+
+class Serializer(object):
+    """
+    Turns values into bytes and back. Subclasses implement dumps and loads.
+    """
+    name = None
+
+    def dumps(self, value):
+        """
+        Returns value as bytes.
+        """
+        raise NotImplementedError
+
+    def loads(self, data):
+        """
+        Returns the value held in data.
+
+        :param bytes data: Bytes made by dumps.
+        """
+        raise NotImplementedError
+
+class PickleSerializer(Serializer):
+    """
+    Any picklable value. The highest protocol is the fastest and smallest.
+    """
+    name = 'pickle'
+
+    def __init__(self, protocol=cPickle.HIGHEST_PROTOCOL):
+        """
+        :param int protocol: The pickle protocol values are written with.
+        """
+        super(PickleSerializer, self).__init__()
+        self.protocol = protocol
+
+    def dumps(self, value):
+        return cPickle.dumps(value, self.protocol)
+
+    def loads(self, data):
+        return cPickle.loads(data)
+
+class MarshalSerializer(Serializer):
+    """
+    Builtin types only, eg. dicts, lists, str and numbers, but faster than
+    pickle. The format may change between python versions.
+    """
+    name = 'marshal'
+
+    def dumps(self, value):
+        return marshal.dumps(value)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+class RawSerializer(Serializer):
+    """
+    Passes bytes through untouched, for values that are already encoded.
+    """
+    name = 'raw'
+
+    def dumps(self, value):
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            raise TypeError('RawSerializer stores bytes, not {0}'.format(type(value).__name__))
+        return bytes(value)
+
+    def loads(self, data):
+        return bytes(data)
+
+class TextSerializer(Serializer):
+    """
+    str values stored as latin-1 text, readable by text commands.
+    """
+    name = 'text'
+
+    def dumps(self, value):
+        return value.encode('latin-1') if isinstance(value, str) else bytes(value)
+
+    def loads(self, data):
+        return bytes(data).decode('latin-1')
+
+SERIALIZERS = dict((cls.name, cls,) for cls in (PickleSerializer, MarshalSerializer, RawSerializer, TextSerializer))
+
+def get_serializer(serializer):
+    """
+    Returns a Serializer given one or the name of a builtin serializer.
+
+    :param serializer: A Serializer or one of pickle, marshal, raw or text.
+    """
+    if isinstance(serializer, str):
+        if serializer not in SERIALIZERS:
+            raise ValueError('Unknown serializer {0}. Not one of {1}'.format(serializer, ', '.join(sorted(SERIALIZERS))))
+        return SERIALIZERS[serializer]()
+    return serializer
+
+class Codec(object):
+    """
+    Encodes values for the server with a serializer, compressing those whose
+    serialized size reaches compress_threshold.
+
+    usage:
+        >>> codec = Codec('pickle', compress_threshold=1024)
+        >>> codec.decode(codec.encode({'rows': list(range(1000))}))['rows'][-1]
+        999
+    """
+    def __init__(self, serializer='pickle', compress_threshold=None, compress_level=1):
+        """
+        :param serializer: A Serializer or one of pickle, marshal, raw or text.
+        :param int compress_threshold: Bytes from which values are compressed, None writes no flag and never compresses.
+        :param int compress_level: zlib level, 1 is fastest and 9 smallest.
+        """
+        super(Codec, self).__init__()
+        self.serializer = get_serializer(serializer)
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def encode(self, value):
+        """
+        Returns the bytes stored on the server for value.
+        """
+        data = self.serializer.dumps(value)
+        if self.compress_threshold is None:
+            return data
+        if len(data) >= self.compress_threshold:
+            compressed = zlib.compress(data, self.compress_level)
+            # incompressible values are kept as they are
+            if len(compressed) < len(data):
+                return FLAG_ZLIB + compressed
+        return FLAG_PLAIN + data
+
+    def decode(self, data):
+        """
+        Returns the value held in bytes read from the server.
+        """
+        if self.compress_threshold is None:
+            return self.serializer.loads(data)
+        flag = data[:1]
+        # a view skips copying the payload after the flag
+        payload = memoryview(data)[1:]
+        if flag == FLAG_ZLIB:
+            return self.serializer.loads(zlib.decompress(payload))
+        if flag == FLAG_PLAIN:
+            return self.serializer.loads(payload)
+        raise ValueError('ERROR: Unknown value flag {0!r}'.format(flag))
@@ -0,0 +1,410 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+A cache table in shared memory, served by many worker processes at once.
+
+The table is a fixed number of buckets of a fixed number of slots held in one
+multiprocessing.shared_memory block, so every worker forked by the server
+reads and writes the same keys. A key hashes to one bucket and lives in any
+of its slots. Every slot reserves room for the largest key and value allowed,
+so the table never grows and its memory is fixed when it is created.
+
+    | state | kind | key length | value length | expires | used | created | version | key ... | value ... |
+    +-------+------+------------+--------------+---------+------+---------+---------+---------+-----------+
+    |   B   |  B   |     H      |      I       |    q    |  q   |    q    |    Q    | max_key | max_value |
+
+expires is the tick the key expires on, or -1 for perm keys, and used the
+tick it was last read or written. Ticks come from the system wide monotonic
+clock so every process agrees on them.
+
+Buckets are guarded by lock stripes, multiprocessing RLocks made before the
+workers fork, so writes to different buckets rarely wait for each other.
+The key count and version counter of each stripe sit before the slots.
+
+When every slot of a bucket is taken a new key replaces an expired key if
+there is one, then the least recently used perm key, then the ttl key
+expiring soonest, the order manage_memory evicts keys from a Store.
+"""
+
+__author__ = "Niall O'Connor zechs dot marquie at gmail dot com"
+__version__ = '1.0'
+
+import multiprocessing
+from   multiprocessing import shared_memory
+import random
+import struct
+import time
+import zlib
+
+from   ncache_store import Entry, now_ticks, seconds_to_ticks
+
+SLOT = struct.Struct('=BBHIqqqQ')
+# the used tick alone, rewritten on every read
+USED = struct.Struct('=q')
+USED_OFFSET = 16
+
+SLOT_EMPTY = 0
+SLOT_USED = 1
+
+KIND_BYTES = 0
+KIND_TEXT = 1
+
+PERM = -1
+
+class SharedTable(object):
+    """
+    A fixed size table of keys in shared memory with the interface of
+    ncache_store.Store used by the server. Watchers and the hit and eviction
+    counters belong to the process using the table, the keys to every process.
+
+    usage:
+        >>> table = SharedTable(slots=1024)
+        >>> table.set('k1', 'v1', ttl=10)
+        >>> table.get('k1')
+        'v1'
+    """
+    def __init__(self, slots=65536, ways=8, max_key=250, max_value=4096, stripes=64):
+        """
+        :param int slots: The most keys held, rounded down to whole buckets.
+        :param int ways: Slots per bucket. More ways evict closer to the Store's order but make lookups longer.
+        :param int max_key: The longest key in bytes.
+        :param int max_value: The largest value in bytes.
+        :param int stripes: Locks the buckets are shared between.
+        """
+        super(SharedTable, self).__init__()
+        self.ways = ways
+        self.buckets = max(slots // ways, 1)
+        self.max_key = max_key
+        self.max_value = max_value
+        self.slot_size = self.slot_bytes(max_key, max_value)
+        self.stripes = min(stripes, self.buckets)
+        self.slots_offset = 2 * 8 * self.stripes
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=self.slots_offset + self.buckets * ways * self.slot_size)
+        self.buf = self.memory.buf
+        # keys and the last version given per stripe. Versions are
+        # <counter> * stripes + stripe so no two stripes give the same one.
+        self.counts = self.buf[:8 * self.stripes].cast('Q')
+        self.versions = self.buf[8 * self.stripes:self.slots_offset].cast('Q')
+        seed = int(time.time() * 1000000)
+        for stripe in range(self.stripes):
+            self.versions[stripe] = seed
+        self.locks = [multiprocessing.RLock() for _ in range(self.stripes)]
+        self.watchers = []
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.lru_evictions = 0
+        self.ttl_evictions = 0
+        self.eviction_seconds = 0.0
+        # the next bucket the expiry cycle of this process looks at
+        self.cursor = None
+
+    @staticmethod
+    def slot_bytes(max_key, max_value):
+        """
+        Returns the bytes one slot takes for keys and values up to these sizes.
+        """
+        return SLOT.size + max_key + max_value
+
+    @property
+    def capacity(self):
+        return self.buckets * self.ways
+
+    def __len__(self):
+        return sum(self.counts)
+
+    @property
+    def bytes(self):
+        """
+        The bytes reserved by the slots holding keys.
+        """
+        return len(self) * self.slot_size
+
+    @property
+    def evictions(self):
+        return self.lru_evictions + self.ttl_evictions
+
+    def _locate(self, key):
+        """
+        Returns the key as bytes, its bucket and the stripe guarding it.
+        """
+        data = key.encode('latin-1')
+        bucket = zlib.crc32(data) % self.buckets
+        return data, bucket, bucket % self.stripes
+
+    def _find(self, data, bucket):
+        """
+        Returns the offset of the slot holding the key data in bucket or None.
+        """
+        buf = self.buf
+        size = len(data)
+        offset = self.slots_offset + bucket * self.ways * self.slot_size
+        for _ in range(self.ways):
+            if buf[offset] == SLOT_USED and SLOT.unpack_from(buf, offset)[2] == size:
+                start = offset + SLOT.size
+                if buf[start:start + size] == data:
+                    return offset
+            offset += self.slot_size
+        return None
+
+    def _read_key(self, offset):
+        key_len = SLOT.unpack_from(self.buf, offset)[2]
+        start = offset + SLOT.size
+        return bytes(self.buf[start:start + key_len]).decode('latin-1')
+
+    def _remove(self, key, offset, stripe):
+        """
+        Empties a slot and tells the watchers.
+        """
+        self.buf[offset] = SLOT_EMPTY
+        self.counts[stripe] -= 1
+        for watcher in self.watchers:
+            watcher.on_delete(key)
+
+    def _next_version(self, stripe):
+        self.versions[stripe] += 1
+        return self.versions[stripe] * self.stripes + stripe
+
+    def lock(self, key):
+        """
+        Returns the lock to hold while reading and then writing key, eg. for
+        INCR, so no other process changes the key in between.
+        """
+        return self.locks[self._locate(key)[2]]
+
+    def __contains__(self, key):
+        data, bucket, stripe = self._locate(key)
+        with self.locks[stripe]:
+            offset = self._find(data, bucket)
+            if offset is None:
+                return False
+            expires = SLOT.unpack_from(self.buf, offset)[4]
+            return expires == PERM or expires > now_ticks()
+
+    def get(self, key):
+        """
+        Returns the value of a key or None if it is missing, see Store.get.
+        """
+        entry = self.get_entry(key)
+        return None if entry is None else entry.value
+
+    def get_entry(self, key):
+        """
+        Returns a copy of the live Entry of a key or None. An expired key is
+        deleted when found and reading a key makes it the most recently used.
+
+        :param str key: The key to look up.
+        """
+        data, bucket, stripe = self._locate(key)
+        buf = self.buf
+        with self.locks[stripe]:
+            offset = self._find(data, bucket)
+            if offset is None:
+                self.misses += 1
+                return None
+            _, kind, key_len, value_len, expires, _, created, version = SLOT.unpack_from(buf, offset)
+            now = now_ticks()
+            if expires != PERM and expires <= now:
+                self._remove(key, offset, stripe)
+                self.expired += 1
+                self.misses += 1
+                return None
+            USED.pack_into(buf, offset + USED_OFFSET, now)
+            start = offset + SLOT.size + key_len
+            value = bytes(buf[start:start + value_len])
+        self.hits += 1
+        entry = Entry(key, value.decode('latin-1') if kind == KIND_TEXT else value,
+                      None if expires == PERM else expires, created)
+        entry.version = version
+        return entry
+
+    def _payload(self, data, value):
+        """
+        Returns (kind, value as bytes), checking both fit in a slot.
+        """
+        kind = KIND_TEXT if isinstance(value, str) else KIND_BYTES
+        payload = value.encode('latin-1') if kind == KIND_TEXT else value
+        if len(data) > self.max_key:
+            raise ValueError('ERROR: Key is {0} bytes, the most a slot holds is {1}'.format(len(data), self.max_key))
+        if len(payload) > self.max_value:
+            raise ValueError('ERROR: Value is {0} bytes, the most a slot holds is {1}'.format(
+                len(payload), self.max_value))
+        return kind, payload
+
+    def _write(self, offset, data, kind, payload, expires, used, created, version):
+        buf = self.buf
+        SLOT.pack_into(buf, offset, SLOT_USED, kind, len(data), len(payload), expires, used, created, version)
+        start = offset + SLOT.size
+        buf[start:start + len(data)] = data
+        start += len(data)
+        buf[start:start + len(payload)] = payload
+
+    def _free_slot(self, bucket, stripe, now):
+        """
+        Returns the offset of an empty slot in bucket, evicting a key if
+        every slot is taken.
+        """
+        buf = self.buf
+        offset = self.slots_offset + bucket * self.ways * self.slot_size
+        expired = lru = soonest = None
+        for _ in range(self.ways):
+            if buf[offset] == SLOT_EMPTY:
+                self.counts[stripe] += 1
+                return offset
+            expires, used = SLOT.unpack_from(buf, offset)[4:6]
+            if expires == PERM:
+                if lru is None or used < lru[0]:
+                    lru = (used, offset,)
+            elif expires <= now:
+                expired = offset
+            elif soonest is None or expires < soonest[0]:
+                soonest = (expires, offset,)
+            offset += self.slot_size
+        started = time.time()
+        if expired is not None:
+            victim = expired
+            self.expired += 1
+        elif lru is not None:
+            victim = lru[1]
+            self.lru_evictions += 1
+        else:
+            victim = soonest[1]
+            self.ttl_evictions += 1
+        # the slot is handed straight to the new key so the count is unchanged
+        self.counts[stripe] += 1
+        self._remove(self._read_key(victim), victim, stripe)
+        self.eviction_seconds += time.time() - started
+        return victim
+
+    def set(self, key, value, ttl=None):
+        """
+        Sets a key, replacing any existing entry, see Store.set.
+
+        :param str key: The key we are setting.
+        :param value: The value we are setting, str or bytes.
+        :param float ttl: The time to live in seconds. Optional.
+        :returns Entry: A copy of the entry now holding the value.
+        """
+        data, bucket, stripe = self._locate(key)
+        kind, payload = self._payload(data, value)
+        now = now_ticks()
+        expires = PERM if ttl is None else now + seconds_to_ticks(ttl)
+        with self.locks[stripe]:
+            offset = self._find(data, bucket)
+            if offset is None:
+                offset = self._free_slot(bucket, stripe, now)
+            version = self._next_version(stripe)
+            self._write(offset, data, kind, payload, expires, now, now, version)
+            entry = Entry(key, value, None if expires == PERM else expires, now)
+            entry.version = version
+            for watcher in self.watchers:
+                watcher.on_set(key, entry)
+        return entry
+
+    def replace_value(self, entry, value):
+        """
+        Gives a live entry a new value, keeping its expiry and recency. Hold
+        lock(key) from get_entry until this returns.
+
+        :param Entry entry: An entry returned by get_entry.
+        :param value: The new value.
+        """
+        key = entry.key
+        data, bucket, stripe = self._locate(key)
+        kind, payload = self._payload(data, value)
+        with self.locks[stripe]:
+            offset = self._find(data, bucket)
+            if offset is None:
+                raise KeyError(key)
+            _, _, _, _, expires, used, created, _ = SLOT.unpack_from(self.buf, offset)
+            version = self._next_version(stripe)
+            self._write(offset, data, kind, payload, expires, used, created, version)
+            entry.value = value
+            entry.version = version
+            for watcher in self.watchers:
+                watcher.on_set(key, entry)
+
+    def delete(self, key):
+        """
+        Removes a key.
+
+        :param str key: The key to delete.
+        :returns bool: True if the key existed.
+        """
+        data, bucket, stripe = self._locate(key)
+        with self.locks[stripe]:
+            offset = self._find(data, bucket)
+            if offset is None:
+                return False
+            self._remove(key, offset, stripe)
+            return True
+
+    def expire_due(self, max_seconds):
+        """
+        Removes expired keys, scanning buckets from where the last call of
+        this process stopped until max_seconds have been spent or every
+        bucket has been seen. Each process starts at a random bucket so
+        workers share the scanning.
+
+        :param float max_seconds: The time budget.
+        :returns tuple: (<keys removed>, <True if the budget ran out while expired keys were being found>).
+        """
+        if self.cursor is None:
+            self.cursor = random.randrange(self.buckets)
+        deadline = time.perf_counter() + max_seconds
+        buf = self.buf
+        removed = 0
+        now = now_ticks()
+        for scanned in range(1, self.buckets + 1):
+            bucket = self.cursor
+            self.cursor = (bucket + 1) % self.buckets
+            stripe = bucket % self.stripes
+            offset = self.slots_offset + bucket * self.ways * self.slot_size
+            with self.locks[stripe]:
+                for _ in range(self.ways):
+                    if buf[offset] == SLOT_USED:
+                        expires = SLOT.unpack_from(buf, offset)[4]
+                        if expires != PERM and expires <= now:
+                            self._remove(self._read_key(offset), offset, stripe)
+                            removed += 1
+                    offset += self.slot_size
+            if not scanned & 63 and time.perf_counter() >= deadline:
+                self.expired += removed
+                return removed, removed > 0
+        self.expired += removed
+        return removed, False
+
+    def clear(self):
+        """
+        Removes every key. Watchers are not told, as with Store.clear.
+        """
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            buf = self.buf
+            offset = self.slots_offset
+            for _ in range(self.buckets * self.ways):
+                buf[offset] = SLOT_EMPTY
+                offset += self.slot_size
+            for stripe in range(self.stripes):
+                self.counts[stripe] = 0
+        finally:
+            for lock in reversed(self.locks):
+                lock.release()
+
+    def close(self):
+        """
+        Unmap the table from this process.
+        """
+        self.counts.release()
+        self.versions.release()
+        self.buf = None
+        self.memory.close()
+
+    def unlink(self):
+        """
+        Free the shared memory once every process has closed the table.
+        """
+        self.memory.unlink()
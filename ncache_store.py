@@ -0,0 +1,506 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Storage engine for ncache.
+
+Every key lives in a single dict as one Entry. An entry holds its value, its
+expiry and creation time as integer monotonic ticks and, for perm keys, links
+into an intrusive recency list used for least recently used eviction. ttl keys
+are indexed in a min-heap by expiry.
+"""
+
+__author__ = "Niall O'Connor zechs dot marquie at gmail dot com"
+__version__ = '1.0'
+
+from   contextlib import nullcontext
+import heapq
+from   sys import getsizeof
+import time
+
+from   ncache_policy import PermLRUPolicy
+
+# ticks are milliseconds on the monotonic clock
+TICKS_PER_SECOND = 1000
+
+def now_ticks():
+    """
+    Returns the current monotonic time in ticks.
+    """
+    return time.monotonic_ns() // 1000000
+
+def seconds_to_ticks(seconds):
+    """
+    Converts a number of seconds into ticks.
+
+    :param float seconds: A duration in seconds.
+    """
+    return int(seconds * TICKS_PER_SECOND)
+
+class Entry(object):
+    """
+    A single cache entry.
+
+    expires is the tick the entry expires on or None for a perm entry. version
+    changes on every write and is the token compare and swap checks. prev and
+    next link perm entries into the recency list, they are None for ttl
+    entries.
+    """
+    __slots__ = ('key', 'value', 'expires', 'created', 'version', 'prev', 'next')
+
+    def __init__(self, key=None, value=None, expires=None, created=0):
+        self.key = key
+        self.value = value
+        self.expires = expires
+        self.created = created
+        self.version = 0
+        self.prev = None
+        self.next = None
+
+# Bytes an entry costs beyond its key and value. The Entry itself, its slot
+# in the entries dict (hash, key and value pointers with spare capacity) and
+# an expiry heap tuple for ttl keys.
+DICT_SLOT = 48
+ENTRY_OVERHEAD = getsizeof(Entry()) + DICT_SLOT + getsizeof((0, '',)) + 8
+
+UNLOCKED = nullcontext()
+
+class Store(object):
+    """
+    The single table storage engine.
+
+    usage:
+        >>> store = Store()
+        >>> store.set('k1', 'v1', ttl=10)
+        >>> store.get('k1')
+        'v1'
+    """
+    def __init__(self, policy=None):
+        """
+        :param EvictionPolicy policy: Chooses the keys evict removes, the least recently used perm keys if omitted.
+        """
+        super(Store, self).__init__()
+        self.entries = {}
+        # min-heap of (<expiry tick>, key). Entries are not removed when a key
+        # is overwritten or deleted, instead they are recognised as stale when
+        # popped because the entry no longer holds that expiry.
+        self.expiry_index = []
+        # sentinel of the circular recency list of perm entries. head.next is
+        # the least recently used entry and head.prev the most recently used.
+        self.head = Entry()
+        self.head.prev = self.head.next = self.head
+        # bytes used by every entry
+        self.bytes = 0
+        # hit rate and eviction cost counters
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.lru_evictions = 0
+        self.ttl_evictions = 0
+        self.policy_evictions = 0
+        self.eviction_seconds = 0.0
+        # objects with on_set(key, entry) and on_delete(key) told of every change
+        self.watchers = []
+        # the eviction policy and, if it counts reads, the policy told of every get
+        self.policy = None
+        self.reads = None
+        self.set_policy(policy or PermLRUPolicy())
+        # the last version given to an entry. Starting from the wall clock in
+        # microseconds keeps versions issued before a restart from matching.
+        self.version = int(time.time() * 1000000)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def evictions(self):
+        return self.lru_evictions + self.ttl_evictions + self.policy_evictions
+
+    def set_policy(self, policy):
+        """
+        Replaces the eviction policy, see ncache_policy.
+
+        :param EvictionPolicy policy: The new policy.
+        """
+        if self.policy in self.watchers:
+            self.watchers.remove(self.policy)
+        self.policy = policy
+        policy.attach(self)
+        self.reads = policy if policy.counts_reads else None
+        if policy.counts_reads:
+            self.watchers.append(policy)
+
+    def evict(self, count):
+        """
+        Removes up to count keys chosen by the eviction policy.
+
+        :param int count: The number of keys to remove.
+        :returns int: The number of keys removed.
+        """
+        return self.policy.evict(count)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def lock(self, key):
+        """
+        Returns the lock to hold while reading and then writing key. A Store
+        is only used by one thread so there is nothing to lock.
+        """
+        return UNLOCKED
+
+    def entry_size(self, key, entry):
+        """
+        Returns the bytes accounted to a single entry. getsizeof of a str or
+        bytes is O(1) so the size is recalculated on delete rather than stored.
+
+        :param str key: The entry key.
+        :param Entry entry: The entry.
+        """
+        return getsizeof(key) + getsizeof(entry.value) + ENTRY_OVERHEAD
+
+    def _link(self, entry):
+        """
+        Append a perm entry to the most recently used end of the recency list.
+        """
+        head = self.head
+        last = head.prev
+        last.next = entry
+        entry.prev = last
+        entry.next = head
+        head.prev = entry
+
+    def _unlink(self, entry):
+        """
+        Remove a perm entry from the recency list.
+        """
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+        entry.prev = entry.next = None
+
+    def get(self, key):
+        """
+        Returns the value of a key or None if it is missing. An expired key is
+        deleted when found and a perm key becomes the most recently used.
+
+        :param str key: The key to look up.
+        """
+        entry = self.get_entry(key)
+        return None if entry is None else entry.value
+
+    def get_entry(self, key):
+        """
+        Returns the live Entry of a key or None, see get.
+
+        :param str key: The key to look up.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            if self.reads is not None:
+                self.reads.on_miss(key)
+            return None
+        expires = entry.expires
+        if expires is None:
+            # key is permanent, move it to the most recently used end
+            prev = entry.prev
+            nxt = entry.next
+            prev.next = nxt
+            nxt.prev = prev
+            head = self.head
+            last = head.prev
+            last.next = entry
+            entry.prev = last
+            entry.next = head
+            head.prev = entry
+        elif expires <= now_ticks():
+            # ttl is in the past so the key should be deleted
+            self.delete(key)
+            self.expired += 1
+            self.misses += 1
+            if self.reads is not None:
+                self.reads.on_miss(key)
+            return None
+        self.hits += 1
+        if self.reads is not None:
+            self.reads.on_read(key, entry)
+        return entry
+
+    def set(self, key, value, ttl=None):
+        """
+        Sets a key, replacing any existing entry.
+
+        :param str key: The key we are setting.
+        :param value: The value we are setting.
+        :param float ttl: The time to live in seconds. Optional.
+        :returns Entry: The entry now holding the value.
+        """
+        now = now_ticks()
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = Entry(key)
+        else:
+            self.bytes -= self.entry_size(key, entry)
+            if entry.expires is None:
+                self._unlink(entry)
+        entry.value = value
+        entry.created = now
+        self.version += 1
+        entry.version = self.version
+        if ttl is None:
+            entry.expires = None
+            self._link(entry)
+        else:
+            entry.expires = now + seconds_to_ticks(ttl)
+            self._index_expiry(key, entry.expires)
+        self.bytes += self.entry_size(key, entry)
+        for watcher in self.watchers:
+            watcher.on_set(key, entry)
+        return entry
+
+    def replace_value(self, entry, value):
+        """
+        Gives a live entry a new value, keeping its expiry and recency.
+
+        :param Entry entry: An entry returned by get_entry.
+        :param value: The new value.
+        """
+        key = entry.key
+        self.bytes -= self.entry_size(key, entry)
+        entry.value = value
+        self.version += 1
+        entry.version = self.version
+        self.bytes += self.entry_size(key, entry)
+        for watcher in self.watchers:
+            watcher.on_set(key, entry)
+
+    def _index_expiry(self, key, expires):
+        """
+        Records a ttl key in expiry_index. Stale entries left behind by
+        overwritten or deleted keys are purged once they outnumber live keys.
+        """
+        index = self.expiry_index
+        heapq.heappush(index, (expires, key,))
+        if len(index) > 2 * len(self.entries) + 1024:
+            index[:] = [(entry.expires, k,) for k, entry in self.entries.items()
+                        if entry.expires is not None]
+            heapq.heapify(index)
+
+    def delete(self, key):
+        """
+        Removes a key and subtracts its bytes. ttl keys leave a stale
+        expiry_index entry that is skipped when popped.
+
+        :param str key: The key to delete.
+        :returns bool: True if the key existed.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        if entry.expires is None:
+            self._unlink(entry)
+        self.bytes -= self.entry_size(key, entry)
+        for watcher in self.watchers:
+            watcher.on_delete(key)
+        return True
+
+    def evict_lru(self, count):
+        """
+        Removes up to count of the least recently used perm keys. Each eviction
+        takes the front of the recency list so the cost is O(count).
+
+        :param int count: The number of keys to remove.
+        :returns int: The number of keys removed.
+        """
+        started = time.time()
+        head = self.head
+        removed = 0
+        while removed < count and head.next is not head:
+            self.delete(head.next.key)
+            removed += 1
+        self.lru_evictions += removed
+        self.eviction_seconds += time.time() - started
+        return removed
+
+    def expire_before(self, tick):
+        """
+        Removes all ttl keys expiring before tick. Only expiry_index entries
+        earlier than tick are visited so the cost is proportional to the
+        number of keys removed, not the size of the cache.
+
+        :param int tick: Keys expiring before this tick are removed.
+        :returns int: The number of keys removed.
+        """
+        started = time.time()
+        removed = self._expire(tick - 1)
+        self.ttl_evictions += removed
+        self.eviction_seconds += time.time() - started
+        return removed
+
+    def expire_due(self, max_seconds):
+        """
+        Removes keys that have expired, cheapest first from the front of
+        expiry_index, stopping once max_seconds have been spent.
+
+        :param float max_seconds: The time budget.
+        :returns tuple: (<keys removed>, <True if expired keys remain>).
+        """
+        now = now_ticks()
+        removed = self._expire(now, time.perf_counter() + max_seconds)
+        self.expired += removed
+        index = self.expiry_index
+        return removed, bool(index) and index[0][0] <= now
+
+    def _expire(self, tick, deadline=None):
+        """
+        Pops expiry_index entries expiring on or before tick, deleting their
+        keys unless the entry is stale. With a deadline the clock is checked
+        every 64 entries and popping stops once it passes.
+        """
+        index = self.expiry_index
+        entries = self.entries
+        removed = 0
+        popped = 0
+        while index and index[0][0] <= tick:
+            expires, key = heapq.heappop(index)
+            entry = entries.get(key)
+            if entry is not None and entry.expires == expires:
+                self.delete(key)
+                removed += 1
+            popped += 1
+            if deadline is not None and not popped & 63 and time.perf_counter() >= deadline:
+                break
+        return removed
+
+    def next_expiry(self):
+        """
+        Returns the tick of the earliest ttl key, possibly one since removed,
+        or None if there are no ttl keys.
+        """
+        return self.expiry_index[0][0] if self.expiry_index else None
+
+    def clear(self):
+        """
+        Removes every key.
+        """
+        self.entries.clear()
+        del self.expiry_index[:]
+        self.head.prev = self.head.next = self.head
+        self.bytes = 0
+        self.policy.clear()
+
+class KeyIndex(object):
+    """
+    Secondary indexes of a store by tag and by key prefix, kept in step as a
+    store watcher so every set, delete, expiry and eviction updates them.
+
+    A key belongs to every prefix ending in separator, eg. 'user:42:name'
+    belongs to 'user:' and 'user:42:'. Keys keep their tags until they are
+    removed from the store.
+
+    usage:
+        >>> index = KeyIndex()
+        >>> store.watchers.append(index)
+        >>> store.set('user:42:name', 'niall')
+        >>> index.tag('user:42:name', ['users'])
+        >>> index.keys_with_tag('users')
+        ['user:42:name']
+    """
+    def __init__(self, separator=':'):
+        """
+        :param str separator: Prefixes ending in this are indexed.
+        """
+        super(KeyIndex, self).__init__()
+        self.separator = separator
+        # prefix -> set of keys
+        self.prefixes = {}
+        # tag -> set of keys, key -> set of tags
+        self.tags = {}
+        self.key_tags = {}
+
+    def _prefixes(self, key):
+        """
+        Yields the indexed prefixes of key.
+        """
+        separator = self.separator
+        end = key.find(separator)
+        while end != -1:
+            end += len(separator)
+            yield key[:end]
+            end = key.find(separator, end)
+
+    def on_set(self, key, entry):
+        """
+        Store watcher, indexes the prefixes of a key.
+        """
+        if self.separator in key:
+            prefixes = self.prefixes
+            for prefix in self._prefixes(key):
+                keys = prefixes.get(prefix)
+                if keys is None:
+                    keys = prefixes[prefix] = set()
+                keys.add(key)
+
+    def on_delete(self, key):
+        """
+        Store watcher, drops a key from every index.
+        """
+        if self.separator in key:
+            prefixes = self.prefixes
+            for prefix in self._prefixes(key):
+                keys = prefixes.get(prefix)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del prefixes[prefix]
+        tags = self.key_tags.pop(key, None)
+        if tags:
+            for tag in tags:
+                keys = self.tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.tags[tag]
+
+    def tag(self, key, tags):
+        """
+        Adds tags to a key. The key must be in the store.
+
+        :param str key: The key to tag.
+        :param list tags: The tags.
+        """
+        key_tags = self.key_tags.get(key)
+        if key_tags is None:
+            key_tags = self.key_tags[key] = set()
+        for tag in tags:
+            key_tags.add(tag)
+            keys = self.tags.get(tag)
+            if keys is None:
+                keys = self.tags[tag] = set()
+            keys.add(key)
+
+    def keys_with_tag(self, tag):
+        """
+        Returns the keys tagged with tag.
+        """
+        return list(self.tags.get(tag, ()))
+
+    def keys_with_prefix(self, prefix, store):
+        """
+        Returns the keys starting with prefix. A prefix ending in separator is
+        read from the index, any other prefix scans the keys of store.
+
+        :param str prefix: The prefix.
+        :param Store store: The store indexed.
+        """
+        if prefix.endswith(self.separator):
+            return list(self.prefixes.get(prefix, ()))
+        return [key for key in store.entries if key.startswith(prefix)]
+
+    def clear(self):
+        """
+        Empties every index, eg. when the store is cleared.
+        """
+        self.prefixes.clear()
+        self.tags.clear()
+        self.key_tags.clear()
@@ -6,19 +6,32 @@
 __author__ = "Niall O'Connor"
 
 from   datetime import datetime, timedelta
+import bench_ncache
 import ncache
+from   ncache_persist import (KIND_DELETE, KIND_TEXT, ReplicationFeed, WriteLog, load_snapshot, read_log,
+                          read_record, repair_log, write_snapshot)
+from   ncache_policy import make_policy
+import ncache_protocol as protocol
+from   ncache_shared import SharedTable
+from   ncache_store import KeyIndex, Store, now_ticks
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
 class TestNCacheGetOrTimeout(unittest.TestCase):
     """
     ncache.get_or_timeout works the following way.
 
-    ncache.cahce_values   contains key->value   pairs
-    ncache.cache_timeouts contains key->timeout pairs
+    ncache.store contains key->entry pairs, each entry has a value and an expiry tick
 
-    There are two flavours of timeout
-    1. ('ttl',  <ttl datetime>)
-    2. ('perm', <created time>)
+    There are two flavours of entry
+    1. ttl,  expires on <expiry tick>
+    2. perm, expires is None
 
     Specification.
 
@@ -28,13 +41,14 @@ class TestNCacheGetOrTimeout(unittest.TestCase):
     |'k2' |    'ttl'     | in past      | 'NOT FOUND' |
     |'k3' |    'perm'    | in past      |  value      |
     """
+    def setUp(self):
+        ncache.flush_all()
 
     def test_get_or_timeout_fresh_key(self):
         """
         In this case a key has a time to live in the future and should return data.
         """
-        ncache.cache_timeouts['TEST1'] = ('ttl', datetime.now() + timedelta(days=10),)
-        ncache.cache_values['TEST1'] = 'some test data'
+        ncache._set_key('TEST1', 'some test data', ttl=timedelta(days=10).total_seconds())
 
         data = ncache._get_or_timeout('TEST1')
         self.assertEqual(data, 'some test data')
@@ -43,8 +57,7 @@ class TestNCacheGetOrTimeout(unittest.TestCase):
         """
         In this case a key has a time to live in the past and should return NOT FOUND.
         """
-        ncache.cache_timeouts['TEST1'] = ('ttl', datetime.now() - timedelta(days=10),)
-        ncache.cache_values['TEST1'] = 'some test data'
+        ncache._set_key('TEST1', 'some test data', ttl=-timedelta(days=10).total_seconds())
 
         data = ncache._get_or_timeout('TEST1')
         self.assertEqual(data, 'NOT FOUND')
@@ -53,8 +66,7 @@ class TestNCacheGetOrTimeout(unittest.TestCase):
         """
         In this case a key is perm and should return data.
         """
-        ncache.cache_timeouts['TEST1'] = ('perm', datetime.now() - timedelta(days=10),)
-        ncache.cache_values['TEST1'] = 'some test data'
+        ncache._set_key('TEST1', 'some test data')
 
         data = ncache._get_or_timeout('TEST1')
         self.assertEqual(data, 'some test data')
@@ -73,29 +85,29 @@ class TestNCacheClearKeys(unittest.TestCase):
 
 
     """
+    def setUp(self):
+        ncache.flush_all()
+
     def test_clear_perm_keys(self):
         """
-        Given the following
+        Given the following perm keys set in the order k2, k1, k3 and then read
 
-        | key | timeout type |    date      |
-        +-----+--------------+--------------+
-        |'k1' |    'perm'    | now - 100sec |
-        |'k2' |    'perm'    | now - 200sec |
-        |'k3' |    'perm'    | now - 10sec  |
+        | key | last read |
+        +-----+-----------+
+        |'k2' |  first    |
+        |'k1' |  second   |
+        |'k3' |  third    |
 
-        order of deletion should be k2, then k1, then k3
+        order of deletion is least recently used first, k2, then k1, then k3
         """
-        ncache.cache_timeouts['k1'] = ('perm', datetime.now() - timedelta(seconds=100),)
-        ncache.cache_values['k1']   = 'some test data'
-        ncache.cache_timeouts['k2'] = ('perm', datetime.now() - timedelta(seconds=200),)
-        ncache.cache_values['k2']   = 'some test data'
-        ncache.cache_timeouts['k3'] = ('perm', datetime.now() - timedelta(seconds=10),)
-        ncache.cache_values['k3']   = 'some test data'
+        ncache._set_key('k2', 'some test data')
+        ncache._set_key('k1', 'some test data')
+        ncache._set_key('k3', 'some test data')
 
-        data = ncache._get_or_timeout('k1')
-        self.assertEqual(data, 'some test data')
         data = ncache._get_or_timeout('k2')
         self.assertEqual(data, 'some test data')
+        data = ncache._get_or_timeout('k1')
+        self.assertEqual(data, 'some test data')
         data = ncache._get_or_timeout('k3')
         self.assertEqual(data, 'some test data')
 
@@ -123,6 +135,20 @@ class TestNCacheClearKeys(unittest.TestCase):
         data = ncache._get_or_timeout('k3')
         self.assertEqual(data, 'NOT FOUND')
 
+    def test_clear_perm_keys_frequently_read_survive(self):
+        """
+        A key read after newer keys were written is not the next to go.
+        """
+        ncache._set_key('k1', 'some test data')
+        ncache._set_key('k2', 'some test data')
+        ncache._set_key('k3', 'some test data')
+        ncache._get_or_timeout('k1')
+
+        evictions = ncache.store.evictions
+        ncache._clear_perm_keys(2)
+        self.assertEqual(list(ncache.store.entries), ['k1'])
+        self.assertEqual(ncache.store.evictions, evictions + 2)
+
     def test_clear_ttl_keys(self):
         """
         Given the following
@@ -137,12 +163,9 @@ class TestNCacheClearKeys(unittest.TestCase):
         step 5 mins or 300 seconds forward to remove k1
         step 5 mins or 300 seconds forward to remove k3 and k2
         """
-        ncache.cache_timeouts['k1'] = ('ttl', datetime.now() + timedelta(seconds=360),)
-        ncache.cache_values['k1']   = 'some test data'
-        ncache.cache_timeouts['k2'] = ('ttl', datetime.now() + timedelta(seconds=640),)
-        ncache.cache_values['k2']   = 'some test data'
-        ncache.cache_timeouts['k3'] = ('ttl', datetime.now() + timedelta(seconds=720),)
-        ncache.cache_values['k3']   = 'some test data'
+        ncache._set_key('k1', 'some test data', ttl=360)
+        ncache._set_key('k2', 'some test data', ttl=640)
+        ncache._set_key('k3', 'some test data', ttl=720)
 
         data = ncache._get_or_timeout('k1')
         self.assertEqual(data, 'some test data')
@@ -178,6 +201,376 @@ class TestNCacheClearKeys(unittest.TestCase):
         data = ncache._get_or_timeout('k3')
         self.assertEqual(data, 'NOT FOUND')
 
+    def test_clear_ttl_keys_overwritten(self):
+        """
+        A ttl key overwritten with a later expiry or made perm is only removed
+        according to its current timeout.
+        """
+        ncache._set_key('k1', 'old data', ttl=10)
+        ncache._set_key('k1', 'new data', ttl=1000)
+        ncache._set_key('k2', 'old data', ttl=10)
+        ncache._set_key('k2', 'new data')
+
+        ncache._clear_ttl_keys(datetime.now() + timedelta(seconds=300))
+        self.assertEqual(ncache._get_or_timeout('k1'), 'new data')
+        self.assertEqual(ncache._get_or_timeout('k2'), 'new data')
+
+        ncache._clear_ttl_keys(datetime.now() + timedelta(seconds=1300))
+        self.assertEqual(ncache._get_or_timeout('k1'), 'NOT FOUND')
+        self.assertEqual(ncache._get_or_timeout('k2'), 'new data')
+
+    def test_manage_memory_ttl_keys(self):
+        """
+        With no perm keys left manage_memory removes ttl keys nearest expiry
+        first, and returns once nothing is left to remove.
+        """
+        ncache._set_key('k1', 'some test data', ttl=100)
+        ncache._set_key('k2', 'some test data', ttl=10000)
+        ncache.manage_memory(1, 300, 0)
+        self.assertEqual(len(ncache.store), 0)
+
+
+class TestNCacheMemory(unittest.TestCase):
+    """
+    Every entry's bytes are tracked as keys are set and deleted so the cache
+    size is known without measuring it.
+    """
+    def setUp(self):
+        ncache.flush_all()
+
+    def test_cache_bytes(self):
+        self.assertEqual(ncache.current_cache_size(), 0)
+        ncache._set_key('k1', 'x' * 1000)
+        size = ncache.current_cache_size()
+        self.assertTrue(size > 1000)
+        ncache._set_key('k1', 'x' * 2000, ttl=100)
+        self.assertEqual(ncache.current_cache_size(), size + 1000)
+        ncache._set_key('k2', 'x' * 1000, ttl=0)
+        ncache._get_or_timeout('k2')
+        self.assertEqual(ncache.current_cache_size(), size + 1000)
+        ncache._clear_ttl_keys(datetime.now() + timedelta(seconds=300))
+        self.assertEqual(ncache.current_cache_size(), 0)
+
+    def test_manage_memory_limit(self):
+        """
+        Least recently used perm keys are removed until the limit is respected.
+        """
+        for i in range(10):
+            ncache._set_key('k{0}'.format(i), 'x' * 1000)
+        ncache.manage_memory(1, 300, ncache.current_cache_size() // 2)
+        self.assertEqual(sorted(ncache.store.entries), ['k5', 'k6', 'k7', 'k8', 'k9'])
+
+
+class TestNCacheStore(unittest.TestCase):
+    """
+    The store keeps one entry per key. Perm entries are linked in recency order.
+    """
+    def test_overwrite_changes_flavour(self):
+        store = Store()
+        store.set('k1', 'perm data')
+        store.set('k2', 'perm data')
+        store.set('k1', 'ttl data', ttl=100)
+        self.assertEqual(store.get('k1'), 'ttl data')
+        # k1 is no longer perm so only k2 can be evicted
+        self.assertEqual(store.evict_lru(5), 1)
+        self.assertEqual(list(store.entries), ['k1'])
+        store.set('k1', 'perm data')
+        self.assertEqual(store.expire_before(now_ticks() + 1000000), 0)
+        self.assertEqual(store.evict_lru(5), 1)
+        self.assertEqual(store.bytes, 0)
+
+    def test_counters(self):
+        store = Store()
+        store.set('k1', 'perm data')
+        store.set('k2', 'ttl data', ttl=0)
+        store.set('k3', 'ttl data', ttl=10)
+        store.get('k1')
+        store.get('k2')
+        store.evict_lru(1)
+        store.expire_before(now_ticks() + 1000000)
+        self.assertEqual((store.hits, store.misses, store.expired), (1, 1, 1))
+        self.assertEqual((store.lru_evictions, store.ttl_evictions), (1, 1))
+
+    def test_delete(self):
+        store = Store()
+        store.set('k1', 'perm data')
+        store.set('k2', 'ttl data', ttl=100)
+        self.assertTrue(store.delete('k1'))
+        self.assertTrue(store.delete('k2'))
+        self.assertFalse(store.delete('k2'))
+        self.assertEqual(store.evict_lru(5), 0)
+        self.assertEqual(store.expire_before(now_ticks() + 1000000), 0)
+        self.assertEqual(store.bytes, 0)
+
+
+    def test_expire_due(self):
+        store = Store()
+        for i in range(1000):
+            store.set('k{0}'.format(i), 'ttl data', ttl=0)
+        store.set('live', 'ttl data', ttl=100)
+        # with no budget one batch of keys is removed and the rest left for later
+        self.assertEqual(store.expire_due(0), (64, True,))
+        self.assertEqual(store.expire_due(10), (936, False,))
+        self.assertEqual((list(store.entries), store.expired, store.ttl_evictions,), (['live'], 1000, 0,))
+
+    def test_key_index(self):
+        store = Store()
+        index = KeyIndex()
+        store.watchers.append(index)
+        store.set('user:1:name', 'perm data')
+        store.set('user:2:name', 'ttl data', ttl=0)
+        store.set('user', 'perm data')
+        index.tag('user:1:name', ['users', 'names'])
+        index.tag('user:2:name', ['users'])
+        self.assertEqual(sorted(index.keys_with_prefix('user:', store)), ['user:1:name', 'user:2:name'])
+        self.assertEqual(index.keys_with_prefix('user:1:', store), ['user:1:name'])
+        # prefixes not ending in the separator scan the store
+        self.assertEqual(sorted(index.keys_with_prefix('use', store)), ['user', 'user:1:name', 'user:2:name'])
+        # expiry and eviction drop keys from every index
+        store.expire_before(now_ticks() + 1)
+        self.assertEqual(index.keys_with_tag('users'), ['user:1:name'])
+        store.evict_lru(2)
+        self.assertEqual((index.prefixes, index.tags, index.key_tags,), ({}, {}, {},))
+
+
+class TestNCachePolicies(unittest.TestCase):
+    """
+    The store's eviction policy chooses the keys manage_memory evicts.
+    """
+    def test_lru(self):
+        store = Store(make_policy('lru'))
+        store.set('k1', 'ttl data', ttl=100)
+        store.set('k2', 'perm data')
+        store.set('k3', 'perm data')
+        store.get('k1')
+        # ttl keys are evicted in recency order with perm keys
+        self.assertEqual(store.evict(2), 2)
+        self.assertEqual(list(store.entries), ['k1'])
+        self.assertEqual((store.policy_evictions, store.evictions,), (2, 2,))
+
+    def test_lfu(self):
+        store = Store(make_policy('lfu'))
+        for key in ('k1', 'k2', 'k3', 'k4'):
+            store.set(key, 'perm data')
+        for key in ('k1', 'k1', 'k2', 'k4'):
+            store.get(key)
+        # k3 was used least, then k2 and k4 used as often, k2 less recently
+        self.assertEqual(store.evict(1), 1)
+        self.assertEqual(sorted(store.entries), ['k1', 'k2', 'k4'])
+        store.evict(1)
+        self.assertEqual(sorted(store.entries), ['k1', 'k4'])
+        self.assertEqual(store.evict(5), 2)
+        self.assertEqual(store.bytes, 0)
+
+    def test_tinylfu_admission(self):
+        store = Store(make_policy('tinylfu', width=1024))
+        store.set('hot', 'perm data')
+        for _ in range(5):
+            store.get('hot')
+        store.set('warm', 'perm data')
+        store.get('warm')
+        # the new key is used less often than the least recently used key so it goes
+        store.set('cold', 'perm data')
+        store.evict(1)
+        self.assertEqual(sorted(store.entries), ['hot', 'warm'])
+        # a new key missed often enough displaces it
+        for _ in range(8):
+            store.get('popular')
+        store.set('popular', 'perm data')
+        store.evict(1)
+        self.assertEqual(sorted(store.entries), ['popular', 'warm'])
+        self.assertEqual(store.policy.rejected, 1)
+
+    def test_set_policy(self):
+        store = Store()
+        store.set('k1', 'perm data')
+        store.set('k2', 'ttl data', ttl=100)
+        self.assertEqual(store.evict(5), 1)
+        store.set('k1', 'perm data')
+        store.set_policy(make_policy('lru'))
+        # keys already stored are evicted by the new policy
+        self.assertEqual(store.evict(5), 2)
+        self.assertEqual(store.policy.order, {})
+        store.set('k3', 'perm data')
+        store.clear()
+        self.assertEqual(store.policy.order, {})
+        self.assertRaises(ValueError, make_policy, 'random')
+
+    def test_manage_memory(self):
+        ncache.flush_all()
+        ncache.store.set_policy(make_policy('lfu'))
+        self.addCleanup(ncache.store.set_policy, make_policy('default'))
+        for i in range(4):
+            ncache._set_key('k{0}'.format(i), 'x' * 1000, ttl=100 - i)
+        ncache._get_or_timeout('k2')
+        ncache._get_or_timeout('k3')
+        # by default the keys nearest expiry, k3 and k2, would go
+        ncache.manage_memory(1, 300, ncache.current_cache_size() // 2)
+        self.assertEqual(sorted(ncache.store.entries), ['k2', 'k3'])
+        ncache.flush_all()
+
+    def test_simulate(self):
+        """
+        On a skewed workload frequency based policies keep more of the popular keys.
+        """
+        trace = bench_ncache.zipf_trace(2000, 20000, value_size=100)
+        results = dict((result['params']['policy'], result,) for result in
+                       bench_ncache.run_simulate(trace, ['lru', 'tinylfu'], [50000]))
+        self.assertEqual(results['lru']['ops'], 20000)
+        self.assertTrue(results['lru']['evictions'] > 0)
+        self.assertGreater(results['tinylfu']['hit_ratio'], results['lru']['hit_ratio'] + 0.02)
+        self.assertEqual(ncache.store.policy.name, 'default')
+
+    def test_read_trace(self):
+        path = os.path.join(tempfile.mkdtemp(), 'trace')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('k1\nGET k2\n\nset k3 500 10\nSET k4 20\n')
+        self.assertEqual(bench_ncache.read_trace(path, 100), [
+            ('GET', 'k1', 100, None,), ('GET', 'k2', 100, None,), ('SET', 'k3', 500, 10.0,), ('SET', 'k4', 20, None,)])
+        with open(path, 'w') as f:
+            f.write('GET k1 k2\n')
+        self.assertRaises(ValueError, bench_ncache.read_trace, path)
+
+
+class TestNCacheSnapshot(unittest.TestCase):
+    """
+    Snapshots save every live entry with its expiry and value type. Keys that
+    expire while the server is down are dropped when the snapshot is loaded.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'ncache.snapshot')
+
+    def test_round_trip(self):
+        store = Store()
+        store.set('k1', 'text data')
+        store.set('k2', b'\x00binary\r\ndata')
+        store.set('k3', 'ttl data', ttl=1000)
+        store.set('k4', 'expiring data', ttl=0.05)
+        store.get('k1')
+        self.assertEqual(write_snapshot(store, self.path), 4)
+
+        time.sleep(0.1)
+        loaded = Store()
+        self.assertEqual(load_snapshot(loaded, self.path), 3)
+        # perm keys keep their recency order, k2 was used least recently
+        self.assertEqual(loaded.head.next.key, 'k2')
+        self.assertEqual(loaded.get('k1'), 'text data')
+        self.assertEqual(loaded.get('k2'), b'\x00binary\r\ndata')
+        self.assertEqual(loaded.get('k3'), 'ttl data')
+        self.assertEqual(loaded.get('k4'), None)
+        self.assertTrue(loaded.entries['k3'].expires - now_ticks() <= 1000 * 1000)
+
+    def test_missing_snapshot(self):
+        self.assertEqual(load_snapshot(Store(), self.path), 0)
+
+    def test_snapshot_command(self):
+        """
+        SNAPSHOT saves in the background and a new server loads it at startup.
+        """
+        ncache.flush_all()
+        ncache._set_key('k1', 'some test data')
+        server = ncache.Server(port=0, snapshot_path=self.path)
+        self.assertEqual(server.execute('SNAPSHOT'), 'SUCCESS')
+        server.snapshotter.poll(block=True)
+        server.close()
+
+        ncache.flush_all()
+        server = ncache.Server(port=0, snapshot_path=self.path)
+        server.close()
+        self.assertEqual(ncache._get_or_timeout('k1'), 'some test data')
+
+    def test_snapshot_not_configured(self):
+        server = ncache.Server(port=0)
+        server.close()
+        self.assertTrue(server.execute('SNAPSHOT').startswith('ERROR: '))
+
+
+class TestNCacheWriteLog(unittest.TestCase):
+    """
+    Every set and delete is appended to the write log and replayed at startup.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'ncache.log')
+
+    def replay(self, log):
+        store = Store()
+        for _ in log.replay(store):
+            pass
+        return store
+
+    def test_replay(self):
+        ncache.flush_all()
+        server = ncache.Server(port=0, log_path=self.path, log_fsync='always')
+        server.execute('SET k1 "some test data"')
+        server.execute('SET k2 "ttl data" TTL=100')
+        server.execute('SET k3 "gone data"')
+        ncache._delete_key('k3')
+        server.write_log.commit()
+        self.assertEqual(len(list(read_log(self.path))), 4)
+        server.close()
+
+        ncache.flush_all()
+        server = ncache.Server(port=0, log_path=self.path)
+        while server.replay_task in server.periodic:
+            server._run_periodic(0)
+        server.close()
+        self.assertEqual(ncache._get_or_timeout('k1'), 'some test data')
+        self.assertEqual(ncache._get_or_timeout('k2'), 'ttl data')
+        self.assertEqual(ncache._get_or_timeout('k3'), 'NOT FOUND')
+
+    def test_live_writes_win_over_replay(self):
+        log = WriteLog(self.path, 'always')
+        log.open()
+        store = Store()
+        store.watchers.append(log)
+        store.set('k1', 'old data')
+        log.commit()
+
+        replay = log.replay(store)
+        store.set('k1', 'new data')
+        for _ in replay:
+            pass
+        log.close()
+        self.assertEqual(store.get('k1'), 'new data')
+
+    def test_compact(self):
+        log = WriteLog(self.path, 'never', compact_size=0)
+        log.open()
+        store = Store()
+        store.watchers.append(log)
+        for i in range(100):
+            store.set('k1', 'data {0}'.format(i))
+        store.set('k2', 'deleted data')
+        store.delete('k2')
+        log.flush(False)
+        self.assertTrue(log.compact(store))
+        store.set('k3', 'written during compaction')
+        log.poll(block=True)
+        log.close()
+        self.assertEqual(len(list(read_log(self.path))), 2)
+        replayed = self.replay(WriteLog(self.path))
+        self.assertEqual(replayed.get('k1'), 'data 99')
+        self.assertEqual(replayed.get('k2'), None)
+        self.assertEqual(replayed.get('k3'), 'written during compaction')
+
+    def test_repair_partial_record(self):
+        log = WriteLog(self.path, 'always')
+        log.open()
+        store = Store()
+        store.watchers.append(log)
+        store.set('k1', 'some test data')
+        log.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, 'ab') as out:
+            out.write(b'\x00\x01\x02')
+        self.assertEqual(repair_log(self.path), size)
+        self.assertEqual(os.path.getsize(self.path), size)
+
 
 class TestNCacheSetKeys(unittest.TestCase):
     """
@@ -189,14 +582,14 @@ class TestNCacheSetKeys(unittest.TestCase):
     """
     def test_set_key_perm(self):
         """
-        Assert 'k1' -> 'some_test_data' in ncache.cache_values
-        Assert 'k1' -> ('perm', <datetime>)
+        Assert 'k1' -> 'some_test_data' in ncache.store
+        Assert 'k1' -> perm, created <tick>
         """
         ncache._set_key('k1', 'some_test_data')
-        data = ncache.cache_timeouts.get('k1')
-        self.assertEqual(data[0], 'perm')
-        self.assertTrue(isinstance(data[1], datetime))
-        self.assertTrue(bool(datetime.now() >= data[1]))
+        data = ncache.store.entries.get('k1')
+        self.assertEqual(data.expires, None)
+        self.assertTrue(isinstance(data.created, int))
+        self.assertTrue(bool(now_ticks() >= data.created))
         data = ncache._get_or_timeout('k1')
         self.assertEqual(data, 'some_test_data')
         # repeat test to guard against accidental removal using pop instead of get :-$
@@ -205,15 +598,14 @@ class TestNCacheSetKeys(unittest.TestCase):
 
     def test_set_key_ttl(self):
         """
-        Assert 'k1' -> 'some_test_data' in ncache.cache_values
-        Assert 'k1' -> ('ttl', <datetime + 2000seconds>)
+        Assert 'k1' -> 'some_test_data' in ncache.store
+        Assert 'k1' -> ttl, expires <tick + 2000seconds>
         """
         ncache._set_key('k1', 'some_test_data', ttl=2000)
         #XXX: hopefully this test will not stall over 2000seconds.  It wouldn't in pure python outside of quartz
-        data = ncache.cache_timeouts.get('k1')
-        self.assertEqual(data[0], 'ttl')
-        self.assertTrue(isinstance(data[1], datetime))
-        self.assertTrue(bool(datetime.now() <= data[1]))
+        data = ncache.store.entries.get('k1')
+        self.assertTrue(isinstance(data.expires, int))
+        self.assertTrue(bool(now_ticks() <= data.expires))
         data = ncache._get_or_timeout('k1')
         self.assertEqual(data, 'some_test_data')
         # repeat test to guard against accidental removal using pop instead of get :-$
@@ -222,14 +614,13 @@ class TestNCacheSetKeys(unittest.TestCase):
 
     def test_set_key_ttl_expiry(self):
         """
-        Assert 'k1' -> 'some_test_data' in ncache.cache_values
-        Assert 'k1' -> ('ttl', <datetime + 0seconds>)
+        Assert 'k1' -> 'some_test_data' in ncache.store
+        Assert 'k1' -> ttl, expires <tick + 0seconds>
         """
         ncache._set_key('k1', 'some_test_data', ttl=0)
-        data = ncache.cache_timeouts.get('k1')
-        self.assertEqual(data[0], 'ttl')
-        self.assertTrue(isinstance(data[1], datetime))
-        self.assertTrue(bool(datetime.now() >= data[1]))
+        data = ncache.store.entries.get('k1')
+        self.assertTrue(isinstance(data.expires, int))
+        self.assertTrue(bool(now_ticks() >= data.expires))
         data = ncache._get_or_timeout('k1')
         self.assertEqual(data, 'NOT FOUND')
 
@@ -308,6 +699,532 @@ class TestNCacheParseCommand(unittest.TestCase):
         with self.assertRaises(ValueError):
             ncache.parse_command('GET my head')
 
+    def test_parse_command_mset_mget(self):
+        """
+        Behaviour of the batch commands is represented below.
+
+        |   command               |  Expected              |
+        +-------------------------+------------------------+
+        | MSET a 1 b "2" TTL=5    | a -> "1", b -> "2"     |
+        | MGET a thing b          | "1", NOT FOUND, "2"    |
+        | MSET a 1 b              | Exception - wrong args |
+        | MSET                    | Exception - wrong args |
+        | MGET                    | Exception - wrong args |
+        """
+        status = ncache.parse_command('MSET a 1 b "2" TTL=5')
+        self.assertEqual(status, 'SUCCESS')
+        self.assertEqual(ncache.store.entries['a'].expires, None)
+        self.assertNotEqual(ncache.store.entries['b'].expires, None)
+        data = ncache.parse_command('MGET a thing b')
+        self.assertEqual(data, '1\r\nNOT FOUND\r\n2')
+
+        with self.assertRaises(ValueError):
+            ncache.parse_command('MSET a 1 b')
+        with self.assertRaises(ValueError):
+            ncache.parse_command('MSET')
+        with self.assertRaises(ValueError):
+            ncache.parse_command('MGET')
+
+    def test_parse_command_registry(self):
+        """
+        Values keep their spacing, wrong arity is reported and new commands
+        can be registered.
+
+        |   command               |  Expected              |
+        +-------------------------+------------------------+
+        | SET k1 a  b TTL=5       | k1 -> "a  b"           |
+        | SET k2 a  TTL=x         | k2 -> "a  TTL=x"       |
+        | GET k1 k2               | Exception - wrong args |
+        | FETCH k1                | Exception - unknown    |
+        | APPEND k1 " c"          | k1 -> "a  b c"         |
+        """
+        self.assertEqual(ncache.parse_command('SET k1 a  b TTL=5'), 'SUCCESS')
+        self.assertEqual(ncache._get_or_timeout('k1'), 'a  b')
+        self.assertNotEqual(ncache.store.entries['k1'].expires, None)
+        ncache.parse_command('set k2 a  TTL=x')
+        self.assertEqual(ncache._get_or_timeout('k2'), 'a  TTL=x')
+        with self.assertRaisesRegex(ValueError, 'Wrong number of args for GET. Received 2, expected 1'):
+            ncache.parse_command('GET k1 k2')
+        with self.assertRaisesRegex(ValueError, 'Unkown command'):
+            ncache.parse_command('FETCH k1')
+
+        @ncache.register_command('append', value=True)
+        def append(key, value, ttl):
+            ncache._set_key(key, ncache._get_or_timeout(key) + value, ttl=ttl)
+            return 'SUCCESS'
+        self.addCleanup(ncache.commands.pop, 'append')
+        self.assertEqual(ncache.parse_command('APPEND k1 " c"'), 'SUCCESS')
+        self.assertEqual(ncache._get_or_timeout('k1'), 'a  b c')
+
+    def test_parse_command_atomic(self):
+        """
+        Behaviour of the atomic commands is represented below.
+
+        |   command               |  Expected              |
+        +-------------------------+------------------------+
+        | INCR hits 1             | 1                      |
+        | INCR hits 2 100         | 3                      |
+        | DECR new 1 10 TTL=60    | 9, expires             |
+        | INCR k1 1               | Exception - not an int |
+        | ADD hits "x"            | EXISTS                 |
+        | ADD a "x y"             | SUCCESS                |
+        | GETS a                  | "x y", <version>       |
+        | CAS a <version> z       | SUCCESS                |
+        | CAS a <version> w       | EXISTS                 |
+        | CAS nothing 1 w         | NOT FOUND              |
+        """
+        ncache.flush_all()
+        self.assertEqual(ncache.parse_command('INCR hits 1'), '1')
+        self.assertEqual(ncache.parse_command('INCR hits 2 100'), '3')
+        self.assertEqual(ncache.store.entries['hits'].expires, None)
+        self.assertEqual(ncache.parse_command('DECR new 1 10 TTL=60'), '9')
+        self.assertNotEqual(ncache.store.entries['new'].expires, None)
+        ncache.parse_command('SET k1 one')
+        with self.assertRaises(ValueError):
+            ncache.parse_command('INCR k1 1')
+        with self.assertRaises(ValueError):
+            ncache.parse_command('INCR hits one')
+
+        self.assertEqual(ncache.parse_command('ADD hits "x"'), 'EXISTS')
+        self.assertEqual(ncache.parse_command('ADD a "x y"'), 'SUCCESS')
+        value, version = ncache.parse_command('GETS a').split('\r\n')
+        self.assertEqual(value, 'x y')
+        self.assertEqual(ncache.parse_command('CAS a {0} z'.format(version)), 'SUCCESS')
+        self.assertEqual(ncache.parse_command('CAS a {0} w'.format(version)), 'EXISTS')
+        self.assertEqual(ncache._get_or_timeout('a'), 'z')
+        self.assertEqual(ncache.parse_command('CAS nothing 1 w'), 'NOT FOUND')
+
+    def test_parse_command_lease_release(self):
+        """
+        Behaviour of the lease commands is represented below.
+
+        |   command               |  Expected              |
+        +-------------------------+------------------------+
+        | LEASE a t1 10           | SUCCESS                |
+        | LEASE a t2 10           | LOCKED                 |
+        | LEASE a t1 10           | SUCCESS, renewed       |
+        | RELEASE a t2            | NOT FOUND              |
+        | RELEASE a t1            | SUCCESS                |
+        | LEASE a t2 10           | SUCCESS                |
+        | LEASE a t2              | Exception - wrong args |
+        """
+        ncache.flush_all()
+        self.assertEqual(ncache.parse_command('LEASE a t1 10'), 'SUCCESS')
+        self.assertEqual(ncache.parse_command('LEASE a t2 10'), 'LOCKED')
+        self.assertEqual(ncache.parse_command('LEASE a t1 10'), 'SUCCESS')
+        self.assertEqual(ncache.parse_command('RELEASE a t2'), 'NOT FOUND')
+        self.assertEqual(ncache.parse_command('RELEASE a t1'), 'SUCCESS')
+        self.assertEqual(ncache.parse_command('LEASE a t2 10'), 'SUCCESS')
+        # an expired lease can be taken by anyone
+        ncache.leases['a'] = ('t2', ncache.now_ticks() - 1,)
+        self.assertEqual(ncache.parse_command('LEASE a t3 10'), 'SUCCESS')
+        self.assertNotIn('a', ncache.store)
+
+        with self.assertRaises(ValueError):
+            ncache.parse_command('LEASE a t2')
+
+    def test_parse_command_invalidation(self):
+        """
+        Behaviour of the invalidation commands is represented below.
+
+        |   command               |  Expected              |
+        +-------------------------+------------------------+
+        | TAG a:1 t1 t2           | SUCCESS                |
+        | TAG nothing t1          | NOT FOUND              |
+        | TAG b t1                | SUCCESS                |
+        | DELTAG t1               | 2, a:1 and b           |
+        | DELPREFIX a:            | 2                      |
+        | DEL b c nothing         | 1                      |
+        | DEL                     | Exception - wrong args |
+        """
+        ncache.flush_all()
+        for key in ('a:1', 'a:2', 'a:3', 'b', 'c'):
+            ncache.parse_command('SET {0} x'.format(key))
+        self.assertEqual(ncache.parse_command('TAG a:1 t1 t2'), 'SUCCESS')
+        self.assertEqual(ncache.parse_command('TAG b t1'), 'SUCCESS')
+        self.assertEqual(ncache.parse_command('TAG nothing t1'), 'NOT FOUND')
+        self.assertEqual(ncache.parse_command('DELTAG t1'), '2')
+        self.assertEqual(ncache.parse_command('DELTAG t2'), '0')
+        self.assertEqual(ncache.parse_command('DELPREFIX a:'), '2')
+        self.assertEqual(ncache.parse_command('DEL b c nothing'), '1')
+        self.assertEqual(len(ncache.store), 0)
+        with self.assertRaises(ValueError):
+            ncache.parse_command('DEL')
+
+
+class TestNCacheProtocol(unittest.TestCase):
+    """
+    Frames are built from buffers without copying large values and read
+    through a preallocated buffer.
+    """
+    def test_frame_parts(self):
+        value = os.urandom(protocol.COPY_THRESHOLD)
+        parts = protocol.frame_parts(protocol.MAGIC_REQUEST, protocol.OP_SET, ['k1', value, b''])
+        self.assertIs(parts[2], value)
+        frame = b''.join(parts)
+        self.assertEqual(frame, protocol.pack_frame(protocol.MAGIC_REQUEST, protocol.OP_SET, ['k1', value, b'']))
+        self.assertEqual(protocol.read_frame(frame), (protocol.MAGIC_REQUEST, protocol.OP_SET, [b'k1', value, b''], len(frame)))
+        self.assertEqual(protocol.read_frame(frame, 0, len(frame) - 1), None)
+
+    def test_read_buffer(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        inbox = protocol.ReadBuffer(16)
+        big = protocol.pack_frame(protocol.MAGIC_REQUEST, protocol.OP_GET, [b'x' * 40])
+        small = protocol.pack_frame(protocol.MAGIC_REQUEST, protocol.OP_GET, [b'k1'])
+        a.sendall(small + big)
+        while inbox.end < len(small + big):
+            inbox.recv_into(b)
+        # the buffer grew to hold the large frame
+        self.assertTrue(len(inbox.buf) >= len(small + big))
+        _, _, items, end = protocol.read_frame(inbox.buf, inbox.start, inbox.end)
+        self.assertEqual(items, [b'k1'])
+        inbox.consume(end)
+        _, _, items, end = protocol.read_frame(inbox.buf, inbox.start, inbox.end)
+        self.assertEqual(items, [b'x' * 40])
+        inbox.consume(end)
+        # emptied, it returns to its preallocated size
+        self.assertEqual((len(inbox), len(inbox.buf),), (0, 16,))
+
+    def test_short_frame(self):
+        """
+        A frame counting more items than its body holds is malformed, whether
+        it ends at the end of the buffer or another frame follows it.
+        """
+        frame = bytearray(protocol.pack_frame(protocol.MAGIC_REQUEST, protocol.OP_GET, [b'k1']))
+        frame[2:6] = b'\x00\x00\x00\x02'
+        self.assertRaises(ValueError, protocol.read_frame, frame)
+        following = frame + protocol.pack_frame(protocol.MAGIC_REQUEST, protocol.OP_GET, [b'k2'])
+        self.assertRaises(ValueError, protocol.read_frame, following)
+
+
+class TestNCacheServer(unittest.TestCase):
+    """
+    The server is an event loop. Many clients may be connected at once and
+    new clients are accepted for as long as the server runs.
+    """
+    def setUp(self):
+        self.server = ncache.Server(port=0)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+
+    def connect(self):
+        conn = socket.create_connection(self.server.address)
+        self.addCleanup(conn.close)
+        return conn
+
+    def test_active_expiry(self):
+        """
+        Expired keys nobody reads again are removed by the expiry cycle.
+        """
+        ncache._set_key('server_expiring', 'value', ttl=0.01)
+        deadline = time.time() + 5
+        while 'server_expiring' in ncache.store and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertNotIn('server_expiring', ncache.store)
+
+    def test_concurrent_clients(self):
+        """
+        Three clients connect before any of them sends a command, each is served.
+        """
+        clients = [self.connect() for _ in range(3)]
+        for i, conn in enumerate(clients):
+            conn.sendall('SET server{0} "value {0}"\n'.format(i).encode())
+            self.assertEqual(conn.recv(1024), b'SUCCESS\r\n')
+        for i, conn in reversed(list(enumerate(clients))):
+            conn.sendall('GET server{0}\n'.format(i).encode())
+            self.assertEqual(conn.recv(1024), 'value {0}\r\n'.format(i).encode())
+
+    def test_client_leaving_does_not_stop_server(self):
+        """
+        The server keeps accepting clients after one disconnects.
+        """
+        conn = self.connect()
+        conn.sendall(b'SET server_k1 v1\n')
+        self.assertEqual(conn.recv(1024), b'SUCCESS\r\n')
+        conn.close()
+        conn = self.connect()
+        conn.sendall(b'GET server_k1\n')
+        self.assertEqual(conn.recv(1024), b'v1\r\n')
+
+    def test_stats(self):
+        conn = self.connect()
+        conn.sendall(b'GET server_nothing\nSTATS\n')
+        data = b''
+        while b'latency_get_buckets' not in data:
+            data += conn.recv(4096)
+        self.assertIn(b'\r\nmisses ', data)
+        self.assertIn(b'\r\nlatency_get_count 1\r\n', data)
+
+    def test_parse_error_is_returned(self):
+        conn = self.connect()
+        conn.sendall(b'FETCH k1\n')
+        self.assertTrue(conn.recv(1024).startswith(b'ERROR: '))
+
+    def recv_exactly(self, conn, size):
+        data = b''
+        while len(data) < size:
+            data += conn.recv(size - len(data))
+        return data
+
+    def test_pipelined_text_commands(self):
+        """
+        Commands sent back to back in one write are answered in order.
+        """
+        conn = self.connect()
+        conn.sendall(b'SET server_k2 a\nSET server_k3 b\r\nGET server_k3\nGET server_k2\n')
+        expected = b'SUCCESS\r\nSUCCESS\r\nb\r\na\r\n'
+        self.assertEqual(self.recv_exactly(conn, len(expected)), expected)
+
+    def test_binary_frames(self):
+        """
+        Binary frames carry values larger than the read buffer, split across
+        writes, and answer in order.
+        """
+        conn = self.connect()
+        value = bytes(range(256)) * 100
+        frames = protocol.pack_frame(protocol.MAGIC_REQUEST, protocol.OP_SET, [b'server_k4', value, b''])
+        frames += protocol.pack_frame(protocol.MAGIC_REQUEST, protocol.OP_GET, [b'server_k4'])
+        frames += protocol.pack_frame(protocol.MAGIC_REQUEST, protocol.OP_GET, [b'server_nothing'])
+        conn.sendall(frames[:7])
+        conn.sendall(frames[7:])
+        expected = protocol.pack_frame(protocol.MAGIC_RESPONSE, protocol.STATUS_OK)
+        expected += protocol.pack_frame(protocol.MAGIC_RESPONSE, protocol.STATUS_OK, [value, b''])
+        expected += protocol.pack_frame(protocol.MAGIC_RESPONSE, protocol.STATUS_NOT_FOUND)
+        self.assertEqual(self.recv_exactly(conn, len(expected)), expected)
+
+    def test_short_frame(self):
+        """
+        A frame counting more items than it holds, filling the read buffer
+        exactly, is answered with an error and the server keeps serving.
+        """
+        conn = self.connect()
+        frame = bytearray(protocol.pack_frame(protocol.MAGIC_REQUEST, protocol.OP_GET, [b'x' * 1010]))
+        self.assertEqual(len(frame), self.server.buffer_size)
+        frame[2:6] = b'\x00\x00\x00\x02'
+        conn.sendall(frame)
+        header = self.recv_exactly(conn, protocol.HEADER.size)
+        self.assertEqual(header[:2], bytes([protocol.MAGIC_RESPONSE, protocol.STATUS_ERROR]))
+        conn = self.connect()
+        conn.sendall(b'SET server_k5 "v5"\n')
+        self.assertEqual(conn.recv(1024), b'SUCCESS\r\n')
+
+
+def _run_server(**kw):
+    # a forked server starts with an empty cache, not a copy of the test's
+    ncache.flush_all()
+    ncache.run_ncache(**kw)
+
+class NCacheProcessTestCase(unittest.TestCase):
+    """
+    Runs servers in their own processes on localhost and talks to them with
+    binary frames.
+    """
+    def start(self, **kw):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        address = sock.getsockname()
+        sock.close()
+        process = multiprocessing.Process(target=_run_server, kwargs=dict(kw, port=address[1]))
+        process.start()
+        self.addCleanup(process.join)
+        self.addCleanup(process.terminate)
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(address).close()
+                return address
+            except ConnectionError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.01)
+
+    def request(self, address, opcode, *items):
+        conn = socket.create_connection(address)
+        try:
+            conn.sendall(protocol.pack_frame(protocol.MAGIC_REQUEST, opcode, items))
+            inbox = bytearray()
+            while protocol.read_frame(inbox) is None:
+                data = conn.recv(65536)
+                if not data:
+                    raise ConnectionError('server closed the connection')
+                inbox += data
+            _, status, items, _ = protocol.read_frame(inbox)
+            return status, items
+        finally:
+            conn.close()
+
+    def wait_for(self, address, key, value):
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            _, items = self.request(address, protocol.OP_GET, key)
+            if (items[0] if items else None) == value:
+                return
+            time.sleep(0.01)
+        self.fail('{0} never became {1!r}'.format(key, value))
+
+    def stats(self, address):
+        _, items = self.request(address, protocol.OP_STATS)
+        return dict((name.decode(), value.decode(),) for name, value in zip(items[0::2], items[1::2]))
+
+class TestNCacheReplication(NCacheProcessTestCase):
+    """
+    A replica receives every key of its primary and then every change, in
+    separate processes on localhost. Replicas only serve reads.
+    """
+    def test_feed(self):
+        """
+        Sets, deletes and evictions are streamed as records after a full sync.
+        """
+        store = Store()
+        store.set('k1', 'perm data')
+        feed = ReplicationFeed()
+        store.watchers.append(feed)
+        replica = ncache.Connection(None, None)
+        self.assertEqual(feed.add(replica, store), 1)
+        store.set('k2', b'ttl data', ttl=100)
+        store.evict_lru(1)
+        feed.ping()
+        stream = bytearray(b''.join(replica.outbox))
+        records = []
+        offset = 0
+        while offset < len(stream):
+            kind, key, value, _, offset = read_record(stream, offset)
+            records.append((kind, key, value,))
+        self.assertEqual(records[:3], [(KIND_TEXT, 'k1', b'perm data',), (0, 'k2', b'ttl data',), (KIND_DELETE, 'k1', b'',)])
+        self.assertEqual(records[3][1:], ('', b'',))
+        self.assertEqual(feed.backlogs(), [(replica, len(stream),)])
+        self.assertEqual(read_record(stream, 0, 10), None)
+
+    def test_replication(self):
+        primary = self.start()
+        self.request(primary, protocol.OP_SET, 'repl:k1', 'before', '')
+        self.request(primary, protocol.OP_SET, 'repl:k2', 'expiring', '100')
+        replica = self.start(primary=primary)
+        self.wait_for(replica, 'repl:k1', b'before')
+        self.wait_for(replica, 'repl:k2', b'expiring')
+
+        self.request(primary, protocol.OP_SET, 'repl:k1', 'after', '')
+        self.wait_for(replica, 'repl:k1', b'after')
+        self.request(primary, protocol.OP_DELPREFIX, 'repl:')
+        self.wait_for(replica, 'repl:k2', None)
+
+        status, items = self.request(replica, protocol.OP_SET, 'repl:k3', 'value', '')
+        self.assertEqual(status, protocol.STATUS_ERROR)
+        self.assertTrue(items[0].startswith(b'ERROR: Replicas are read only'))
+
+        self.assertEqual(self.stats(primary)['replicas'], '1')
+        stats = self.stats(replica)
+        self.assertEqual(stats['replication_connected'], '1')
+        self.assertTrue(0 <= float(stats['replication_lag_seconds']) < 5)
+
+
+def _count_in_table(table, count):
+    ncache.store = table
+    for _ in range(count):
+        ncache._incr('hits', 1)
+
+class TestNCacheSharedTable(unittest.TestCase):
+    """
+    A SharedTable behaves like a Store within fixed slots and is shared by
+    forked processes.
+    """
+    def table(self, **kw):
+        table = SharedTable(**kw)
+        self.addCleanup(table.unlink)
+        self.addCleanup(table.close)
+        return table
+
+    def test_set_get(self):
+        table = self.table(slots=64)
+        table.set('k1', 'text data')
+        table.set('k2', b'\x00binary', ttl=100)
+        table.set('k3', 'expired data', ttl=0)
+        self.assertEqual(table.get('k1'), 'text data')
+        self.assertEqual(table.get('k2'), b'\x00binary')
+        self.assertNotEqual(table.get_entry('k2').expires, None)
+        self.assertEqual(table.get('k3'), None)
+        self.assertEqual((len(table), table.bytes,), (2, 2 * table.slot_size,))
+        self.assertIn('k1', table)
+        version = table.get_entry('k1').version
+        table.set('k1', 'new data')
+        self.assertNotEqual(table.get_entry('k1').version, version)
+        self.assertTrue(table.delete('k1'))
+        self.assertFalse(table.delete('k1'))
+        self.assertEqual((table.hits, table.misses, table.expired,), (5, 1, 1,))
+        with self.assertRaises(ValueError):
+            table.set('k4', 'x' * (table.max_value + 1))
+        table.clear()
+        self.assertEqual(len(table), 0)
+
+    def test_bucket_eviction(self):
+        """
+        A full bucket gives up an expired key, then the least recently used
+        perm key, then the ttl key expiring soonest.
+        """
+        table = self.table(slots=3, ways=3)
+        table.set('perm1', 'data')
+        table.set('perm2', 'data')
+        table.set('expired', 'data', ttl=0)
+        table.set('new1', 'data', ttl=100)
+        self.assertEqual(table.expired, 1)
+        # recency is kept in millisecond ticks
+        time.sleep(0.002)
+        table.get('perm1')
+        table.set('new2', 'data', ttl=50)
+        self.assertNotIn('perm2', table)
+        table.set('new3', 'data', ttl=200)
+        self.assertNotIn('perm1', table)
+        table.set('new4', 'data')
+        self.assertNotIn('new2', table)
+        self.assertEqual((table.lru_evictions, table.ttl_evictions, len(table),), (2, 1, 3,))
+
+    def test_expire_due(self):
+        table = self.table(slots=1024)
+        for i in range(100):
+            table.set('k{0}'.format(i), 'ttl data', ttl=0)
+        table.set('live', 'ttl data', ttl=100)
+        self.assertEqual(table.expire_due(10), (100, False,))
+        self.assertEqual(len(table), 1)
+
+    def test_processes(self):
+        """
+        Counters incremented from several processes at once lose no updates.
+        """
+        table = self.table(slots=64)
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=_count_in_table, args=(table, 200)) for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(table.get('hits'), '800')
+
+
+class TestNCacheWorkers(NCacheProcessTestCase):
+    """
+    run_ncache with workers serves one cache from several processes.
+    """
+    def test_workers(self):
+        address = self.start(workers=2, max_memory=1024 * 1024)
+        pids = set()
+        for i in range(32):
+            self.request(address, protocol.OP_SET, 'workers_k{0}'.format(i), str(i), '')
+            self.request(address, protocol.OP_INCR, 'workers_hits', '1', '0', '')
+            pids.add(self.stats(address)['pid'])
+        self.assertEqual(len(pids), 2)
+        for i in range(32):
+            self.assertEqual(self.request(address, protocol.OP_GET, 'workers_k{0}'.format(i))[1][0], str(i).encode())
+        self.assertEqual(self.request(address, protocol.OP_GET, 'workers_hits')[1][0], b'32')
+        stats = self.stats(address)
+        self.assertEqual(stats['keys'], '33')
+        self.assertEqual(self.request(address, protocol.OP_LEASE, 'workers_k1', 't1', '10')[0], protocol.STATUS_ERROR)
+
 
 if __name__ == '__main__':
     suite = unittest.TestSuite()
@@ -315,4 +1232,14 @@ if __name__ == '__main__':
     suite.addTest(unittest.makeSuite(TestNCacheParseCommand))
     suite.addTest(unittest.makeSuite(TestNCacheClearKeys))
     suite.addTest(unittest.makeSuite(TestNCacheSetKeys))
+    suite.addTest(unittest.makeSuite(TestNCacheMemory))
+    suite.addTest(unittest.makeSuite(TestNCacheStore))
+    suite.addTest(unittest.makeSuite(TestNCachePolicies))
+    suite.addTest(unittest.makeSuite(TestNCacheSnapshot))
+    suite.addTest(unittest.makeSuite(TestNCacheWriteLog))
+    suite.addTest(unittest.makeSuite(TestNCacheProtocol))
+    suite.addTest(unittest.makeSuite(TestNCacheServer))
+    suite.addTest(unittest.makeSuite(TestNCacheReplication))
+    suite.addTest(unittest.makeSuite(TestNCacheSharedTable))
+    suite.addTest(unittest.makeSuite(TestNCacheWorkers))
     unittest.TextTestRunner().run(suite)
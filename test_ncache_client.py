@@ -0,0 +1,558 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests for ncache_client against a live ncache server"""
+
+__author__ = "Niall O'Connor"
+
+import asyncio
+import multiprocessing
+import ncache
+from   ncache_async import AsyncNCache
+from   ncache_client import HashRing, NCache, NearCache, PoolTimeout, ShardedNCache
+from   ncache_serializers import Codec, FLAG_PLAIN, FLAG_ZLIB
+import socket
+import threading
+import time
+import unittest
+
+class NCacheServerTestCase(unittest.TestCase):
+    """
+    Runs an ncache server on a free localhost port for the duration of a test.
+    """
+    def setUp(self):
+        self.server = ncache.Server(port=0)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.addCleanup(self.thread.join)
+        self.addCleanup(self.server.stop)
+
+    def client(self, **kw):
+        ip, port = self.server.address
+        cache = NCache(ip=ip, port=port, **kw)
+        self.addCleanup(cache.close)
+        return cache
+
+
+class TestNCacheClient(NCacheServerTestCase):
+    """
+    The client speaks binary frames so values of any size and content round trip.
+    """
+    def test_set_get(self):
+        cache = self.client()
+        self.assertEqual(cache.set('client_k1', {'a': [1, 2, 3]}), 'SUCCESS')
+        self.assertEqual(cache.get('client_k1'), {'a': [1, 2, 3]})
+        self.assertEqual(cache.get('client_nothing'), None)
+
+    def test_large_value(self):
+        """
+        Values far larger than the read buffer are not truncated.
+        """
+        cache = self.client()
+        value = ['x' * 100] * 10000
+        cache.set('client_big', value)
+        self.assertEqual(cache.get('client_big'), value)
+
+    def test_raw_value_partial_writes(self):
+        """
+        Values larger than the socket buffers are sent in pieces both ways.
+        """
+        cache = self.client(serializer='raw')
+        value = bytes(range(256)) * 32768
+        cache.set('client_raw_big', value)
+        self.assertEqual(cache.get('client_raw_big'), value)
+
+    def test_pipeline(self):
+        """
+        Pipelined commands return their results in the order they were queued.
+        """
+        cache = self.client()
+        with cache.pipeline() as pipe:
+            for i in range(100):
+                pipe.set('client_p{0}'.format(i), i)
+            for i in reversed(range(100)):
+                pipe.get('client_p{0}'.format(i))
+        self.assertEqual(pipe.results[:100], ['SUCCESS'] * 100)
+        self.assertEqual(pipe.results[100:], list(reversed(range(100))))
+
+    def test_set_many_get_many(self):
+        cache = self.client()
+        cache.set_many({'client_m1': 1, 'client_m2': [2], 'client_m3': '3'},
+                       seconds={'client_m3': 0})
+        self.assertEqual(cache.get_many(['client_m1', 'client_m2', 'client_m3', 'client_nothing']),
+                         {'client_m1': 1, 'client_m2': [2]})
+        cache.set_many({'client_m4': 4, 'client_m5': 5}, seconds=100)
+        self.assertEqual(cache.get_many(['client_m4', 'client_m5']), {'client_m4': 4, 'client_m5': 5})
+        self.assertEqual(cache.get_many([]), {})
+
+    def test_large_batches(self):
+        """
+        Batches of more than 65535 items fit in one frame.
+        """
+        cache = self.client()
+        mapping = dict(('client_b{0}'.format(i), i,) for i in range(40000))
+        cache.set_many(mapping)
+        self.assertEqual(cache.get_many(list(mapping)), mapping)
+
+    def test_atomic(self):
+        """
+        Counters stay correct when many threads update them at once.
+        """
+        cache = self.client()
+        def work():
+            for _ in range(100):
+                cache.incr('client_hits', seconds=60)
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.decr('client_hits', 0), 800)
+        self.assertEqual(cache.decr('client_left', 2, initial=10), 8)
+
+        self.assertTrue(cache.add('client_once', [1]))
+        self.assertFalse(cache.add('client_once', [2]))
+        value, version = cache.gets('client_once')
+        self.assertEqual(value, [1])
+        self.assertTrue(cache.cas('client_once', [3], version))
+        self.assertFalse(cache.cas('client_once', [4], version))
+        self.assertEqual(cache.get('client_once'), [3])
+        self.assertEqual(cache.gets('client_nothing'), (None, None))
+        self.assertFalse(cache.cas('client_nothing', [1], version))
+
+    def test_invalidation(self):
+        """
+        Keys are deleted one by one, by tag or by prefix, on the server and in
+        the near cache.
+        """
+        cache = self.client(near_cache_size=100)
+        cache.set('client:user:1', 'one', tags=['client_users'])
+        cache.set('client:user:2', 'two', tags=['client_users', 'client_admins'])
+        cache.set('client:post:1', 'post')
+        self.assertTrue(cache.tag('client:post:1', 'client_admins'))
+        self.assertFalse(cache.tag('client:nothing', 'client_admins'))
+        self.assertEqual(cache.delete_tag('client_admins'), 2)
+        self.assertEqual(cache.get('client:user:2'), None)
+        self.assertEqual(cache.get('client:user:1'), 'one')
+        self.assertEqual(cache.delete_prefix('client:user:'), 1)
+        self.assertEqual(cache.get('client:user:1'), None)
+        cache.set('client:user:3', 'three')
+        self.assertEqual(cache.delete('client:user:3', 'client:nothing'), 1)
+        self.assertEqual(cache.get('client:user:3'), None)
+
+    def test_stats(self):
+        cache = self.client()
+        before = cache.stats()
+        cache.set('client_s1', 1)
+        cache.get('client_s1')
+        cache.get('client_nothing')
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], before['hits'] + 1)
+        self.assertEqual(stats['misses'], before['misses'] + 1)
+        self.assertTrue(stats['keys'] >= 1)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['latency_get_count'], before.get('latency_get_count', 0) + 2)
+        self.assertEqual(sum(stats['latency_get_buckets']), stats['latency_get_count'])
+        self.assertEqual(stats['eviction_policy'], 'default')
+
+    def test_text_fallback(self):
+        cache = self.client()
+        self.assertEqual(cache._execute_command('SET client_t1 "some text"'), 'SUCCESS')
+        self.assertEqual(cache._execute_command('GET client_t1'), 'some text')
+        with self.assertRaises(ValueError):
+            cache._execute_command('GET')
+
+
+class TestNCacheCachable(NCacheServerTestCase):
+    """
+    Concurrent misses on a key compute it once and stale keys are served
+    while one caller recomputes them.
+    """
+    def test_single_flight(self):
+        cache = self.client()
+        calls = []
+        release = threading.Event()
+        @cache.cachable(key_name='flight_k1')
+        def slow():
+            calls.append(1)
+            release.wait()
+            return 'computed'
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(slow())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        while not cache._flights:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['computed'] * 8)
+        self.assertEqual(calls, [1])
+
+    def test_tags(self):
+        cache = self.client()
+        calls = []
+        @cache.cachable(tags=lambda user_id: ['tags_user:{0}'.format(user_id)])
+        def profile(user_id):
+            calls.append(user_id)
+            return {'id': user_id}
+        profile(7)
+        profile(7)
+        self.assertEqual(cache.delete_tag('tags_user:7'), 1)
+        profile(7)
+        self.assertEqual(calls, [7, 7])
+
+    def test_lease(self):
+        cache, other = self.client(), self.client()
+        token = cache.lease('lease_k1', 10)
+        self.assertNotEqual(token, None)
+        self.assertEqual(other.lease('lease_k1', 10), None)
+        self.assertEqual(cache.lease('lease_k1', 10, token=token), token)
+        self.assertFalse(other.release('lease_k1', 'wrong'))
+        self.assertTrue(cache.release('lease_k1', token))
+        self.assertNotEqual(other.lease('lease_k1', 10), None)
+
+    def test_lease_waits_for_value(self):
+        cache, other = self.client(), self.client()
+        token = other.lease('lease_k2', 10)
+        @cache.cachable(key_name='lease_k2', lease=10)
+        def compute():
+            return 'mine'
+        threading.Timer(0.1, other.set, ('lease_k2', 'theirs',)).start()
+        self.assertEqual(compute(), 'theirs')
+
+    def test_stale_while_revalidate(self):
+        cache = self.client()
+        values = iter(['first', 'second'])
+        @cache.cachable(key_name='stale_k1', seconds=1, stale=60)
+        def compute():
+            return next(values)
+        self.assertEqual(compute(), 'first')
+        value, fresh_until = cache.get('stale_k1')
+        # out of date, the old value is served while it is recomputed
+        cache.set('stale_k1', (value, fresh_until - 1,), seconds=60)
+        self.assertEqual(compute(), 'first')
+        deadline = time.time() + 5
+        while cache.get('stale_k1')[0] != 'second' and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(compute(), 'second')
+        with self.assertRaises(ValueError):
+            cache.cachable(stale=10)
+
+
+class TestNCacheSerializers(NCacheServerTestCase):
+    """
+    Values round trip through every serializer, large ones compressed.
+    """
+    def test_codec(self):
+        value = {'rows': [[i, 'name'] for i in range(1000)]}
+        for name in ('pickle', 'marshal'):
+            codec = Codec(name, compress_threshold=1024)
+            data = codec.encode(value)
+            self.assertEqual(data[:1], FLAG_ZLIB)
+            self.assertEqual(codec.decode(data), value)
+            self.assertEqual(codec.encode([1])[:1], FLAG_PLAIN)
+            self.assertEqual(codec.decode(codec.encode([1])), [1])
+        self.assertEqual(Codec('raw').encode(b'\x00abc'), b'\x00abc')
+        # incompressible values are not compressed
+        self.assertEqual(Codec('raw', compress_threshold=1).encode(b'\x9c'), FLAG_PLAIN + b'\x9c')
+        with self.assertRaises(ValueError):
+            Codec('json')
+
+    def test_client(self):
+        value = ['x' * 100] * 1000
+        cache = self.client(serializer='marshal', compress_threshold=1024)
+        cache.set('codec_k1', value)
+        cache.set_many({'codec_k2': value, 'codec_k3': 3})
+        self.assertEqual(cache.get('codec_k1'), value)
+        self.assertEqual(cache.get_many(['codec_k2', 'codec_k3']), {'codec_k2': value, 'codec_k3': 3})
+        stored = ncache.store.entries['codec_k1'].value
+        self.assertTrue(len(stored) < 1000, len(stored))
+        raw = self.client(serializer='raw')
+        raw.set('codec_k4', b'bytes')
+        self.assertEqual(raw.get('codec_k4'), b'bytes')
+
+
+class TestNCacheConnectionPool(NCacheServerTestCase):
+    """
+    Connections are pooled and shared safely between threads.
+    """
+    def test_threads_share_client(self):
+        """
+        Many threads using one client never see each other's responses.
+        """
+        cache = self.client(pool_size=4)
+        errors = []
+        def work(n):
+            try:
+                for i in range(50):
+                    key = 'pool_{0}_{1}'.format(n, i)
+                    cache.set(key, (n, i))
+                    if cache.get(key) != (n, i):
+                        errors.append(key)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(cache.pool.created <= 4)
+
+    def test_pool_timeout(self):
+        cache = self.client(pool_size=1, pool_timeout=0.01)
+        conn = cache.pool.get()
+        with self.assertRaises(PoolTimeout):
+            cache.get('pool_k1')
+        cache.pool.put(conn)
+        self.assertEqual(cache.get('pool_k1'), None)
+
+    def test_reconnect_broken_connection(self):
+        """
+        A pooled connection that was closed while idle is replaced transparently.
+        """
+        cache = self.client(pool_size=1)
+        cache.set('pool_k2', 'v2')
+        cache.pool.idle[0].sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(cache.get('pool_k2'), 'v2')
+
+    def test_health_check(self):
+        """
+        Idle connections are checked before reuse when health checks are due.
+        """
+        cache = self.client(pool_size=1, health_check_interval=0)
+        cache.set('pool_k3', 'v3')
+        broken = cache.pool.idle[0]
+        broken.sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(cache.get('pool_k3'), 'v3')
+        self.assertFalse(broken in cache.pool.idle)
+
+
+class TestNearCache(NCacheServerTestCase):
+    """
+    Hot keys are served in process, bounded and no longer than their ttl.
+    """
+    def test_limits(self):
+        near = NearCache(max_entries=3, max_bytes=100)
+        for key in ('a', 'b', 'c'):
+            near.put(key, key, 10)
+        near.get('a')
+        near.put('d', 'd', 10)
+        self.assertEqual(list(near.entries), ['c', 'a', 'd'])
+        near.put('e', 'e', 80)
+        self.assertEqual(list(near.entries), ['a', 'd', 'e'])
+        self.assertEqual((near.bytes, near.evictions,), (100, 2,))
+        near.invalidate('e')
+        self.assertEqual((near.get('e'), near.bytes,), (None, 20,))
+
+    def test_ttl(self):
+        near = NearCache(ttl=10)
+        near.put('a', 'a', 1, seconds=0.01)
+        near.put('b', 'b', 1)
+        self.assertEqual(near.entries['b'][1] - near.entries['a'][1] > 9, True)
+        time.sleep(0.02)
+        self.assertEqual((near.get('a'), near.get('b'),), (None, 'b',))
+
+    def test_client(self):
+        cache = self.client(near_cache_size=100)
+        writer = self.client()
+        writer.set('near_k1', [1])
+        writer.set('near_k2', [2], seconds=1)
+        self.assertEqual(cache.get('near_k1'), [1])
+        self.assertEqual(cache.get('near_k2'), [2])
+        writer.set('near_k1', [3])
+        # served locally until invalidated
+        self.assertEqual(cache.get('near_k1'), [1])
+        cache.near.invalidate('near_k1')
+        self.assertEqual(cache.get('near_k1'), [3])
+        # the server ttl is kept locally
+        self.assertTrue(0 < cache.near.entries['near_k2'][1] - time.monotonic() <= 1)
+        cache.set('near_k3', [4])
+        self.assertEqual(cache.get_many(['near_k1', 'near_k3']), {'near_k1': [3], 'near_k3': [4]})
+        stats = cache.near.stats()
+        self.assertEqual((stats['hits'], stats['misses'],), (3, 3,))
+
+
+def _run_replica(**kw):
+    # a forked replica starts with an empty cache, not a copy of the test's
+    ncache.flush_all()
+    ncache.run_ncache(**kw)
+
+class TestNCacheReplicas(NCacheServerTestCase):
+    """
+    Reads are spread over replicas, in their own processes, and writes go to
+    the server they replicate.
+    """
+    def replica(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        address = sock.getsockname()
+        sock.close()
+        process = multiprocessing.Process(target=_run_replica, kwargs=dict(port=address[1], primary=self.server.address))
+        process.start()
+        self.addCleanup(process.join)
+        self.addCleanup(process.terminate)
+        deadline = time.time() + 10
+        while True:
+            try:
+                cache = NCache(*address)
+                self.addCleanup(cache.close)
+                return cache
+            except ConnectionError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.01)
+
+    def test_reads_from_replica(self):
+        replica_only = self.replica()
+        cache = self.client(replicas=[(replica_only.pool.ip, replica_only.pool.port,)])
+        cache.set('replica_k1', [1, 2])
+        deadline = time.time() + 10
+        while replica_only.get('replica_k1') is None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(replica_only.stats()['replication_connected'], 1)
+        self.assertEqual(cache.get_many(['replica_k1', 'replica_nothing']), {'replica_k1': [1, 2]})
+        self.assertTrue(replica_only.stats()['latency_mget_count'] >= 1)
+        with self.assertRaises(ValueError):
+            replica_only.set('replica_k2', 'value')
+
+    def test_replica_down(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        cache = self.client(replicas=[sock.getsockname()])
+        sock.close()
+        cache.set('replica_k3', 'value')
+        self.assertEqual(cache.get('replica_k3'), 'value')
+
+
+class TestHashRing(unittest.TestCase):
+    """
+    Keys spread evenly over nodes and few keys move when nodes come and go.
+    """
+    keys = ['key{0}'.format(i) for i in range(10000)]
+
+    def test_spread(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        counts = {}
+        for key in self.keys:
+            node = ring.get(key)
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(sorted(counts), ['a', 'b', 'c', 'd'])
+        for count in counts.values():
+            self.assertTrue(1750 < count < 3250, counts)
+
+    def test_add_remove_node(self):
+        ring = HashRing(['a', 'b', 'c'])
+        before = dict((key, ring.get(key),) for key in self.keys)
+        ring.add('d')
+        moved = [key for key in self.keys if ring.get(key) != before[key]]
+        # only keys now owned by the new node move, about a quarter of them
+        self.assertTrue(all(ring.get(key) == 'd' for key in moved))
+        self.assertTrue(1750 < len(moved) < 3250, len(moved))
+        ring.remove('d')
+        self.assertEqual(before, dict((key, ring.get(key),) for key in self.keys))
+
+
+class TestShardedNCache(unittest.TestCase):
+    """
+    A sharded client works across several servers like a single NCache.
+    """
+    def setUp(self):
+        nodes = []
+        for _ in range(3):
+            server = ncache.Server(port=0)
+            thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+            thread.start()
+            self.addCleanup(thread.join)
+            self.addCleanup(server.stop)
+            nodes.append(server.address)
+        self.cache = ShardedNCache(nodes, pool_size=2)
+        self.addCleanup(self.cache.close)
+
+    def test_set_get(self):
+        self.cache.set('shard_k1', [1])
+        self.assertEqual(self.cache.get('shard_k1'), [1])
+        self.assertEqual(self.cache.get('shard_nothing'), None)
+
+    def test_set_many_get_many(self):
+        values = dict(('shard_m{0}'.format(i), i,) for i in range(50))
+        self.cache.set_many(values, seconds=100)
+        self.assertEqual(len(set(self.cache.ring.get(key) for key in values)), 3)
+        self.assertEqual(self.cache.get_many(list(values) + ['shard_nothing']), values)
+
+    def test_cachable(self):
+        calls = []
+        @self.cache.cachable()
+        def addit(a, b):
+            calls.append((a, b))
+            return a + b
+        self.assertEqual(addit(1, 2), 3)
+        self.assertEqual(addit(1, 2), 3)
+        self.assertEqual(calls, [(1, 2)])
+
+
+class TestAsyncNCache(NCacheServerTestCase):
+    """
+    Concurrent coroutines pipeline requests onto a few stream connections.
+    """
+    def run_async(self, test, **kw):
+        async def run():
+            ip, port = self.server.address
+            cache = AsyncNCache(ip=ip, port=port, **kw)
+            try:
+                return await test(cache)
+            finally:
+                cache.close()
+        return asyncio.run(run())
+
+    def test_set_get(self):
+        async def test(cache):
+            self.assertEqual(await cache.set('async_k1', {'a': 1}), 'SUCCESS')
+            self.assertEqual(await cache.get('async_k1'), {'a': 1})
+            self.assertEqual(await cache.get('async_nothing'), None)
+        self.run_async(test)
+
+    def test_concurrent_coroutines(self):
+        async def test(cache):
+            keys = ['async_c{0}'.format(i) for i in range(500)]
+            await asyncio.gather(*[cache.set(key, key * 10) for key in keys])
+            values = await asyncio.gather(*[cache.get(key) for key in keys])
+            self.assertEqual(values, [key * 10 for key in keys])
+            self.assertEqual(len([conn for conn in cache.connections if conn is not None]), 2)
+        self.run_async(test, pool_size=2)
+
+    def test_set_many_get_many(self):
+        async def test(cache):
+            values = dict(('async_m{0}'.format(i), i,) for i in range(20))
+            await cache.set_many(values, seconds=100)
+            self.assertEqual(await cache.get_many(list(values) + ['async_nothing']), values)
+        self.run_async(test)
+
+    def test_cachable(self):
+        calls = []
+        async def test(cache):
+            @cache.cachable()
+            async def async_addit(a, b):
+                calls.append((a, b))
+                return a + b
+            self.assertEqual(await async_addit(1, 2), 3)
+            self.assertEqual(await async_addit(1, 2), 3)
+        self.run_async(test)
+        self.assertEqual(calls, [(1, 2)])
+
+    def test_cachable_single_flight(self):
+        calls = []
+        async def test(cache):
+            @cache.cachable(key_name='async_flight')
+            async def slow():
+                calls.append(1)
+                await asyncio.sleep(0.05)
+                return 'computed'
+            self.assertEqual(await asyncio.gather(*[slow() for _ in range(8)]), ['computed'] * 8)
+        self.run_async(test)
+        self.assertEqual(calls, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()